@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from metapep_utils import iter_table_chunks, read_table
+
+####################################################################################################
+
+
+def parse_args(args=None):
+    """Parses the command line arguments specified by the user."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Build the peptide index used by the downstream steps: for each peptide_id the contributions of the "
+            "peptide to the combinations of entity, allele, condition and entity weight (groups), stored in CSR "
+            "format as memory-mappable NumPy arrays."
+        )
+    )
+
+    # INPUT FILES
+    parser.add_argument(
+        "-ppo",
+        "--protein-peptide-occ",
+        help="Path to the protein peptide occurences input file",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "-epo",
+        "--entities-proteins-occ",
+        help="Path to the entity protein occurences input file",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "-meo",
+        "--microbiomes-entities-occ",
+        help="Path to the microbiome entity occurences input file",
+        type=str,
+        required=True,
+    )
+    parser.add_argument("-c", "--conditions", help="Path to the conditions input file", type=str, required=True)
+    parser.add_argument(
+        "-cam", "--condition-allele-map", help="Path to the condition allele map input file", type=str, required=True
+    )
+
+    # OUTPUT FILES
+    parser.add_argument(
+        "-o", "--outdir", help="Path to the output directory of the peptide index", type=str, required=True
+    )
+
+    # PARAMETERS
+    parser.add_argument(
+        "-pc",
+        "--chunk-size",
+        help="Number of protein peptide occurences processed at once to limit memory usage. Default: 500000",
+        type=int,
+        default=500000,
+    )
+    parser.add_argument(
+        "-mlld",
+        "--mem_log_level_deep",
+        help="Enable 'deep' option for pandas memory usage output ('deep' enables accurate usage values, but increases runtime). Default: None. ",
+        default=False,
+        action="store_true",
+    )
+
+    return parser.parse_args()
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.mem_log_level_deep:
+        print_mem = "deep"
+    else:
+        print_mem = None
+
+    now = datetime.datetime.now()
+    print("Start date and time : ")
+    print(now.strftime("%Y-%m-%d %H:%M:%S"))
+
+    # Read input files
+    entities_proteins_occs = read_table(args.entities_proteins_occ, columns=["entity_id", "protein_id"])
+    entities_proteins_occs["entity_id"] = pd.to_numeric(entities_proteins_occs["entity_id"], downcast="unsigned")
+    entities_proteins_occs["protein_id"] = pd.to_numeric(entities_proteins_occs["protein_id"], downcast="unsigned")
+
+    microbiomes_entities_occs = read_table(
+        args.microbiomes_entities_occ, columns=["microbiome_id", "entity_id", "entity_weight"]
+    )
+    microbiomes_entities_occs["microbiome_id"] = pd.to_numeric(
+        microbiomes_entities_occs["microbiome_id"], downcast="unsigned"
+    )
+    microbiomes_entities_occs["entity_id"] = pd.to_numeric(microbiomes_entities_occs["entity_id"], downcast="unsigned")
+    microbiomes_entities_occs["entity_weight"] = pd.to_numeric(
+        microbiomes_entities_occs["entity_weight"], downcast="float"
+    )
+
+    conditions = pd.read_csv(args.conditions, sep="\t")
+    conditions["condition_id"] = pd.to_numeric(conditions["condition_id"], downcast="unsigned")
+    conditions["microbiome_id"] = pd.to_numeric(conditions["microbiome_id"], downcast="unsigned")
+
+    condition_allele_map = pd.read_csv(args.condition_allele_map, sep="\t")
+    condition_allele_map["condition_id"] = pd.to_numeric(condition_allele_map["condition_id"], downcast="unsigned")
+    condition_allele_map["allele_id"] = pd.to_numeric(condition_allele_map["allele_id"], downcast="unsigned")
+
+    # Create output directory if it doesn't exist
+    if os.path.exists(args.outdir) and not os.path.isdir(args.outdir):
+        print("ERROR - The target path is not a directory", file=sys.stderr)
+        sys.exit(2)
+    elif not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    print("Prepare df with protein info ...", flush=True)
+    # Prepare df for joining protein information (the same join as in the downstream steps)
+    protein_info = (
+        microbiomes_entities_occs.merge(conditions)
+        .drop(columns="microbiome_id")
+        .merge(condition_allele_map)
+        .drop(columns="condition_id")
+        .merge(entities_proteins_occs)
+    )
+    # -> protein_id, entity_id, entity_weight, condition_name, allele_id
+    print("\nInfo: protein_info", flush=True)
+    protein_info.info(verbose=False, memory_usage=print_mem)
+
+    # Index the combinations of entity_id, allele_id, condition_name and entity_weight (groups) in the order of the
+    # entity binding ratio results
+    group_columns = ["entity_id", "allele_id", "condition_name", "entity_weight"]
+    groups = protein_info[group_columns].drop_duplicates().sort_values(group_columns, ignore_index=True)
+    groups.to_csv(os.path.join(args.outdir, "groups.tsv"), sep="\t", index_label="group")
+    protein_info = protein_info.merge(groups.reset_index(names="group"))[["protein_id", "group"]]
+    protein_info["group"] = protein_info["group"].astype(np.uint32)
+    # -> protein_id, group
+
+    # First pass: count each peptide within each group of its proteins and buffer the entries, which are in the order
+    # of the protein peptide occurences, in temporary files
+    # (a peptide can be split across chunks, so a peptide and group can have several entries, which is fine for sums)
+    entries_per_peptide = np.zeros(0, dtype=np.int64)
+    with tempfile.TemporaryDirectory(dir=args.outdir) as tmpdir:
+        entry_files = {column: open(os.path.join(tmpdir, column), "w+b") for column in ["peptide_id", "group", "count"]}
+        try:
+            for i, protein_peptide_occs in enumerate(
+                iter_table_chunks(
+                    args.protein_peptide_occ, args.chunk_size, columns=["protein_id", "peptide_id", "count"]
+                )
+            ):
+                print("\nChunk: ", i, flush=True)
+                entries = (
+                    protein_peptide_occs.merge(protein_info)
+                    .groupby(["peptide_id", "group"], sort=True)["count"]
+                    .sum()
+                    .reset_index()
+                )
+                # -> peptide_id, group, count (sorted by peptide_id and group)
+                peptide_ids = entries["peptide_id"].to_numpy(dtype=np.int64)
+                entries["peptide_id"].to_numpy(dtype=np.uint32).tofile(entry_files["peptide_id"])
+                entries["group"].to_numpy(dtype=np.uint32).tofile(entry_files["group"])
+                entries["count"].to_numpy(dtype=np.uint32).tofile(entry_files["count"])
+                if len(peptide_ids):
+                    counts = np.bincount(peptide_ids)
+                    if len(counts) > len(entries_per_peptide):
+                        entries_per_peptide = np.pad(entries_per_peptide, (0, len(counts) - len(entries_per_peptide)))
+                    entries_per_peptide[: len(counts)] += counts
+
+            # Second pass: place the entries of each peptide consecutively (counting sort by peptide_id)
+            indptr = np.zeros(len(entries_per_peptide) + 1, dtype=np.int64)
+            np.cumsum(entries_per_peptide, out=indptr[1:])
+            print("\nPeptides:", len(entries_per_peptide), "entries:", indptr[-1], flush=True)
+            group = np.lib.format.open_memmap(
+                os.path.join(args.outdir, "group.npy"), mode="w+", dtype=np.uint32, shape=(indptr[-1],)
+            )
+            count = np.lib.format.open_memmap(
+                os.path.join(args.outdir, "count.npy"), mode="w+", dtype=np.uint32, shape=(indptr[-1],)
+            )
+            next_entry = indptr[:-1].copy()
+            for entry_file in entry_files.values():
+                entry_file.seek(0)
+            while True:
+                peptide_ids = np.fromfile(entry_files["peptide_id"], dtype=np.uint32, count=args.chunk_size)
+                if len(peptide_ids) == 0:
+                    break
+                chunk_groups = np.fromfile(entry_files["group"], dtype=np.uint32, count=len(peptide_ids))
+                chunk_counts = np.fromfile(entry_files["count"], dtype=np.uint32, count=len(peptide_ids))
+                # (stable sort, so that the entries of a peptide keep their order)
+                order = np.argsort(peptide_ids, kind="stable")
+                unique_ids, first, num_entries = np.unique(peptide_ids[order], return_index=True, return_counts=True)
+                positions = np.repeat(next_entry[unique_ids] - first, num_entries) + np.arange(len(peptide_ids))
+                group[positions] = chunk_groups[order]
+                count[positions] = chunk_counts[order]
+                next_entry[unique_ids] += num_entries
+            group.flush()
+            count.flush()
+        finally:
+            for entry_file in entry_files.values():
+                entry_file.close()
+    np.save(os.path.join(args.outdir, "indptr.npy"), indptr)
+
+    print("Done!", flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
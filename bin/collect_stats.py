@@ -5,6 +5,8 @@ import sys
 
 import pandas as pd
 
+from metapep_utils import read_table
+
 
 def parse_args(args=None):
     """Parses the command line arguments specified by the user."""
@@ -45,18 +47,16 @@ def main(args=None):
     args = parse_args(args)
 
     # Read input files
-    protein_peptide_occs = pd.read_csv(args.protein_peptide_occ, sep="\t")
+    protein_peptide_occs = read_table(args.protein_peptide_occ, columns=["protein_id", "peptide_id", "count"])
     protein_peptide_occs["protein_id"] = pd.to_numeric(protein_peptide_occs["protein_id"], downcast="unsigned")
     protein_peptide_occs["peptide_id"] = pd.to_numeric(protein_peptide_occs["peptide_id"], downcast="unsigned")
     protein_peptide_occs["count"] = pd.to_numeric(protein_peptide_occs["count"], downcast="unsigned")
 
-    entities_proteins_occs = pd.read_csv(args.entities_proteins_occ, sep="\t")
+    entities_proteins_occs = read_table(args.entities_proteins_occ, columns=["entity_id", "protein_id"])
     entities_proteins_occs["entity_id"] = pd.to_numeric(entities_proteins_occs["entity_id"], downcast="unsigned")
     entities_proteins_occs["protein_id"] = pd.to_numeric(entities_proteins_occs["protein_id"], downcast="unsigned")
 
-    microbiomes_entities_occs = pd.read_csv(
-        args.microbiomes_entities_occ, usecols=["microbiome_id", "entity_id"], sep="\t"
-    )
+    microbiomes_entities_occs = read_table(args.microbiomes_entities_occ, columns=["microbiome_id", "entity_id"])
     microbiomes_entities_occs["microbiome_id"] = pd.to_numeric(
         microbiomes_entities_occs["microbiome_id"], downcast="unsigned"
     )
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+from metapep_utils import NO_SCORE_BIN, get_bin_edges, get_binder_threshold, get_score_bins, iter_table_chunks
+
+####################################################################################################
+
+
+def parse_args(args=None):
+    """Parses the command line arguments specified by the user."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compact the merged predictions into per-allele binder bitmaps and prediction score bins, which is all "
+            "the downstream visualizations need."
+        )
+    )
+
+    # INPUT FILES
+    parser.add_argument("-p", "--predictions", help="Path to the predictions input file", type=str, required=True)
+
+    # OUTPUT FILES
+    parser.add_argument(
+        "-o", "--output", help="Path to the compact predictions output file (.compact.npz)", type=str, required=True
+    )
+
+    # PARAMETERS
+    parser.add_argument("-m", "--method", help="Used epitope prediction method", type=str, required=True)
+    parser.add_argument(
+        "-c",
+        "--chunk-size",
+        help="Number of predictions read at once from the predictions input file. Default: 1000000",
+        type=int,
+        default=1000000,
+    )
+    parser.add_argument(
+        "-b",
+        "--bins",
+        help=(
+            "Number of prediction score bins (between the score bounds of the method or, if unknown, the minimum and "
+            "maximum score). Default: 1000"
+        ),
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "-sst",
+        "--syfpeithi_score_threshold",
+        help=("Threshold for binder/non-binder calling when using SYFPEITHI epitope prediction method. Default: 0.5"),
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        "-mst",
+        "--mhcf_mhcn_score_threshold",
+        help=(
+            "Threshold for binder/non-binder calling when using MHCflurry or MHCnuggets epitope prediction methods. Default: 0.426"
+        ),
+        type=float,
+        default=0.426,
+    )
+
+    return parser.parse_args()
+
+
+def read_prediction_chunks(path, chunk_size):
+    """Yields the predictions chunk-wise with the column types used by the downstream steps."""
+    for chunk in iter_table_chunks(path, chunk_size, columns=["peptide_id", "prediction_score", "allele_id"]):
+        chunk["prediction_score"] = pd.to_numeric(chunk["prediction_score"], downcast="float")
+        yield chunk
+
+
+def pack_bits(peptide_ids, bits, num_bytes):
+    """Takes unique sorted peptide ids and their bits within their bytes and returns the packed bitmap."""
+    packed = np.zeros(num_bytes, dtype=np.uint8)
+    if len(peptide_ids):
+        byte_ids, starts = np.unique(peptide_ids // 8, return_index=True)
+        packed[byte_ids] = np.add.reduceat(bits, starts)
+    return packed
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.bins >= NO_SCORE_BIN:
+        print("ERROR - The number of prediction score bins must be less than", NO_SCORE_BIN, file=sys.stderr)
+        sys.exit(2)
+
+    # First pass: get score range, alleles and peptide_id range
+    min_score, max_score = np.inf, -np.inf
+    max_peptide_id = -1
+    allele_ids = set()
+    for chunk in read_prediction_chunks(args.predictions, args.chunk_size):
+        if len(chunk) == 0:
+            continue
+        min_score = min(min_score, chunk["prediction_score"].min())
+        max_score = max(max_score, chunk["prediction_score"].max())
+        max_peptide_id = max(max_peptide_id, chunk["peptide_id"].max())
+        allele_ids.update(chunk["allele_id"].unique().tolist())
+    allele_ids = sorted(allele_ids)
+    num_peptides = max_peptide_id + 1
+    print("Alleles:", allele_ids, "peptide_ids:", num_peptides, "scores:", min_score, "-", max_score, flush=True)
+
+    # Use the same bin edges as prepare_score_distribution.py, i.e. those of pd.cut() on the score bounds of the
+    # method or on all prediction scores (these only depend on min and max)
+    bin_edges = get_bin_edges(args.method, min_score, max_score, args.bins)
+
+    # Second pass: collect the peptide ids, binder calls and score bins of the predictions per allele
+    threshold = get_binder_threshold(args.method, args.syfpeithi_score_threshold, args.mhcf_mhcn_score_threshold)
+    allele_index = {allele_id: i for i, allele_id in enumerate(allele_ids)}
+    allele_chunks = [[] for _ in allele_ids]
+    for i, chunk in enumerate(read_prediction_chunks(args.predictions, args.chunk_size)):
+        print(" Chunk: ", i, flush=True)
+        rows = chunk["allele_id"].map(allele_index).to_numpy()
+        peptide_ids = chunk["peptide_id"].to_numpy(dtype=np.uint32)
+        scores = chunk["prediction_score"].to_numpy()
+        # compare in double precision like call_binder() does on the single scores
+        binders = scores.astype(np.float64) >= threshold
+        codes = get_score_bins(scores, bin_edges)
+        codes = np.where(codes < 0, NO_SCORE_BIN, codes).astype(np.uint16)
+        order = np.argsort(rows, kind="stable")
+        starts = np.searchsorted(rows[order], np.arange(len(allele_ids) + 1))
+        for row in np.flatnonzero(np.diff(starts)):
+            selected = order[starts[row] : starts[row + 1]]
+            allele_chunks[row].append((peptide_ids[selected], binders[selected], codes[selected]))
+
+    # Pack the predicted and binder bitmaps per allele (bit j of the packed row is peptide_id j, as with
+    # np.packbits()) and keep the score bins only for the predicted peptides (in peptide_id order, concatenated over
+    # the alleles)
+    num_bytes = (num_peptides + 7) // 8
+    predicted = np.zeros((len(allele_ids), num_bytes), dtype=np.uint8)
+    binder = np.zeros((len(allele_ids), num_bytes), dtype=np.uint8)
+    score_bins = []
+    for row, chunks in enumerate(allele_chunks):
+        if not chunks:
+            continue
+        peptide_ids, binders, codes = (np.concatenate(column) for column in zip(*chunks))
+        allele_chunks[row] = None
+        order = np.argsort(peptide_ids, kind="stable")
+        # (a peptide predicted more than once keeps its last prediction)
+        last = np.append(peptide_ids[order][1:] != peptide_ids[order][:-1], True)
+        order = order[last]
+        peptide_ids, binders = peptide_ids[order], binders[order]
+        score_bins.append(codes[order])
+        bits = np.right_shift(np.uint8(128), (peptide_ids % 8).astype(np.uint8))
+        predicted[row] = pack_bits(peptide_ids, bits, num_bytes)
+        binder[row] = pack_bits(peptide_ids[binders], bits[binders], num_bytes)
+
+    np.savez_compressed(
+        args.output,
+        allele_ids=np.array(allele_ids, dtype=np.uint16),
+        num_peptides=np.array(num_peptides),
+        predicted=predicted,
+        binder=binder,
+        score_bins=np.concatenate(score_bins) if score_bins else np.empty(0, dtype=np.uint16),
+        bin_edges=bin_edges,
+        method=np.array(args.method),
+        binder_threshold=np.array(threshold),
+    )
+    print("Done!", flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
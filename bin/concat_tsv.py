@@ -1,10 +1,217 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import gzip
+import heapq
+import io
+import itertools
+import os
 import sys
+import tempfile
 
 import pandas as pd
 
+from metapep_utils import TableWriter
+
+# Fixed column types of known columns (used for Parquet output)
+COLUMN_DTYPES = {"peptide_id": "uint64", "prediction_score": "float32", "allele_id": "uint16"}
+
+
+class ParallelGzipWriter:
+    """Writes bytes into a gzip file, compressing blocks of the given size in parallel threads (zlib releases the GIL).
+    Each block is written as a separate gzip member, which gzip readers decompress as one concatenated stream."""
+
+    def __init__(self, path, threads=1, block_size=16777216, compresslevel=9):
+        self.handle = open(path, "wb")
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.buffer = []
+        self.buffer_size = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = 2 * threads
+        self.pending = collections.deque()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        if self.buffer:
+            self.pending.append(self.executor.submit(gzip.compress, b"".join(self.buffer), self.compresslevel))
+            self.buffer, self.buffer_size = [], 0
+        # Write compressed blocks in order, limiting the number of blocks held in memory
+        while self.pending and (len(self.pending) > self.max_pending or self.pending[0].done()):
+            self.handle.write(self.pending.popleft().result())
+
+    def close(self):
+        self._submit()
+        while self.pending:
+            self.handle.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BlockReader(io.RawIOBase):
+    """Read-only file object over an iterator of byte blocks, used to parse the streamed tables with pandas."""
+
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.remainder = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.remainder:
+            self.remainder = next(self.blocks, None)
+            if self.remainder is None:
+                self.remainder = b""
+                return 0
+        size = min(len(buffer), len(self.remainder))
+        buffer[:size] = self.remainder[:size]
+        self.remainder = self.remainder[size:]
+        return size
+
+
+def read_header(paths):
+    """Reads the header lines of all input files and checks that they match the header of the first input file
+    (column order must be the same). Returns the header line."""
+    header = None
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as infile:
+            file_header = infile.readline().rstrip(b"\r\n")
+        if header is None:
+            header = file_header
+            print("Header: ", header.decode().split("\t"), flush=True)
+        elif file_header != header:
+            print(
+                "ERROR - header of input file",
+                path,
+                "does not match the header of the first input file!",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+    return header + b"\n"
+
+
+def iter_blocks(paths, block_size):
+    """Yields the lines of all input files, skipping their headers, as raw byte blocks of about the given size."""
+    for path in paths:
+        print("Processing file: ", path, flush=True)
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as infile:
+            infile.readline()
+            for block in iter(lambda: infile.read(block_size), b""):
+                # complete the last line of the block
+                block += infile.readline()
+                if not block.endswith(b"\n"):
+                    block += b"\n"
+                yield block
+
+
+def get_line_key(key_index):
+    """Returns a function that extracts the integer column at the given index from a raw TSV line."""
+    return lambda line: int(line.split(b"\t", key_index + 1)[key_index])
+
+
+def is_sorted(path, key_index):
+    """Checks line by line whether the lines (without header) of the input file are sorted by the integer column at
+    the given index."""
+    line_key = get_line_key(key_index)
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as infile:
+        infile.readline()
+        previous_key = None
+        for line in infile:
+            if not line.strip():
+                continue
+            key = line_key(line)
+            if previous_key is not None and key < previous_key:
+                return False
+            previous_key = key
+    return True
+
+
+def sort_runs(path, key_index, run_size, tmpdir):
+    """Returns the lines (without header) of the input file as runs sorted by the integer column at the given index:
+    the input file itself if its lines are sorted already, otherwise temporary files with sorted runs of at most
+    run_size lines, so that at most run_size lines are kept in memory."""
+    if is_sorted(path, key_index):
+        return [(path, True)]
+    line_key = get_line_key(key_index)
+    runs = []
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as infile:
+        infile.readline()
+        lines = (line if line.endswith(b"\n") else line + b"\n" for line in infile if line.strip())
+        for run in iter(lambda: list(itertools.islice(lines, run_size)), []):
+            # (stable sort, so that lines with the same key keep their order)
+            run.sort(key=line_key)
+            fd, run_path = tempfile.mkstemp(dir=tmpdir, suffix=".tsv")
+            with os.fdopen(fd, "wb") as outfile:
+                outfile.writelines(run)
+            runs.append((run_path, False))
+    return runs
+
+
+def iter_run_lines(path, has_header):
+    """Yields the lines of a sorted run."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as infile:
+        if has_header:
+            infile.readline()
+        for line in infile:
+            yield line if line.endswith(b"\n") else line + b"\n"
+
+
+def merge_runs(runs, key_index):
+    """Merges the lines of sorted runs, given as (path, has_header), by the integer column at the given index."""
+    return heapq.merge(
+        *[iter_run_lines(path, has_header) for path, has_header in runs],
+        key=get_line_key(key_index),
+    )
+
+
+def iter_sorted_blocks(paths, key_column, header, block_size, run_size, fan_in, tmpdir):
+    """Yields the lines of all input files sorted by the integer key column (k-way merge of the input files, which
+    are split into sorted runs of at most run_size lines first unless already sorted) as raw byte blocks of about
+    the given size."""
+    key_index = header.rstrip(b"\n").split(b"\t").index(key_column.encode())
+    runs = []
+    for path in paths:
+        print("Processing file: ", path, flush=True)
+        runs.extend(sort_runs(path, key_index, run_size, tmpdir))
+    # Merge hierarchically to limit the number of simultaneously opened files
+    while len(runs) > fan_in:
+        merged_runs = []
+        for i in range(0, len(runs), fan_in):
+            fd, merged_path = tempfile.mkstemp(dir=tmpdir, suffix=".tsv")
+            with os.fdopen(fd, "wb") as outfile:
+                outfile.writelines(merge_runs(runs[i : i + fan_in], key_index))
+            merged_runs.append((merged_path, False))
+        runs = merged_runs
+
+    block, size = [], 0
+    for line in merge_runs(runs, key_index):
+        block.append(line)
+        size += len(line)
+        if size >= block_size:
+            yield b"".join(block)
+            block, size = [], 0
+    if block:
+        yield b"".join(block)
+
 
 def parse_args(args=None):
     """Parses the command line arguments specified by the user."""
@@ -14,7 +221,16 @@ def parse_args(args=None):
     parser.add_argument("-i", "--input", help="Path to input files.", type=str, required=True, nargs="+")
 
     # OUTPUT FILES
-    parser.add_argument("-o", "--output", help="Path to output file.", type=str, required=True)
+    parser.add_argument(
+        "-o",
+        "--output",
+        help=(
+            "Path to output file. Output files with the extension '.parquet' are written as Parquet files, output "
+            "files with the extension '.npz' as predictions with quantized prediction scores."
+        ),
+        type=str,
+        required=True,
+    )
 
     # PARAMETERS
     parser.add_argument(
@@ -24,6 +240,36 @@ def parse_args(args=None):
         type=int,
         default=10000,
     )
+    parser.add_argument(
+        "-s",
+        "--sort",
+        help=(
+            "Sort the output by the given integer column (e.g. peptide_id) with a k-way merge of the input files. "
+            "Unsorted input files are split into sorted runs of chunk size lines first."
+        ),
+        type=str,
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of threads used to compress gzip-compressed TSV output files. Default: 1",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-bs",
+        "--block-size",
+        help="Size in bytes of the blocks in which the TSV files are streamed and compressed. Default: 16777216",
+        type=int,
+        default=16777216,
+    )
+    parser.add_argument(
+        "-fi",
+        "--fan-in",
+        help="Maximum number of files merged at once when sorting. Default: 256",
+        type=int,
+        default=256,
+    )
 
     return parser.parse_args()
 
@@ -31,32 +277,48 @@ def parse_args(args=None):
 def main(args=None):
     args = parse_args(args)
 
-    first_header = pd.DataFrame().columns
-    for i, filename in enumerate(args.input):
-        print("Processing file: ", filename, flush=True)
-
-        # Read input file chunk-wise
-        with pd.read_csv(filename, sep="\t", chunksize=args.chunk_size) as reader:
-            for j, tsv_chunk in enumerate(reader):
-                print(" Chunk: ", j, flush=True)
-                if i == 0 and j == 0:
-                    first_header = tsv_chunk.columns
-                    print("Header: ", first_header.tolist(), flush=True)
-                    tsv_chunk.to_csv(args.output, mode="w", sep="\t", index=False, header=True)
-                else:
-                    if j == 0:
-                        # Check if header of subsequent input files match header of first input file
-                        # (column order must be the same)
-                        if tsv_chunk.columns.tolist() != first_header.tolist():
-                            print(
-                                "ERROR - header of input file",
-                                filename,
-                                "does not match the header of the first input file!",
-                                file=sys.stderr,
-                            )
-                            sys.exit(1)
+    # Validate the headers once, then stream the lines as raw bytes
+    header = read_header(args.input)
+    with tempfile.TemporaryDirectory(dir=".") as tmpdir:
+        if args.sort:
+            blocks = iter_sorted_blocks(
+                args.input, args.sort, header, args.block_size, args.chunk_size, args.fan_in, tmpdir
+            )
+        else:
+            blocks = iter_blocks(args.input, args.block_size)
 
-                    tsv_chunk.to_csv(args.output, mode="a", sep="\t", index=False, header=False)
+        if args.output.endswith(".parquet") or args.output.endswith(".npz"):
+            # Typed output formats: parse the stream chunk-wise
+            writer = None
+            try:
+                reader = io.BufferedReader(BlockReader(itertools.chain([header], blocks)), buffer_size=args.block_size)
+                with pd.read_csv(reader, sep="\t", chunksize=args.chunk_size) as tsv_reader:
+                    for j, tsv_chunk in enumerate(tsv_reader):
+                        print(" Chunk: ", j, flush=True)
+                        if writer is None:
+                            writer = TableWriter(
+                                args.output,
+                                {
+                                    column: COLUMN_DTYPES.get(column, "str" if dtype == object else str(dtype))
+                                    for column, dtype in tsv_chunk.dtypes.items()
+                                },
+                            )
+                        writer.write(tsv_chunk)
+            except ValueError as e:
+                print("ERROR -", e, file=sys.stderr)
+                sys.exit(1)
+            finally:
+                if writer:
+                    writer.close()
+        else:
+            if args.output.endswith(".gz"):
+                outfile = ParallelGzipWriter(args.output, threads=args.threads, block_size=args.block_size)
+            else:
+                outfile = open(args.output, "wb")
+            with outfile:
+                outfile.write(header)
+                for block in blocks:
+                    outfile.write(block)
 
 
 if __name__ == "__main__":
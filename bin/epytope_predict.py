@@ -2,21 +2,52 @@
 
 import argparse
 import contextlib
-import io
+import functools
+import glob
+import itertools
 
 ####################################################################################################
 import logging
+import math
+import multiprocessing
+import os
+import sqlite3
+import subprocess
 import sys
 import warnings
 
 logging.basicConfig(format="%(levelname)s - %(message)s", level=logging.WARNING)
 
+# Restrict the TensorFlow and OpenMP thread pools (see --threads) before TensorFlow is loaded by the imports below
+thread_parser = argparse.ArgumentParser(add_help=False)
+thread_parser.add_argument("-t", "--threads", type=int, default=None)
+threads = thread_parser.parse_known_args()[0].threads
+if threads:
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+
 ####################################################################################################
 
 import numpy as np
 import pandas as pd
 from epytope.Core import Allele, Peptide
 from epytope.EpitopePrediction import EpitopePredictorFactory
+from epytope.EpitopePrediction.PSSM import Syfpeithi
+from mhcflurry import Class1AffinityPredictor
+
+from metapep_utils import PREDICTION_CACHE_COLUMNS, PREDICTION_CACHE_SCHEMA
+
+####################################################################################################
+
+# SYFPEITHI pssm max values by allele model and peptide length, see --syfpeithi-max-scores
+SYFPEITHI_MAX_SCORES = {}
+
+# Prediction methods based on TensorFlow models, which are parallelized by TensorFlow itself
+NEURAL_METHODS = {"mhcflurry", "mhcnuggets-class-1", "mhcnuggets-class-2"}
+
+# Predictor of the PredictorPool worker processes (inherited from the main process)
+WORKER_PREDICTOR = None
 
 ####################################################################################################
 
@@ -53,6 +84,36 @@ def capture_stdout(target):
         sys.stdout = old
 
 
+class LogWarningCollector(logging.Handler):
+    """Collects the messages of logged warnings into a set, other records are passed on to the
+    specified handlers"""
+
+    def __init__(self, target, handlers):
+        super().__init__()
+        self.target = target
+        self.handlers = handlers
+
+    def emit(self, record):
+        if record.levelno == logging.WARNING:
+            self.target.add(record.getMessage())
+        else:
+            for handler in self.handlers:
+                handler.handle(record)
+
+
+@contextlib.contextmanager
+def capture_log_warnings(target):
+    """Captures the messages of warnings logged by the prediction methods (e.g. about unsupported
+    peptide lengths) into the specified set instead of logging them"""
+    root = logging.getLogger()
+    handlers = root.handlers
+    try:
+        root.handlers = [LogWarningCollector(target, handlers)]
+        yield
+    finally:
+        root.handlers = handlers
+
+
 def list_available_methods(out=sys.stdout):
     """Print a list of available epitope prediction methods"""
     print("The following methods and method versions are available:", file=out)
@@ -118,6 +179,37 @@ def parse_args():
         type=argparse.FileType("w"),
         default=sys.stdout,
     )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        help=(
+            "Prediction chunk files or directories containing prediction chunk files ('peptides_*.txt') to "
+            "predict with the same predictor. The alleles and allele ids are read from the chunk headers "
+            "(#name1,name2#id1,id2) and for each chunk the predictions ('<chunk>_predictions.tsv', long format) "
+            "and the prediction warnings ('<chunk>_pred_warnings.log') are written to the output directory. "
+            "Default: None."
+        ),
+        nargs="+",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "-od",
+        "--output-dir",
+        help="Output directory for the batch mode. Default: current directory.",
+        type=str,
+        default=".",
+    )
+    parser.add_argument(
+        "-pbs",
+        "--peptide-batch-size",
+        help=(
+            "Number of peptides that are read, predicted and written at once. Limits the memory usage "
+            "independently of the input file size. Default: 100000."
+        ),
+        type=int,
+        default=100000,
+    )
     parser.add_argument(
         "-m", "--method", help="Prediction method to use. Default: syfpeithi.", type=str, default="syfpeithi"
     )
@@ -128,9 +220,74 @@ def parse_args():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        "-ai",
+        "--allele-ids",
+        help=(
+            "Comma separated list of allele ids, one for each of the specified alleles. If given, the output is "
+            "written in long format with the columns 'peptide_id', 'prediction_score' and 'allele_id' "
+            "(requires peptide ids in the input). Default: None."
+        ),
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "-pc",
+        "--prediction-cache",
+        help=(
+            "Path to a SQLite prediction cache. The predicted scores are added to the cache, keyed by method, "
+            "method version, score normalization, allele and peptide sequence. The cache is created if it does not "
+            "exist. Default: None."
+        ),
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         "-sn", "--syfpeithi-norm", help="When using the SYFPEITHI method, normalize the scores", action="store_true"
     )
+    parser.add_argument(
+        "-sms",
+        "--syfpeithi-max-scores",
+        help=(
+            "Path to a tsv file with the maximum attainable SYFPEITHI score per allele model and peptide length "
+            "(columns 'allele_model', 'peptide_length' and 'max_score'), used for the score normalization. Allele "
+            "models missing from the table are read from epytope. Default: None."
+        ),
+        type=argparse.FileType("r"),
+        default=None,
+    )
+    parser.add_argument(
+        "-ns",
+        "--native-syfpeithi",
+        help=(
+            "When using the SYFPEITHI method, score the peptides with NumPy lookup tables built from the epytope "
+            "SYFPEITHI matrices instead of the epytope predictor. The scores are identical."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "-pbz",
+        "--predictor-batch-size",
+        help=(
+            "When using the MHCflurry method, the peptides are grouped by length and predicted in "
+            "length-homogeneous batches of this size with models that are loaded only once. Default: 4096 "
+            "(MHCflurry default)."
+        ),
+        type=int,
+        default=4096,
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help=(
+            "Number of threads to use for the prediction. For the TensorFlow based methods (MHCflurry, "
+            "MHCnuggets), this sets the number of TensorFlow intra-op and OpenMP threads, for the other methods "
+            "(including the native SYFPEITHI scorer) the peptides of each batch are scored in this number of "
+            "worker processes. Default: None (serial scoring, TensorFlow defaults)."
+        ),
+        type=int,
+        default=None,
+    )
     parser.add_argument(
         "-lm", "--list_methods", help="List available methods and versions and exit.", action="store_true"
     )
@@ -152,41 +309,129 @@ def parse_args():
     return parser.parse_args()
 
 
-def read_peptides(f):
-    """Reads the peptides from the provided file. The provided file can either be a plain text file
-    with one line per peptide or a plain text tsv file with two columns, `peptide_id` and
-    `peptide_sequence`."""
-    try:
-        peptides = pd.read_csv(f, sep="\t", header=None, comment="#")
-
-        # Guess whether this data comes with IDs
-        nrows, ncols = peptides.shape
-        if ncols == 1:
-            return None, [Peptide(x) for x in peptides.iloc[:, 0]]
-        else:
-            peptides.columns = peptides.iloc[0]
-            peptides = peptides.iloc[1:]
-            return list(peptides["peptide_id"]), [Peptide(x) for x in peptides["peptide_sequence"]]
-    except KeyError as e:
-        raise PeptidesParseException(
-            f"Missing column: {str(e)}. Please provide either a plain list or a table containing named columns"
-            " 'peptide_id' and 'peptide_sequence'."
-        )
-    except pd.errors.EmptyDataError:
+def read_peptides(f, batch_size):
+    """Reads the peptide sequences from the provided file and yields them in batches of at most
+    `batch_size` peptides as tuples of peptide ids (None if not provided), sequences and allele masks
+    (None if not provided). The provided file can either be a plain text file with one line per
+    peptide or a plain text tsv file with two named columns, `peptide_id` and `peptide_sequence`, and
+    optionally an `allele_mask` column (bit j is set if the peptide is to be predicted against the
+    j-th allele). Leading lines starting with '#' (e.g. the allele header of prediction chunks) are
+    skipped."""
+    line = f.readline()
+    while line.startswith("#") or (line and not line.strip()):
+        line = f.readline()
+    if not line:
         raise PeptidesParseException("The file appears to be empty.")
 
+    # Explicitly distinguish a named table from a plain list of peptides
+    fields = line.rstrip("\r\n").split("\t")
+    mask_column = None
+    if len(fields) == 1:
+        id_column, sequence_column = None, 0
+        lines = f if fields[0] == "peptide_sequence" else itertools.chain([line], f)
+    else:
+        missing = [column for column in ["peptide_id", "peptide_sequence"] if column not in fields]
+        if missing:
+            raise PeptidesParseException(
+                f"Missing column: '{missing[0]}'. Please provide either a plain list or a table containing named"
+                " columns 'peptide_id' and 'peptide_sequence'."
+            )
+        id_column, sequence_column = fields.index("peptide_id"), fields.index("peptide_sequence")
+        if "allele_mask" in fields:
+            mask_column = fields.index("allele_mask")
+        lines = f
+
+    first = True
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        rows = [line.rstrip("\r\n").split("\t") for line in batch if line.strip()]
+        # an empty first batch is yielded as well, so that the results header is written
+        if rows or first:
+            ids = [row[id_column] for row in rows] if id_column is not None else None
+            masks = (
+                np.array([int(row[mask_column]) for row in rows], dtype=np.uint64) if mask_column is not None else None
+            )
+            yield ids, [row[sequence_column] for row in rows], masks
+        first = False
+        if len(batch) < batch_size:
+            break
+
 
-def write_results(outfile, ids, peptides, predictions):
+def write_results(outfile, ids, peptides, predictions, alleles=None, allele_ids=None, header=True, masks=None):
     """Write the prediction results to the specified output file. If the input peptide sequences
-    were annotated with ids, the ids are written into the output table instead of the sequences."""
+    were annotated with ids, the ids are written into the output table instead of the sequences.
+    If allele ids are given, the results are written in long format with one row per peptide and allele,
+    restricted to the alleles of the peptide's allele mask if given.
+    The column names are only written if `header` is set, so that batches can be appended."""
     # Remove the index and rename the columns of the prediction results.
     predictions.rename({"Seq": "peptide_sequence", "Method": "method"}, axis=1, inplace=True)
     # Check if we have ids from the provided input data and write the results accordingly.
-    if ids:
-        id_map = pd.DataFrame({"peptide_id": ids, "peptide_sequence": peptides})
-        id_map.merge(predictions).drop("peptide_sequence", axis=1).to_csv(outfile, sep="\t", index=False, na_rep="NA")
+    if ids is not None and allele_ids:
+        results = predictions.set_index("peptide_sequence").reindex(peptides)
+        long_results = []
+        for j, (allele, allele_id) in enumerate(zip(alleles, allele_ids)):
+            allele_results = pd.DataFrame(
+                {"peptide_id": ids, "prediction_score": results[allele].to_numpy(), "allele_id": allele_id}
+            )
+            if masks is not None:
+                allele_results = allele_results[(masks >> np.uint64(j)) & np.uint64(1) == 1]
+            long_results.append(allele_results)
+        pd.concat(long_results).to_csv(outfile, sep="\t", index=False, na_rep="NA", header=header)
+    elif ids is not None:
+        results = predictions.set_index("peptide_sequence").reindex(peptides)
+        results.insert(0, "peptide_id", ids)
+        results.to_csv(outfile, sep="\t", index=False, na_rep="NA", header=header)
     else:
-        predictions.to_csv(outfile, sep="\t", index=False, na_rep="NA")
+        predictions.to_csv(outfile, sep="\t", index=False, na_rep="NA", header=header)
+
+
+def cache_predictions(path, method, method_version, normalized, allele_names, alleles, predictions):
+    """Adds the prediction scores to the SQLite prediction cache at the specified path"""
+    connection = sqlite3.connect(path, timeout=600)
+    try:
+        with connection:
+            connection.execute(PREDICTION_CACHE_SCHEMA)
+            for allele_name, allele in zip(allele_names, alleles):
+                connection.executemany(
+                    f"INSERT OR REPLACE INTO predictions ({PREDICTION_CACHE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        (
+                            method,
+                            method_version,
+                            normalized,
+                            allele_name,
+                            str(seq),
+                            None if pd.isna(score) else float(score),
+                        )
+                        for seq, score in zip(predictions["Seq"], predictions[allele])
+                    ),
+                )
+    finally:
+        connection.close()
+
+
+def predict(predictor, peptides, alleles):
+    """Runs the epytope predictor and returns a table with the columns 'Seq' and 'Method' and one score
+    column per allele. Raises a ValueError if no predictions could be made."""
+    # one score column per allele, aligned on the peptides
+    # (group without sorting, since alleles are not orderable)
+    predictions = pd.concat(
+        [
+            pred.set_index("Peptides")[["Method", 0]].rename(columns={0: allele})
+            for allele, pred in predictor.predict([Peptide(x) for x in peptides], alleles=alleles)
+            .unstack()
+            .reset_index()
+            .groupby("Allele", sort=False)[["Peptides", "Method", 0]]
+        ],
+        axis=1,
+    )
+    predictions = (
+        pd.concat([predictions.iloc[:, :1], predictions.drop(columns="Method")], axis=1)
+        .rename_axis("Seq")
+        .reset_index()
+    )
+    predictions["Seq"] = predictions["Seq"].astype(str)
+    return predictions
 
 
 def matrix_max(matrix):  # SYFPEITHI NORMALIZATION
@@ -194,8 +439,12 @@ def matrix_max(matrix):  # SYFPEITHI NORMALIZATION
     return sum([max(value.values()) for _, value in matrix.items()])
 
 
+@functools.lru_cache(maxsize=None)
 def get_allele_model_max_value(allele, length):  # SYFPEITHI NORMALIZATION
-    """Returns the SYFPEITHI pssm max value for a given allele"""
+    """Returns the SYFPEITHI pssm max value for a given allele, taken from the max score table if
+    available and computed from the pssm otherwise"""
+    if (allele, length) in SYFPEITHI_MAX_SCORES:
+        return SYFPEITHI_MAX_SCORES[(allele, length)]
     allele_model = "%s_%i" % (allele, length)
     try:
         return matrix_max(
@@ -208,75 +457,330 @@ def get_allele_model_max_value(allele, length):  # SYFPEITHI NORMALIZATION
         return None
 
 
+def read_syfpeithi_max_scores(f):  # SYFPEITHI NORMALIZATION
+    """Reads the table of SYFPEITHI pssm max values with the columns 'allele_model',
+    'peptide_length' and 'max_score'"""
+    table = pd.read_csv(f, sep="\t")
+    return {
+        (allele, int(length)): max_score
+        for allele, length, max_score in zip(table["allele_model"], table["peptide_length"], table["max_score"])
+    }
+
+
 def syfpeithi_normalize(predictions):  # SYFPEITHI NORMALIZATION
     """Normalizes syfpeithi prediction scores by dividing by the maximum
     attainable score for a particular allele model. This is needed as the
     score is dependent on the underlying model data and otherwise not
     comparable between alleles."""
-    predictor = EpitopePredictorFactory("syfpeithi")
     alleles = [cname for cname in predictions.columns if cname not in ["Seq", "Method"]]
-    conv_alleles = predictor.convert_alleles(alleles)
+    conv_alleles = Syfpeithi.convert_alleles(alleles)
 
-    lengths = predictions.Seq.apply(len)
+    lengths = predictions.Seq.str.len().to_numpy(dtype=np.int64)
+    unique_lengths = np.unique(lengths)
     for allele, conv_allele in zip(alleles, conv_alleles):
-        scored_lengths = {length for length, score in zip(lengths, predictions[allele]) if not pd.isna(score)}
-        max_vals = {length: get_allele_model_max_value(conv_allele, length) for length in scored_lengths}
-        new_scores = [
-            np.nan if pd.isna(score) or max_vals[length] is None else score / max_vals[length]
-            for score, length in zip(predictions[allele], lengths)
-        ]
-        predictions[allele] = new_scores
+        # max value lookup by peptide length, NaN for lengths without allele model
+        max_vals = np.full(unique_lengths.max(initial=0) + 1, np.nan)
+        for length in unique_lengths:
+            max_val = get_allele_model_max_value(conv_allele, int(length))
+            if max_val is not None:
+                max_vals[length] = max_val
+        predictions[allele] = predictions[allele].to_numpy(dtype=np.float64) / max_vals[lengths]
 
     return predictions
 
 
+class NativeSyfpeithiPredictor:
+    """Scores peptides with the SYFPEITHI matrices shipped with epytope without creating epytope
+    Peptide objects. Each allele model is loaded once and converted into a lookup table indexed by
+    position and residue byte, so that all peptides of one length are scored with one gather per
+    position. The position scores are summed in the same order as in epytope, hence the results
+    (including warnings and missing models) are identical to those of the epytope predictor."""
+
+    def __init__(self, predictor):
+        self.predictor = predictor
+        self.models = {}
+
+    @property
+    def name(self):
+        return self.predictor.name
+
+    @property
+    def version(self):
+        return self.predictor.version
+
+    def load_model(self, allele, length):
+        """Returns the lookup table of shape (length, 256) and the constant term of the allele
+        model for the given length, or None if there is no such model"""
+        key = (allele, length)
+        if key not in self.models:
+            allele_model = "%s_%i" % (allele, length)
+            try:
+                pssm = getattr(
+                    __import__("epytope.Data.pssms.syfpeithi" + ".mat." + allele_model, fromlist=[allele_model]),
+                    allele_model,
+                )
+            except ImportError:
+                self.models[key] = None
+            else:
+                table = np.zeros((length, 256), dtype=np.float64)
+                for position in range(length):
+                    for residue, score in pssm[position].items():
+                        table[position, ord(residue)] = score
+                self.models[key] = table, pssm.get(-1, {}).get("con", 0)
+        return self.models[key]
+
+    def predict(self, peptides, alleles):
+        """Returns a table with the columns 'Seq' and 'Method' and one score column per allele, analogous
+        to the unstacked epytope prediction result. Raises a ValueError if no predictions could be made."""
+        sequences = pd.unique(pd.Series(peptides, dtype=object))
+        lengths = pd.Series(sequences).str.len().to_numpy()
+        alleles_string = {conv_a: a for conv_a, a in zip(self.predictor.convert_alleles(alleles), alleles)}
+
+        scores = {}
+        for length in np.unique(lengths):
+            if length not in self.predictor.supportedLength:
+                warnings.warn("Peptide length of %i is not supported by %s" % (length, self.name))
+                continue
+            rows = np.flatnonzero(lengths == length)
+            residues = None
+            for conv_a, a in alleles_string.items():
+                model = self.load_model(conv_a, length)
+                if model is None:
+                    warnings.warn("No model found for %s with length %i" % (a, length))
+                    continue
+                if residues is None:
+                    # one byte per residue, residues not covered by the matrices score 0
+                    residues = np.frombuffer(
+                        "".join(sequences[rows]).encode("ascii", errors="replace"), dtype=np.uint8
+                    ).reshape(len(rows), length)
+                table, con = model
+                allele_scores = np.zeros(len(rows), dtype=np.float64)
+                for position in range(length):
+                    allele_scores += table[position, residues[:, position]]
+                # peptides of lengths without a model for this allele score 0, as in epytope
+                scores.setdefault(a, np.zeros(len(sequences), dtype=np.float64))[rows] = allele_scores + con
+
+        if not scores:
+            raise ValueError(
+                "No predictions could be made with "
+                + self.name
+                + " for given input. Check your epitope length and HLA allele combination."
+            )
+
+        return pd.DataFrame({"Seq": sequences, "Method": self.name, **scores})
+
+
+class MHCflurryBatchPredictor:
+    """Predicts binding scores with MHCflurry analogous to the epytope MHCflurry predictor, which
+    loads the models for each call and predicts the peptides one by one. Here, the models are
+    loaded once and the peptides are grouped by length and predicted in length-homogeneous
+    batches of the specified size, which makes efficient use of the neural network inference."""
+
+    def __init__(self, predictor, batch_size):
+        self.predictor = predictor
+        self.batch_size = batch_size
+        self.models = None
+
+    @property
+    def name(self):
+        return self.predictor.name
+
+    @property
+    def version(self):
+        return self.predictor.version
+
+    def load_models(self):
+        """Loads the MHCflurry models, downloading them first if they are not available"""
+        if self.models is None:
+            if subprocess.call(
+                ["mhcflurry-downloads", "path", "models_class1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            ):
+                logging.warning("mhcflurry models must be downloaded, as they were not found locally.")
+                if subprocess.call(["mhcflurry-downloads", "fetch", "models_class1"]):
+                    raise RuntimeError("mhcflurry failed to download model file")
+            self.models = Class1AffinityPredictor.load()
+        return self.models
+
+    def predict(self, peptides, alleles):
+        """Returns a table with the columns 'Seq' and 'Method' and one score column per supported allele,
+        analogous to the unstacked epytope prediction result. Raises a ValueError if no predictions could
+        be made."""
+        models = self.load_models()
+        sequences = pd.unique(pd.Series(peptides, dtype=object))
+        lengths = pd.Series(sequences, dtype=object).str.len().to_numpy()
+        alleles = [a for a in alleles if a in self.predictor.supportedAlleles]
+        supported_lengths = self.predictor.supportedLength
+
+        # peptides of unsupported lengths score 0, as in epytope
+        scores = {a: np.zeros(len(sequences), dtype=np.float64) for a in alleles}
+        predicted = False
+        for length in np.unique(lengths):
+            if length not in supported_lengths:
+                logging.warning(
+                    "Peptide length must be at least %i or at most %i for %s but is %i"
+                    % (min(supported_lengths), max(supported_lengths), self.name, length)
+                )
+                continue
+            rows = np.flatnonzero(lengths == length)
+            for a in alleles:
+                for start in range(0, len(rows), self.batch_size):
+                    batch = rows[start : start + self.batch_size]
+                    affinities = models.predict(
+                        peptides=list(sequences[batch]),
+                        allele=self.predictor._represent(a),
+                        model_kwargs={"batch_size": self.batch_size},
+                    )
+                    # convert ic50 to raw prediction score
+                    scores[a][batch] = [1 - math.log(affinity, 50000) for affinity in affinities]
+                    predicted = True
+
+        if not predicted:
+            raise ValueError(
+                "No predictions could be made with "
+                + self.name
+                + " for given input. Check your epitope length and HLA allele combination."
+            )
+
+        return pd.DataFrame({"Seq": sequences, "Method": self.name, **scores})
+
+
+def run_predictor(predictor, peptides, alleles):
+    """Runs one of the predictors of this script or an epytope predictor, returns a table with the columns
+    'Seq' and 'Method' and one score column per allele. Raises a ValueError if no predictions could be made."""
+    if isinstance(predictor, (NativeSyfpeithiPredictor, MHCflurryBatchPredictor, PredictorPool)):
+        return predictor.predict(peptides, alleles)
+    return predict(predictor, peptides, alleles)
+
+
+def predict_worker(peptides, alleles):
+    """Runs the predictor of a PredictorPool worker process, returns the predictions (None if
+    no predictions could be made), the prediction warnings and the logged warnings"""
+    logged_warnings = set()
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter("always")
+        try:
+            with capture_stdout(sys.stderr), capture_log_warnings(logged_warnings):
+                predictions = run_predictor(WORKER_PREDICTOR, peptides, alleles)
+        except ValueError:
+            predictions = None
+    return predictions, [str(w.message) for w in caught_warnings], sorted(logged_warnings)
+
+
+class PredictorPool:
+    """Scores the peptides with a predictor that does not parallelize itself (e.g. the native SYFPEITHI
+    scorer) in several worker processes. The peptides of each batch are split into one part per process
+    and the predictions of the parts are combined such that they are identical to those of the predictor."""
+
+    def __init__(self, predictor, processes):
+        global WORKER_PREDICTOR
+        WORKER_PREDICTOR = predictor
+        self.predictor = predictor
+        self.processes = processes
+        # (the worker processes inherit the predictor and load their models once)
+        self.pool = multiprocessing.get_context("fork").Pool(processes)
+
+    @property
+    def name(self):
+        return self.predictor.name
+
+    @property
+    def version(self):
+        return self.predictor.version
+
+    def close(self):
+        """Shuts down the worker processes"""
+        self.pool.close()
+        self.pool.join()
+
+    def predict(self, peptides, alleles):
+        """Returns a table with the columns 'Seq' and 'Method' and one score column per allele, analogous
+        to the unstacked epytope prediction result. Raises a ValueError if no predictions could be made."""
+        sequences = pd.unique(pd.Series(peptides, dtype=object))
+        parts = [list(part) for part in np.array_split(sequences, self.processes) if len(part)]
+        results = self.pool.starmap(predict_worker, [(part, alleles) for part in parts])
+
+        # Pass the warnings of the workers on to the caller
+        for message in dict.fromkeys(message for _, messages, _ in results for message in messages):
+            warnings.warn(message)
+        for message in dict.fromkeys(message for _, _, messages in results for message in messages):
+            logging.warning(message)
+
+        frames = [predictions for predictions, _, _ in results if predictions is not None]
+        if not frames:
+            raise ValueError(
+                "No predictions could be made with "
+                + self.name
+                + " for given input. Check your epitope length and HLA allele combination."
+            )
+
+        # Peptides of parts without a model for an allele score 0, as in a single prediction
+        predictions = pd.concat(frames).set_index("Seq").reindex(sequences)
+        predictions["Method"] = self.name
+        return predictions.fillna(0.0).rename_axis("Seq").reset_index()
+
+
 ####################################################################################################
 
-try:
-    # Parse command line arguments
-    args = parse_args()
 
-    # Validate specified method if requested
-    if args.validate_method:
-        validate_method(method=args.method, version=args.method_version)
+def list_chunk_files(paths):
+    """Returns the chunk files given as files or as directories containing 'peptides_*.txt' files"""
+    chunks = []
+    for path in paths:
+        if os.path.isdir(path):
+            chunks.extend(sorted(glob.glob(os.path.join(path, "peptides_*.txt"))))
+        else:
+            chunks.append(path)
+    return chunks
 
-    # Print methods if requested
-    if args.list_methods:
-        list_available_methods()
-        sys.exit(0)
 
+def read_chunk_header(path):
+    """Reads the allele names and ids from the header of a prediction chunk file (#name1,name2#id1,id2)"""
+    with open(path) as f:
+        header = f.readline().rstrip("\n")
+    if not header.startswith("#") or header.count("#") != 2:
+        raise PeptidesParseException(f"Missing allele header in chunk file '{path}'.")
+    allele_names, allele_ids = header[1:].split("#")
+    return allele_names.split(","), allele_ids.split(",")
+
+
+def predict_chunk(args, predictor, peptides_file, output, allele_names, allele_ids):
+    """Predicts the peptides of one input file for the specified alleles in batches of
+    --peptide-batch-size peptides and writes the results. Returns the prediction warnings."""
     # Parse allele names
-    alleles = [allele_from_string(allele) for allele in args.allele]
+    alleles = [allele_from_string(allele) for allele in allele_names]
+    if allele_ids and len(allele_ids) != len(alleles):
+        fail(f"The number of allele ids ({len(allele_ids)}) does not match the number of alleles ({len(alleles)}).", 2)
+
+    # Read, predict and write the peptides of the provided input file batch-wise
+    messages = set()
+    for batch, (ids, peptides, masks) in enumerate(read_peptides(peptides_file, args.peptide_batch_size)):
+        messages |= predict_batch(
+            args, predictor, ids, peptides, masks, output, allele_names, alleles, allele_ids, batch == 0
+        )
 
-    # Read peptides from provided input file
-    ids, peptides = read_peptides(args.peptides)
+    return messages
 
-    # Create predictor
-    predictor = get_predictor(method=args.method, version=args.method_version)
 
+def predict_batch(args, predictor, ids, peptides, masks, output, allele_names, alleles, allele_ids, header):
+    """Predicts one batch of peptides against all alleles in one call, adds the scores to the prediction
+    cache if requested and appends the (required) results to the output. Returns the prediction warnings."""
     # Run predictor
-    predictor_stdout = io.StringIO()
-    query_peptides_index = pd.DataFrame({"Seq": peptides}).Seq
-    with warnings.catch_warnings(record=True) as warnings:
+    logged_warnings = set()
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter("always")
         try:
             # Redirect stdout output of predictor code to stderr to use stdout
             # exclusively for the results table if writing to stdout was
             # specified by the user.
-            with capture_stdout(sys.stderr):
-                predictions = pd.concat(
-                    [
-                        pred[["Peptides", "Method", 0]].rename(columns={"Peptides": "Seq", 0: allele})
-                        for allele, pred in predictor.predict(peptides, alleles=alleles)
-                        .unstack()
-                        .reset_index()
-                        .groupby("Allele")[["Peptides", "Method", 0]]
-                    ]
-                )
+            with capture_stdout(sys.stderr), capture_log_warnings(logged_warnings):
+                predictions = run_predictor(predictor, peptides, alleles)
             predictions["Method"].fillna(args.method, inplace=True)
         except ValueError:
-            predictions = pd.DataFrame({"Seq": query_peptides_index, "Method": args.method})
-        for message in {w.message for w in warnings}:
-            logging.warning(f"PREDICTION ({predictor.name} {predictor.version}) - {str(message)}")
+            predictions = pd.DataFrame({"Seq": pd.unique(pd.Series(peptides, dtype=object)), "Method": args.method})
+    messages = logged_warnings | {
+        f"PREDICTION ({predictor.name} {predictor.version}) - {str(message)}"
+        for message in {w.message for w in caught_warnings}
+    }
 
     # Add missing alleles as NA values
     for missing_allele in [allele for allele in alleles if allele not in predictions.columns]:
@@ -286,8 +790,71 @@ try:
     if args.method == "syfpeithi" and args.syfpeithi_norm:
         predictions = syfpeithi_normalize(predictions)
 
+    # Add the scores to the prediction cache
+    if args.prediction_cache:
+        cache_predictions(
+            args.prediction_cache,
+            args.method,
+            args.method_version or predictor.version,
+            int(args.method == "syfpeithi" and args.syfpeithi_norm),
+            allele_names,
+            alleles,
+            predictions,
+        )
+
     # Write results
-    write_results(args.output, ids, peptides, predictions)
+    write_results(output, ids, peptides, predictions, alleles, allele_ids, header, masks)
+
+    return messages
+
+
+####################################################################################################
+
+try:
+    # Parse command line arguments
+    args = parse_args()
+
+    # Validate specified method if requested
+    if args.validate_method:
+        validate_method(method=args.method, version=args.method_version)
+
+    # Print methods if requested
+    if args.list_methods:
+        list_available_methods()
+        sys.exit(0)
+
+    # Read the table of SYFPEITHI max values for the normalization
+    if args.method == "syfpeithi" and args.syfpeithi_norm and args.syfpeithi_max_scores:
+        with args.syfpeithi_max_scores as f:
+            SYFPEITHI_MAX_SCORES.update(read_syfpeithi_max_scores(f))
+
+    # Create predictor
+    predictor = get_predictor(method=args.method, version=args.method_version)
+    if args.method == "syfpeithi" and args.native_syfpeithi:
+        predictor = NativeSyfpeithiPredictor(predictor)
+    elif args.method == "mhcflurry":
+        predictor = MHCflurryBatchPredictor(predictor, args.predictor_batch_size)
+    if args.threads and args.threads > 1 and args.method not in NEURAL_METHODS:
+        predictor = PredictorPool(predictor, args.threads)
+
+    if args.batch:
+        # Predict all chunk files with the same predictor, the alleles are taken from the chunk headers
+        for chunk in list_chunk_files(args.batch):
+            basename = os.path.splitext(os.path.basename(chunk))[0]
+            allele_names, allele_ids = read_chunk_header(chunk)
+            output_path = os.path.join(args.output_dir, basename + "_predictions.tsv")
+            with open(chunk) as peptides_file, open(output_path, "w") as output:
+                messages = predict_chunk(args, predictor, peptides_file, output, allele_names, allele_ids)
+            with open(os.path.join(args.output_dir, basename + "_pred_warnings.log"), "w") as warnings_file:
+                for message in sorted(messages):
+                    print(f"WARNING - {message}", file=warnings_file)
+    else:
+        allele_ids = args.allele_ids.split(",") if args.allele_ids else None
+        for message in predict_chunk(args, predictor, args.peptides, args.output, args.allele, allele_ids):
+            logging.warning(message)
+
+    if isinstance(predictor, PredictorPool):
+        predictor.close()
 
     sys.exit(0)
 except KeyboardInterrupt:
@@ -2,8 +2,11 @@
 
 import argparse
 import os
+import sqlite3
 import sys
+import tempfile
 
+import numpy as np
 import pandas as pd
 
 ####################################################################################################
@@ -24,6 +27,14 @@ def parse_args():
         type=str,
         required=True,
     )
+    parser.add_argument(
+        "-spo",
+        "--sorted-protein-peptide-occ",
+        help="Stream the protein peptide occurences chunk-wise alongside the peptides instead of loading them into memory at once. "
+        "Requires the peptides and the protein peptide occurences input files to be sorted by peptide_id (as written by generate_peptides.py).",
+        default=False,
+        action="store_true",
+    )
     parser.add_argument(
         "-epo",
         "--entities-proteins-occ",
@@ -43,6 +54,43 @@ def parse_args():
         "-cam", "--condition-allele-map", help="Path to the condition allele map input file", type=str, required=True
     )
     parser.add_argument("-a", "--alleles", help="Path to the allele input file", type=str, required=True)
+    parser.add_argument(
+        "-ct",
+        "--cost-table",
+        help="Path to a prediction cost table (method, peptide_length, relative_cost). If given, chunks are sized by the "
+        "estimated prediction cost of their peptides instead of their number and the maximum number of chunks is "
+        "distributed across the alleles proportionally to their workload.",
+        type=str,
+    )
+    parser.add_argument(
+        "-pm",
+        "--pred-method",
+        help="Prediction method used to look up the prediction costs in the cost table and the cached predictions. Default: syfpeithi",
+        type=str,
+        default="syfpeithi",
+    )
+    parser.add_argument(
+        "-pmv",
+        "--pred-method-version",
+        help="Prediction method version used to look up the cached predictions. Required with --prediction-cache.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "-pcc",
+        "--prediction-cache",
+        help="Path to a SQLite prediction cache populated by update_prediction_cache.py. Peptides whose scores are cached "
+        "for all their required alleles are not written into chunks, their cached scores are written into "
+        "'cached_predictions.tsv' in the output directory instead. Ignored if the cache does not exist yet.",
+        type=str,
+    )
+    parser.add_argument(
+        "-sn",
+        "--syfpeithi-norm",
+        help="Look up normalized SYFPEITHI scores in the prediction cache (see epytope_predict.py --syfpeithi-norm).",
+        default=False,
+        action="store_true",
+    )
 
     # OUTPUT FILES
     parser.add_argument("-o", "--outdir", help="Path to the output directory", type=str, required=True)
@@ -51,7 +99,8 @@ def parse_args():
     parser.add_argument(
         "-mc",
         "--max-chunk-size",
-        help="Maximum chunk size used for final output files. Default: 5000",
+        help="Maximum chunk size used for final output files. If a cost table is given, the chunk size is given in cost units "
+        "(a relative cost of 1 corresponds to one peptide). Default: 5000",
         type=int,
         default=5000,
     )
@@ -62,6 +111,24 @@ def parse_args():
         type=int,
         default=500000,
     )
+    parser.add_argument(
+        "-apc",
+        "--alleles-per-chunk",
+        help="Maximum number of alleles per chunk (at most 64). Alleles of the same condition are grouped and their "
+        "peptides are written into shared chunks, in which every peptide is to be predicted against all listed alleles. "
+        "Default: 1",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-dp",
+        "--deduplicate-peptides",
+        help="Write each peptide only once per group of alleles (see --alleles-per-chunk) into shared chunks, along with "
+        "a bitmask of its required alleles ('allele_mask', bit j for the j-th allele of the chunk). The peptide is then "
+        "scored against all alleles of the chunk in one call and only the required predictions are kept. Default: False",
+        default=False,
+        action="store_true",
+    )
     parser.add_argument(
         "-mlld",
         "--mem_log_level_deep",
@@ -80,41 +147,526 @@ def parse_args():
     return parser.parse_args()
 
 
-def write_chunks(data, alleles, max_task_per_allele, remainder=False, pbar=None):
-    """Takes data in form of a table of peptide_id, peptide_sequence and
-    identical allele_name values. The data is partitioned into chunks and
-    written into individual output files, prepended with a comment line (#)
-    indicating the allele name."""
-    global cur_chunk
+def read_table(path, columns=None):
+    """Reads a TSV file or, if the file name ends with '.parquet', a Parquet file.
+    If columns are given, only these columns are read."""
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns, sep="\t")
 
-    max_chunk_size = args.max_chunk_size
 
-    # Dynamically increase the chunk size dependent on the maximum number of allowed processes.
-    if len(data)/max_chunk_size > max_task_per_allele:
-        print("WARN: Chunk size is too small and too many chunks are generated. Chunksize is increased to match the maximum number of chunks.")
-        max_chunk_size = int(len(data)/max_task_per_allele)+1 # Make sure that all peptides end up in chunks
+def iter_table_chunks(path, chunksize, columns=None):
+    """Reads a TSV file or, if the file name ends with '.parquet', a Parquet file chunk-wise."""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
 
-    if remainder and len(data) > max_chunk_size:
-        print("ERROR: Something went wrong!", file=sys.stderr)
-        sys.exit(1)
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        with pd.read_csv(path, usecols=columns, sep="\t", chunksize=chunksize) as reader:
+            yield from reader
+
+
+class SortedOccurrenceStream:
+    """Reads protein peptide occurences sorted by peptide_id chunk-wise and returns them
+    block-wise for consecutive ranges of peptide ids, so that only about one chunk is held in memory."""
+
+    def __init__(self, path, chunksize):
+        self.chunks = iter_table_chunks(path, chunksize, columns=["protein_id", "peptide_id"])
+        self.buffer = None
+        self.last_peptide_id = -1
+        self.exhausted = False
+
+    def _read_chunk(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            return
+        if len(chunk) == 0:
+            return
+        if not chunk["peptide_id"].is_monotonic_increasing or chunk["peptide_id"].iloc[0] < self.last_peptide_id:
+            print("ERROR: The protein peptide occurences input file is not sorted by peptide_id.", file=sys.stderr)
+            sys.exit(1)
+        self.last_peptide_id = chunk["peptide_id"].iloc[-1]
+        self.buffer = chunk if self.buffer is None else pd.concat([self.buffer, chunk], ignore_index=True)
+
+    def take(self, max_peptide_id):
+        """Returns all remaining occurences with peptide_id <= max_peptide_id, indexed by peptide_id."""
+        while not self.exhausted and (self.buffer is None or self.buffer["peptide_id"].iloc[-1] <= max_peptide_id):
+            self._read_chunk()
+        if self.buffer is None:
+            return pd.DataFrame({"protein_id": pd.Series(dtype="uint32")}, index=pd.Index([], name="peptide_id"))
+        split = self.buffer["peptide_id"].searchsorted(max_peptide_id, side="right")
+        block = self.buffer.iloc[:split].set_index("peptide_id")
+        self.buffer = self.buffer.iloc[split:].reset_index(drop=True)
+        return block
+
+
+def build_protein_allele_masks(proteins_allele_info, allele_ids, num_proteins):
+    """Takes a table of protein_id, allele_id and returns an array of allele bitmasks
+    indexed by protein_id. Bit i of a mask (counting over consecutive 64 bit words)
+    is set if the allele allele_ids[i] is required for the protein."""
+    num_words = (len(allele_ids) - 1) // 64 + 1
+    protein_masks = np.zeros((num_proteins, num_words), dtype=np.uint64)
+    bits = pd.Series(np.arange(len(allele_ids)), index=allele_ids)[proteins_allele_info["allele_id"]].to_numpy()
+    np.bitwise_or.at(
+        protein_masks,
+        (proteins_allele_info["protein_id"].to_numpy(), bits // 64),
+        np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64)),
+    )
+    return protein_masks
+
+
+def group_alleles(allele_ids, condition_allele_map, alleles_per_chunk):
+    """Groups the alleles (given as positions in allele_ids) that are predicted together
+    in multi-allele chunks. Alleles of the same condition are grouped together, since
+    they share most of their peptides. Each allele is part of exactly one group."""
+    if alleles_per_chunk <= 1:
+        return [[bit] for bit in range(len(allele_ids))]
+
+    bits = {allele_id: bit for bit, allele_id in enumerate(allele_ids)}
+    groups = []
+    grouped = set()
+    for _, condition_alleles in condition_allele_map.sort_values(["condition_id", "allele_id"]).groupby("condition_id"):
+        remaining = [bits[allele_id] for allele_id in condition_alleles["allele_id"].unique()]
+        remaining = [bit for bit in remaining if bit not in grouped]
+        for start in range(0, len(remaining), alleles_per_chunk):
+            groups.append(remaining[start : start + alleles_per_chunk])
+        grouped.update(remaining)
+    groups.extend([bit] for bit in range(len(allele_ids)) if bit not in grouped)
+    return groups
+
+
+def resolve_required_alleles(
+    peptides, protein_peptide_occs, protein_masks, allele_ids, allele_groups, deduplicate_peptides=False
+):
+    """Takes the peptides (indexed by peptide_id) and their protein occurences
+    (protein_id indexed by peptide_id) and returns the required predictions as a
+    dict mapping a tuple of allele ids to a table of peptide_id, peptide_sequence
+    (ordered by peptide_id) that have to be predicted against all these alleles.
+    The required alleles of a peptide are the bitwise OR of the allele masks of
+    all proteins it occurs in. Within each allele group, peptides are assigned to
+    the tuple of exactly their required alleles of that group. If deduplicate_peptides
+    is set, all peptides of a group are assigned to the tuple of all alleles of the
+    group instead, with their required alleles of the group given as allele_mask."""
+    occs = protein_peptide_occs[protein_peptide_occs.index.isin(peptides.index)]
+    if not occs.index.is_monotonic_increasing:
+        occs = occs.sort_index(kind="stable")
+    peptide_ids = occs.index.to_numpy()
+
+    to_predict = {}
+    if len(peptide_ids) == 0:
+        return to_predict
+
+    # OR-reduce the allele masks of all proteins of a peptide
+    starts = np.flatnonzero(np.concatenate(([True], peptide_ids[1:] != peptide_ids[:-1])))
+    peptide_masks = np.bitwise_or.reduceat(protein_masks[occs["protein_id"].to_numpy()], starts, axis=0)
+    peptide_ids = peptide_ids[starts]
+    peptide_sequences = peptides["peptide_sequence"].reindex(peptide_ids).to_numpy()
+
+    for group in allele_groups:
+        # bit j of the group code is set if the j-th allele of the group is required
+        group_codes = np.zeros(len(peptide_ids), dtype=np.uint64)
+        for j, bit in enumerate(group):
+            required = (peptide_masks[:, bit // 64] >> np.uint64(bit % 64)) & np.uint64(1)
+            group_codes |= required << np.uint64(j)
+        if deduplicate_peptides:
+            selected = group_codes > 0
+            if selected.any():
+                to_predict[tuple(int(allele_ids[bit]) for bit in group)] = pd.DataFrame(
+                    {
+                        "peptide_id": peptide_ids[selected],
+                        "peptide_sequence": peptide_sequences[selected],
+                        "allele_mask": group_codes[selected],
+                    }
+                )
+            continue
+        for code in np.unique(group_codes[group_codes > 0]):
+            selected = group_codes == code
+            key = tuple(int(allele_ids[bit]) for j, bit in enumerate(group) if (int(code) >> j) & 1)
+            to_predict[key] = pd.DataFrame(
+                {"peptide_id": peptide_ids[selected], "peptide_sequence": peptide_sequences[selected]}
+            )
+    return to_predict
+
+
+def count_required_predictions(allele_tuple, data):
+    """Returns the number of required (peptide, allele) predictions of a table of the required predictions."""
+    if "allele_mask" in data:
+        masks = data["allele_mask"].to_numpy(dtype=np.uint64)
+        return int(sum(((masks >> np.uint64(j)) & np.uint64(1)).sum() for j in range(len(allele_tuple))))
+    return len(data) * len(allele_tuple)
+
+
+class PredictionCache:
+    """Looks up previously predicted scores in a SQLite prediction cache keyed by
+    method, method version, score normalization, allele and peptide sequence.
+    The cache is opened read-only, it is only updated by update_prediction_cache.py."""
+
+    def __init__(self, path, method, method_version, normalized, alleles):
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=600)
+        self.connection.execute("CREATE TEMP TABLE query (peptide_sequence TEXT PRIMARY KEY)")
+        self.method = method
+        self.method_version = method_version
+        self.normalized = int(normalized)
+        self.allele_names = dict(zip(alleles["allele_id"], alleles["allele_name"]))
+
+    def lookup(self, allele_id, peptide_sequences):
+        """Returns the cached scores of the given peptide sequences for an allele, indexed by peptide sequence."""
+        self.connection.execute("DELETE FROM temp.query")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO temp.query VALUES (?)", ((sequence,) for sequence in peptide_sequences)
+        )
+        rows = self.connection.execute(
+            "SELECT c.peptide_sequence, c.prediction_score FROM temp.query q JOIN predictions c "
+            "ON c.method = ? AND c.method_version = ? AND c.normalized = ? AND c.allele = ? "
+            "AND c.peptide_sequence = q.peptide_sequence",
+            (self.method, self.method_version, self.normalized, self.allele_names[allele_id]),
+        ).fetchall()
+        return pd.Series([score for _, score in rows], index=[sequence for sequence, _ in rows], dtype=float)
+
+    def split(self, to_predict):
+        """Takes the required predictions (see resolve_required_alleles) and removes all
+        peptides that are cached for all their required alleles of the allele tuple (all
+        alleles or, if given, the alleles of the allele_mask). Returns the remaining
+        predictions and a table of peptide_id, prediction_score, allele_id with the
+        cached scores of the removed peptides."""
+        remaining = {}
+        cached = []
+        for allele_tuple, data in to_predict.items():
+            scores = [self.lookup(allele_id, data["peptide_sequence"]) for allele_id in allele_tuple]
+            if "allele_mask" in data:
+                masks = data["allele_mask"].to_numpy(dtype=np.uint64)
+                required = [(masks >> np.uint64(j)) & np.uint64(1) == 1 for j in range(len(allele_tuple))]
+            else:
+                required = [np.ones(len(data), dtype=bool)] * len(allele_tuple)
+            is_cached = np.logical_and.reduce(
+                [~r | data["peptide_sequence"].isin(s.index).to_numpy() for r, s in zip(required, scores)]
+            )
+            for allele_id, allele_scores, r in zip(allele_tuple, scores, required):
+                selected = is_cached & r
+                cached.append(
+                    pd.DataFrame(
+                        {
+                            "peptide_id": data["peptide_id"][selected],
+                            "prediction_score": allele_scores.reindex(data["peptide_sequence"][selected]).to_numpy(),
+                            "allele_id": allele_id,
+                        }
+                    )
+                )
+            if not is_cached.all():
+                remaining[allele_tuple] = data[~is_cached].reset_index(drop=True)
+        if not cached:
+            return remaining, pd.DataFrame(columns=["peptide_id", "prediction_score", "allele_id"])
+        return remaining, pd.concat(cached, ignore_index=True)
+
+
+class PredictionCostModel:
+    """Estimates the relative cost of predicting peptides with a given method
+    from a calibration table of method, peptide_length, relative_cost.
+    Costs of peptide lengths that are not in the table are interpolated
+    between (or clamped to) the closest calibrated lengths."""
+
+    def __init__(self, path, method):
+        table = pd.read_csv(path, sep="\t", comment="#")
+        table = table[table["method"] == method].sort_values("peptide_length")
+        if len(table) == 0:
+            print(f"WARN: No prediction costs given for method {method}. Assuming uniform costs.")
+            table = pd.DataFrame({"peptide_length": [0], "relative_cost": [1.0]})
+        self.peptide_lengths = table["peptide_length"].to_numpy(dtype=float)
+        self.relative_costs = table["relative_cost"].to_numpy(dtype=float)
+
+    def weights(self, peptide_sequences):
+        """Returns the relative prediction cost of each peptide sequence."""
+        lengths = peptide_sequences.str.len().to_numpy(dtype=float)
+        return np.interp(lengths, self.peptide_lengths, self.relative_costs)
+
+
+def allocate_chunk_sizes(workloads, max_chunk_size, maximum_chunk_number):
+    """Takes the total prediction cost per allele group and distributes the maximum
+    number of chunks across them proportionally to their workload (at least one
+    chunk each). Returns the chunk size (in cost units) and the number of chunks per allele group.
+    The total number of chunks only exceeds the maximum number of chunks if there
+    are more allele groups than chunks, since each group needs its own chunk."""
+    total = sum(workloads.values())
+    budgets = {group: max(1, int(maximum_chunk_number * workload / total)) for group, workload in workloads.items()}
+    if len(budgets) > maximum_chunk_number:
+        print(
+            f"WARN: {len(budgets)} allele groups require at least one chunk each, exceeding the maximum number of {maximum_chunk_number} chunks."
+        )
+    # Rounding up to one chunk can exceed the maximum number of chunks, take the excess from the largest budgets
+    for _ in range(sum(budgets.values()) - maximum_chunk_number):
+        group = max(budgets, key=budgets.get)
+        if budgets[group] == 1:
+            break
+        budgets[group] -= 1
+    chunk_sizes = {}
+    for group, workload in workloads.items():
+        budget = budgets[group]
+        chunk_sizes[group] = max(max_chunk_size, workload / budget)
+        if chunk_sizes[group] > max_chunk_size:
+            print(
+                f"WARN: Chunk size for alleles {group} is increased to {chunk_sizes[group]:.1f} to match its share of {budget} chunks."
+            )
+    return chunk_sizes, budgets
+
+
+class ChunkWriter:
+    """Keeps one append-only buffer of peptide_id, peptide_sequence rows per tuple of alleles.
+    Full chunks are written into individual output files as soon as they are
+    available, prepended with a comment line (#) indicating the comma separated
+    allele names and ids (#name1,name2#id1,id2), along with the allele_mask column
+    if given. Only the remaining tail of each buffer is carried over.
+    Each tuple of alleles is a subset of one allele group, and the chunk size and the
+    maximum number of chunks apply per allele group across all of its tuples (see
+    _write_chunk). On close, the remaining peptides of several tuples of a group are
+    written together into chunks of all alleles of the group, with the required alleles
+    of each peptide given as allele_mask, so that a group with many tuples does not end
+    in one small chunk per tuple.
+    If a cost model is given, chunks are filled up to their chunk size in cost units
+    (cost per peptide and allele) instead of peptides. The chunk size per allele group
+    then depends on the total workload of all groups (see allocate_chunk_sizes), so the
+    peptides are spilled into one temporary file per tuple while the workload is
+    accumulated and only written into chunks on close, in a second pass over the spilled files."""
+
+    def __init__(
+        self,
+        outdir,
+        alleles,
+        allele_groups,
+        max_chunk_size,
+        max_task_per_group,
+        cost_model=None,
+        maximum_chunk_number=None,
+        proc_chunk_size=500000,
+    ):
+        self.outdir = outdir
+        self.allele_names = dict(zip(alleles["allele_id"], alleles["allele_name"]))
+        self.groups = {allele_id: group for group in allele_groups for allele_id in group}
+        self.max_chunk_size = max_chunk_size
+        self.max_task_per_group = max_task_per_group
+        self.cost_model = cost_model
+        self.maximum_chunk_number = maximum_chunk_number
+        self.proc_chunk_size = proc_chunk_size
+        self.chunk_sizes = None
+        self.budgets = None
+        self.chunk_files = {}
+        self.buffers = {}
+        self.buffered = {}
+        self.group_buffered = {}
+        self.num_chunks = 0
+        if cost_model:
+            self.spill_dir = tempfile.TemporaryDirectory(dir=outdir)
+            self.spill_paths = {}
+            self.workloads = {}
+
+    def add(self, to_predict):
+        """Takes a dict of allele id tuples to tables of peptide_id, peptide_sequence and writes out all full chunks."""
+        for alleles in sorted(to_predict):
+            data = to_predict[alleles]
+            if self.cost_model:
+                self._spill(alleles, data)
+                continue
+            self._buffer(alleles, data)
+            self._flush(alleles)
+
+    def close(self):
+        """Writes out the remaining peptides of all allele tuples."""
+        if self.cost_model:
+            self.chunk_sizes, self.budgets = allocate_chunk_sizes(
+                self.workloads, self.max_chunk_size, self.maximum_chunk_number
+            )
+            for alleles in sorted(self.spill_paths):
+                dtypes = {"peptide_sequence": str, "allele_mask": np.uint64}
+                with pd.read_csv(
+                    self.spill_paths[alleles], sep="\t", dtype=dtypes, chunksize=self.proc_chunk_size
+                ) as reader:
+                    for data in reader:
+                        self._buffer(alleles, data)
+                        self._flush(alleles)
+            self.spill_dir.cleanup()
+        for group in sorted(set(self.groups.values())):
+            remaining = [alleles for alleles in sorted(self.buffers) if self.groups[alleles[0]] == group]
+            remaining = [alleles for alleles in remaining if sum(len(data) for data in self.buffers[alleles])]
+            if len(remaining) > 1:
+                self._merge_group(group, remaining)
+                remaining = [group]
+            for alleles in remaining:
+                self._flush(alleles, remainder=True)
+
+    def _spill(self, alleles, data):
+        workload = self.cost_model.weights(data["peptide_sequence"]).sum() * len(alleles)
+        group = self.groups[alleles[0]]
+        self.workloads[group] = self.workloads.get(group, 0.0) + workload
+        if alleles not in self.spill_paths:
+            self.spill_paths[alleles] = os.path.join(self.spill_dir.name, "_".join(map(str, alleles)) + ".tsv")
+            data.to_csv(self.spill_paths[alleles], sep="\t", index=False)
+        else:
+            data.to_csv(self.spill_paths[alleles], sep="\t", index=False, header=False, mode="a")
+
+    def _buffer(self, alleles, data):
+        data = data.assign(
+            weight=self.cost_model.weights(data["peptide_sequence"]) * len(alleles) if self.cost_model else 1.0
+        )
+        self.buffers.setdefault(alleles, []).append(data)
+        weight = data["weight"].sum()
+        self.buffered[alleles] = self.buffered.get(alleles, 0) + weight
+        group = self.groups[alleles[0]]
+        self.group_buffered[group] = self.group_buffered.get(group, 0) + weight
+
+    def _merge_group(self, group, tuples):
+        """Replaces the buffers of the given tuples of alleles of a group by one buffer of all alleles of the
+        group, in which the required alleles of each peptide are given as allele_mask (bit j for the j-th allele
+        of the group). A peptide is part of only one tuple of a group, so the peptide ids stay unique."""
+        merged = []
+        for alleles in tuples:
+            merged.append(self._group_masked(alleles, pd.concat(self.buffers.pop(alleles), ignore_index=True)))
+            self.buffered.pop(alleles)
+        data = pd.concat(merged, ignore_index=True).sort_values("peptide_id", kind="stable", ignore_index=True)
+        self.buffers[group] = [data]
+        self.buffered[group] = data["weight"].sum()
+
+    def _flush(self, alleles, remainder=False):
+        buffered = self.buffered[alleles]
+        group = self.groups[alleles[0]]
+
+        if self.chunk_sizes is not None:
+            max_chunk_size = self.chunk_sizes[group]
+        else:
+            max_chunk_size = self.max_chunk_size
+
+            # Dynamically increase the chunk size dependent on the maximum number of allowed processes of the group
+            if self.group_buffered[group] / max_chunk_size > self.max_task_per_group:
+                print("WARN: Chunk size is too small and too many chunks are generated. Chunksize is increased to match the maximum number of chunks.")
+                max_chunk_size = int(self.group_buffered[group] / self.max_task_per_group) + 1  # Make sure that all peptides end up in chunks
+
+        if not remainder and buffered < max_chunk_size:
+            return
+        data = pd.concat(self.buffers[alleles], ignore_index=True)
+
+        # a chunk is full as soon as its cumulative weight reaches the chunk size
+        # (the remainder can exceed the chunk size if the chunk size was increased before, it is then written
+        # into full chunks as well)
+        cumulative_weights = data["weight"].cumsum().to_numpy()
+        start, written_weight = 0, 0.0
+        while True:
+            end = np.searchsorted(cumulative_weights, written_weight + max_chunk_size, side="left") + 1
+            if end > len(data):
+                break
+            self._write_chunk(alleles, data.iloc[start:end])
+            start, written_weight = end, cumulative_weights[end - 1]
 
-    allele_name = alleles[alleles["allele_id"] == data.iloc[0].allele_id]["allele_name"].iloc[0]
-    written = pd.Index([])
-    for start in range(0, len(data), max_chunk_size):
         # if not handling remainder: only write out full chunks here
-        if remainder or len(data) - start >= max_chunk_size:
-            with open(os.path.join(args.outdir, "peptides_" + str(cur_chunk).rjust(5, "0") + ".txt"), "w") as outfile:
-                print(f"#{allele_name}#{data.iloc[0].allele_id}", file=outfile)
-                write = data.iloc[start : start + max_chunk_size]
-                written = written.append(data.index[start : start + max_chunk_size])
-                if pbar:
-                    pbar.update(len(write))
-                write[["peptide_id", "peptide_sequence"]].to_csv(outfile, sep="\t", index=False)
-                cur_chunk = cur_chunk + 1
-
-    # delete chunks that were written out already
-    data.drop(written, inplace=True)
-    return data
+        if remainder and start < len(data):
+            self._write_chunk(alleles, data.iloc[start:])
+            start, written_weight = len(data), cumulative_weights[-1]
+
+        # carry over only the peptides that were not written out yet
+        self.buffers[alleles] = [data.iloc[start:]]
+        self.buffered[alleles] = buffered - written_weight if start < len(data) else 0.0
+        self.group_buffered[group] -= buffered - self.buffered[alleles]
+
+    def _group_masked(self, alleles, data):
+        """Returns the peptides of a tuple of alleles with their required alleles of the group as allele_mask."""
+        if "allele_mask" in data:
+            return data
+        group = self.groups[alleles[0]]
+        mask = sum(1 << group.index(allele_id) for allele_id in alleles)
+        return data.assign(allele_mask=np.uint64(mask))[["peptide_id", "peptide_sequence", "allele_mask", "weight"]]
+
+    def _write_chunk(self, alleles, data):
+        """Writes the peptides of a tuple of alleles into a new chunk file, as long as the allele group has chunks
+        left. The last chunk of a group is a chunk of all alleles of the group (with allele_mask). Once the group
+        has no chunks left, the peptides are appended to the smallest chunk file of the group, which is converted
+        into a chunk of all alleles of the group first if it belongs to another tuple. Hence, the number of chunks
+        of a group never exceeds its maximum number of chunks."""
+        group = self.groups[alleles[0]]
+        key = (alleles, "allele_mask" in data)
+        budget = self.budgets[group] if self.budgets is not None else self.max_task_per_group
+        chunk_files = self.chunk_files.setdefault(group, [])
+        if len(chunk_files) < budget - 1:
+            self._new_chunk_file(key, data)
+            return
+        if len(chunk_files) < budget:
+            if len(group) > 1:
+                key, data = (group, True), self._group_masked(alleles, data)
+            self._new_chunk_file(key, data)
+            return
+        chunk_file = min(chunk_files, key=lambda chunk_file: chunk_file["weight"])
+        if chunk_file["key"] != key:
+            self._group_mask_chunk_file(chunk_file)
+            data = self._group_masked(alleles, data)
+        with open(chunk_file["path"], "a") as outfile:
+            data.drop(columns="weight").to_csv(outfile, sep="\t", index=False, header=False)
+        chunk_file["weight"] += data["weight"].sum()
+
+    def _new_chunk_file(self, key, data):
+        path = os.path.join(self.outdir, "peptides_" + str(self.num_chunks).rjust(5, "0") + ".txt")
+        self._write_chunk_file(path, key[0], data)
+        group = self.groups[key[0][0]]
+        self.chunk_files[group].append({"key": key, "path": path, "weight": data["weight"].sum()})
+        self.num_chunks += 1
+
+    def _group_mask_chunk_file(self, chunk_file):
+        """Rewrites a chunk file of a tuple of alleles as chunk of all alleles of its group (with allele_mask)."""
+        alleles = chunk_file["key"][0]
+        group = self.groups[alleles[0]]
+        if chunk_file["key"] == (group, True):
+            return
+        data = pd.read_csv(chunk_file["path"], sep="\t", skiprows=1, dtype={"peptide_sequence": str})
+        self._write_chunk_file(chunk_file["path"], group, self._group_masked(alleles, data.assign(weight=0.0)))
+        chunk_file["key"] = (group, True)
+
+    def _write_chunk_file(self, path, alleles, data):
+        with open(path, "w") as outfile:
+            allele_names = ",".join(self.allele_names[allele_id] for allele_id in alleles)
+            print(f"#{allele_names}#{','.join(map(str, alleles))}", file=outfile)
+            data.drop(columns="weight").to_csv(outfile, sep="\t", index=False)
+
+
+def iter_required_predictions(
+    protein_peptide_occs, protein_masks, allele_ids, allele_groups, cache=None, print_mem=None
+):
+    """Processes the peptides chunk-wise and yields the required predictions
+    per chunk (see resolve_required_alleles) that are not cached yet,
+    together with the cached predictions (see PredictionCache.split)."""
+    if args.sorted_protein_peptide_occ:
+        # stream the occurences alongside the peptides (merge-join on peptide_id)
+        occurrence_stream = SortedOccurrenceStream(args.protein_peptide_occ, args.proc_chunk_size)
+    last_peptide_id = -1
+
+    # (peptides and protein_peptide_occs can be given as TSV or Parquet files)
+    for c, peptides in enumerate(iter_table_chunks(args.peptides, args.proc_chunk_size)):
+        peptides = peptides.set_index("peptide_id")
+        print("\nChunk: ", c)
+        print("Info: peptides", flush=True)
+        peptides.info(verbose=False, memory_usage=print_mem)
+
+        if args.sorted_protein_peptide_occ:
+            if len(peptides) == 0:
+                continue
+            if not peptides.index.is_monotonic_increasing or peptides.index[0] < last_peptide_id:
+                print("ERROR: The peptides input file is not sorted by peptide_id.", file=sys.stderr)
+                sys.exit(1)
+            last_peptide_id = peptides.index[-1]
+            chunk_protein_peptide_occs = occurrence_stream.take(last_peptide_id)
+        else:
+            chunk_protein_peptide_occs = protein_peptide_occs
+
+        # Identify which predictions have to be computed: resolve the required alleles of each peptide
+        to_predict = resolve_required_alleles(
+            peptides,
+            chunk_protein_peptide_occs,
+            protein_masks,
+            allele_ids,
+            allele_groups,
+            args.deduplicate_peptides,
+        )
+        # -> (allele_id, ...) -> peptide_id, peptide_sequence
+
+        # Skip the predictions that are already cached
+        yield cache.split(to_predict) if cache else (to_predict, None)
+
 
 ####################################################################################################
 
@@ -126,18 +678,20 @@ try:
     # NOTE try out if datatable package can be used and would be faster or more memory efficient
     # downcast df columns that will not be used as indices to save mem usage
     # (skip index columns to avoid upcasting with set_index() and increased runtime)
-    protein_peptide_occs = (
-        pd.read_csv(args.protein_peptide_occ, usecols=["protein_id", "peptide_id"], sep="\t")
-        .set_index("peptide_id")
-        .sort_index()
-    )  # NOTE could this be handled more efficiently somehow (easily)?
+    if args.sorted_protein_peptide_occ:
+        # the occurences are streamed alongside the peptides
+        protein_peptide_occs = None
+    else:
+        protein_peptide_occs = (
+            read_table(args.protein_peptide_occ, columns=["protein_id", "peptide_id"])
+            .set_index("peptide_id")
+            .sort_index()
+        )  # NOTE could this be handled more efficiently somehow (easily)?
 
-    entities_proteins_occs = pd.read_csv(args.entities_proteins_occ, sep="\t")
+    entities_proteins_occs = read_table(args.entities_proteins_occ)
     entities_proteins_occs["entity_id"] = pd.to_numeric(entities_proteins_occs["entity_id"], downcast="unsigned")
 
-    microbiomes_entities_occs = pd.read_csv(
-        args.microbiomes_entities_occ, usecols=["microbiome_id", "entity_id"], sep="\t"
-    )
+    microbiomes_entities_occs = read_table(args.microbiomes_entities_occ, columns=["microbiome_id", "entity_id"])
     microbiomes_entities_occs["microbiome_id"] = pd.to_numeric(
         microbiomes_entities_occs["microbiome_id"], downcast="unsigned"
     )
@@ -161,8 +715,9 @@ try:
         print_mem = "deep"
     else:
         print_mem = None
-    print("\nInfo: protein_peptide_occs", flush=True)
-    protein_peptide_occs.info(verbose=False, memory_usage=print_mem)
+    if protein_peptide_occs is not None:
+        print("\nInfo: protein_peptide_occs", flush=True)
+        protein_peptide_occs.info(verbose=False, memory_usage=print_mem)
     print("\nInfo: entities_proteins_occs", flush=True)
     entities_proteins_occs.info(verbose=False, memory_usage=print_mem)
     print("\nInfo: microbiomes_entities_occs", flush=True)
@@ -176,7 +731,7 @@ try:
         os.makedirs(args.outdir)
 
     print("\nJoining protein ids with allele info...", flush=True)
-    # Prepare df with allele info for proteins for downstream merging against all peptides
+    # Prepare allele bitmasks for proteins for downstream resolving of the required alleles of all peptides
     proteins_allele_info = (
         entities_proteins_occs.merge(microbiomes_entities_occs)
         .drop(columns="entity_id")
@@ -185,65 +740,98 @@ try:
         .merge(condition_allele_map)
         .drop(columns="condition_id")
         .drop_duplicates()
-        .set_index("protein_id")
-        .sort_index()
     )
     # -> protein_id, allele_id
 
     print("\nInfo: proteins_allele_info", flush=True)
     proteins_allele_info.info(verbose=False, memory_usage=print_mem)
 
-    cur_chunk = 0
+    allele_ids = alleles["allele_id"].sort_values().to_numpy()
+    protein_masks = build_protein_allele_masks(
+        proteins_allele_info, allele_ids, entities_proteins_occs["protein_id"].max() + 1
+    )
+    del proteins_allele_info
+    # -> protein_id -> allele bitmask
+
     requests = 0
-    keep = pd.DataFrame()
-
-    # Define how many chunks may be created per allele
-    max_task_per_allele = int(args.maximum_chunk_number/len(alleles["allele_id"])) # cut instead of round to ensure being lower than maximum
-
-    # Process peptides chunk-wise, write out into files with max_chunk_size or keep for next chunk if remaining requests, i.e. < max_chunk_size for one allele
-    with pd.read_csv(args.peptides, sep="\t", index_col="peptide_id", chunksize=args.proc_chunk_size) as reader:
-        for c, peptides in enumerate(reader):
-            print("\nChunk: ", c)
-            print("Info: peptides", flush=True)
-            peptides.info(verbose=False, memory_usage=print_mem)
-
-            # Identify which predictions have to be computed: join peptides with allele info
-            to_predict = (
-                peptides.sort_index()
-                .join(protein_peptide_occs)
-                .reset_index()
-                .set_index("protein_id")
-                .sort_index()
-                .join(proteins_allele_info)
-                .drop_duplicates()
-                .reset_index(drop=True)
-            )
-            # -> index, peptide_id, peptide_sequence, allele_id
+    cached_requests = 0
 
-            # TODO peptides can be deleted?
+    if args.prediction_cache and not os.path.isdir(os.path.dirname(os.path.abspath(args.prediction_cache))):
+        # (the pipeline creates the cache directory, so it is missing if it is not accessible, e.g. not mounted)
+        print(f"ERROR: The directory of the prediction cache {args.prediction_cache} does not exist.", file=sys.stderr)
+        sys.exit(2)
+    elif args.prediction_cache and not os.path.exists(args.prediction_cache):
+        print(f"Info: The prediction cache {args.prediction_cache} does not exist yet.")
+        cache = None
+    elif args.prediction_cache:
+        if not args.pred_method_version:
+            print("ERROR: --pred-method-version is required with --prediction-cache.", file=sys.stderr)
+            sys.exit(2)
+        normalized = args.pred_method == "syfpeithi" and args.syfpeithi_norm
+        cache = PredictionCache(args.prediction_cache, args.pred_method, args.pred_method_version, normalized, alleles)
+        cached_predictions = open(os.path.join(args.outdir, "cached_predictions.tsv"), "w")
+        print("peptide_id\tprediction_score\tallele_id", file=cached_predictions)
+    else:
+        cache = None
 
-            print("Info: to_predict", flush=True)
-            to_predict.info(verbose=False, memory_usage=print_mem)
+    # Group alleles that are predicted together in multi-allele chunks
+    # (the required alleles of a peptide within its group are encoded as 64 bit mask)
+    if args.alleles_per_chunk > 64:
+        print("ERROR: --alleles-per-chunk must not exceed 64.", file=sys.stderr)
+        sys.exit(2)
+    allele_groups = group_alleles(allele_ids, condition_allele_map, args.alleles_per_chunk)
+    allele_id_groups = [tuple(int(allele_ids[bit]) for bit in group) for group in allele_groups]
+
+    # Define how many chunks may be created per allele group (across all tuples of alleles of the group)
+    max_task_per_group = max(1, int(args.maximum_chunk_number/len(allele_groups))) # cut instead of round to ensure being lower than maximum
+    if args.cost_table:
+        # The workload per allele group is accumulated while processing the peptides, which are spilled to temporary
+        # files meanwhile; the chunks are distributed accordingly and written in a second pass over the spilled
+        # files once all peptides are processed (the input tables and the prediction cache are still read once)
+        cost_model = PredictionCostModel(args.cost_table, args.pred_method)
+        chunk_writer = ChunkWriter(
+            args.outdir,
+            alleles,
+            allele_id_groups,
+            args.max_chunk_size,
+            max_task_per_group,
+            cost_model,
+            args.maximum_chunk_number,
+            args.proc_chunk_size,
+        )
+    else:
+        chunk_writer = ChunkWriter(args.outdir, alleles, allele_id_groups, args.max_chunk_size, max_task_per_group)
 
-            requests += len(to_predict)
+    # Process peptides chunk-wise, write out into files with max_chunk_size or keep for next chunk if remaining requests, i.e. < max_chunk_size for one allele tuple
+    for to_predict, cached in iter_required_predictions(
+        protein_peptide_occs, protein_masks, allele_ids, allele_groups, cache, print_mem
+    ):
+        # TODO peptides can be deleted?
 
-            # Concat remaining peptides from previous round with newly processed ones
-            # write the required predictions into chunks of peptide lists
-            keep = (
-                pd.concat([keep, to_predict], ignore_index=True)
-                .groupby("allele_id", group_keys=False)
-                .apply(lambda x: write_chunks(x, alleles, max_task_per_allele))
-            )
-            # use group_keys=False to avoid generation of extra index with "allele_id"
+        if cached is not None:
+            print(f"Info: cached: {len(cached)} peptide prediction requests", flush=True)
+            cached.to_csv(cached_predictions, sep="\t", index=False, header=False, na_rep="NA")
+            cached_requests += len(cached)
+
+        chunk_requests = sum(
+            count_required_predictions(allele_tuple, data) for allele_tuple, data in to_predict.items()
+        )
+        print(f"Info: to_predict: {chunk_requests} peptide prediction requests for {len(to_predict)} allele tuples", flush=True)
+
+        requests += chunk_requests
 
-            print("Info: keep", flush=True)
-            keep.info(verbose=False, memory_usage=print_mem)
+        # Write the required predictions into chunks of peptide lists,
+        # remaining peptides (< max_chunk_size for one allele tuple) are kept for the next chunk
+        chunk_writer.add(to_predict)
 
     # Write out remaining peptides
-    keep.groupby("allele_id", group_keys=False).apply(lambda x: write_chunks(x, alleles, max_task_per_allele, remainder=True))
+    chunk_writer.close()
+    if cache:
+        cached_predictions.close()
+        print(f"Found {cached_requests} peptide prediction requests in the prediction cache.")
 
     # We're happy if we got here
-    print(f"All done. Written {requests} peptide prediction requests into {cur_chunk} chunks.")
+    print(f"All done. Written {requests} peptide prediction requests into {chunk_writer.num_chunks} chunks.")
     sys.exit(0)
 except KeyboardInterrupt:
     print("\nUser aborted.", file=sys.stderr)
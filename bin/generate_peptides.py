@@ -1,10 +1,59 @@
 #!/usr/bin/env python3
 
 import argparse
-import gzip
+import os
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from metapep_utils import TableWriter
+
+# valid amino acid codes:
+# 20 standard ('A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y')
+# and extended codes ('B', 'J', 'O', 'U', 'X', 'Z')
+# (the order of this list determines the order of the peptide_id assignment)
+AA_LIST = [
+    "A",
+    "C",
+    "D",
+    "E",
+    "F",
+    "G",
+    "H",
+    "I",
+    "K",
+    "L",
+    "M",
+    "N",
+    "P",
+    "Q",
+    "R",
+    "S",
+    "T",
+    "V",
+    "W",
+    "Y",
+    "B",
+    "J",
+    "O",
+    "U",
+    "X",
+    "Z",
+]
+
+# Fixed column types of the output tables (used for Parquet output)
+PEPTIDES_DTYPES = {"peptide_sequence": "str", "peptide_id": "uint64"}
+PROTEINS_PEPTIDES_DTYPES = {"protein_id": "uint32", "peptide_id": "uint64", "count": "uint32"}
+
+# Maximum peptide length that can be packed into a single uint64 key (26^13 < 2^64 < 26^14)
+MAX_PACKED_PEPTIDE_LENGTH = 13
+
+# Number of proteins whose sequences are joined at once when encoding the protein sequences
+ENCODE_BATCH_SIZE = 10000
 
 
 def parse_args(args=None):
@@ -19,12 +68,12 @@ def parse_args(args=None):
     parser.add_argument(
         "-p", "--peptides", required=True, metavar="FILE", help="Output file containing: peptide_id, peptide_sequence."
     )  # use str type to allow compression of output
+    # (output files with the extension '.parquet' are written as Parquet files instead of TSV files)
     parser.add_argument(
         "-pp",
         "--proteins_peptides",
         required=True,
         metavar="FILE",
-        type=argparse.FileType("w"),
         help="Output file containing: protein_id, peptide_id, count.",
     )
     parser.add_argument(
@@ -46,6 +95,43 @@ def parse_args(args=None):
     parser.add_argument(
         "-pll", "--peptide_lengths", required=True, metavar="LIST", nargs="*", help="Peptide lengths as list."
     )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        help=(
+            "Peptide generation engine. 'prefix': scan all protein sequences once per peptide length and initial amino acid. "
+            "'partitioned': scan all protein sequences once and bucket the peptides into on-disk partitions "
+            "(one per peptide length and initial amino acid). "
+            "'numpy': encode protein sequences as integer arrays and pack each peptide into a uint64 key "
+            f"(supports peptide lengths <= {MAX_PACKED_PEPTIDE_LENGTH}). All engines produce identical outputs. Default: prefix"
+        ),
+        choices=["prefix", "partitioned", "numpy"],
+        default="prefix",
+    )
+    parser.add_argument(
+        "-pbs",
+        "--partition_buffer_size",
+        help="Number of peptides kept in memory before flushing them to the on-disk partitions (engine 'partitioned'). Default: 5000000",
+        type=int,
+        default=5000000,
+    )
+    parser.add_argument(
+        "-t",
+        "--tmp_dir",
+        metavar="DIR",
+        help="Directory in which the temporary partitions or sorted runs are created (engines 'partitioned' and 'numpy'). Default: current directory",
+        default=".",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help=(
+            "Number of worker processes (engine 'numpy'). The proteins are sharded into contiguous protein_id ranges, "
+            "which are processed in parallel. Default: 1"
+        ),
+        type=int,
+        default=1,
+    )
     return parser.parse_args(args)
 
 
@@ -61,6 +147,325 @@ def gen_peptides(prot_seq, k, prefix):
     return [prot_seq[i : (i + k)] for i in range(len(prot_seq) - k + 1) if prot_seq[i] == prefix]
 
 
+def write_peptides(results, k, id_counter, peptides_writer, proteins_peptides_writer, print_mem):
+    """Takes a table of protein_id, peptide_sequence (one row per peptide occurrence) for
+    peptide length k and one initial amino acid, assigns peptide_ids starting from id_counter
+    and writes out the peptides and protein peptide occurrences. Returns the next free peptide_id."""
+    print("\nInfo: results (['protein_id','peptide_sequence'])", flush=True)
+    results.info(verbose=False, memory_usage=print_mem)
+
+    print("format results ...", flush=True)
+    # count occurrences of one peptide in one protein
+    results = results.groupby(["protein_id", "peptide_sequence"]).size().reset_index(name="count")
+    # -> protein_id, peptide_sequence, count
+    results["count"] = pd.to_numeric(results["count"], downcast="unsigned")
+    # prepare df for joining (stable sort keeps the occurrences of a peptide ordered by protein_id)
+    results.set_index("peptide_sequence", inplace=True)
+    results.sort_index(inplace=True, kind="stable")
+
+    unique_peptides = pd.DataFrame(index=results.index.drop_duplicates())
+    unique_peptides["peptide_id"] = range(id_counter, id_counter + len(unique_peptides))
+    id_counter += len(unique_peptides)
+    # -> peptide_sequence, peptide_id
+    peptides_writer.write(unique_peptides.reset_index())
+
+    results = results.join(unique_peptides)
+    # -> protein_id, peptide_sequence, count, peptide_id
+
+    print("\nInfo: results (['protein_id','peptide_sequence','peptide_id','count'])", flush=True)
+    results.info(verbose=False, memory_usage=print_mem)
+
+    proteins_peptides_writer.write(results[["protein_id", "peptide_id", "count"]])
+
+    print("# peptides of length ", k, ", (non-unique across proteins): ", len(results))
+    return id_counter
+
+
+def generate_prefix(protid_protseq_protlen, peptide_lengths, peptides_writer, proteins_peptides_writer, print_mem):
+    """Generates the peptides by scanning all protein sequences once per peptide length and initial amino acid."""
+    id_counter = 0
+
+    # for each k
+    for k in peptide_lengths:
+        print("Generate peptides of length ", k, " ...", flush=True)
+
+        # Note: could be done with prefixes instead of single first letters if this remains bottleneck
+        for prefix in AA_LIST:
+            print("with prefix ", prefix, flush=True)
+            # for each protein generate all peptides of length k with current prefix (to reduce peak mem usage)
+            # (the AA-wise processing causes multiple iterations over the same protein sequences,
+            # but the increase of run time is negligible in this context)
+            results = pd.DataFrame(
+                [
+                    (it.protein_id, pep)
+                    for it in protid_protseq_protlen.itertuples()
+                    for pep in gen_peptides(it.protein_sequence, k, prefix)
+                ],
+                columns=["protein_id", "peptide_sequence"],
+            )
+            id_counter = write_peptides(results, k, id_counter, peptides_writer, proteins_peptides_writer, print_mem)
+
+
+def generate_partitioned(
+    protid_protseq_protlen, peptide_lengths, peptides_writer, proteins_peptides_writer, print_mem, buffer_size, tmp_dir
+):
+    """Generates the peptides by scanning all protein sequences once. The peptides are bucketed into
+    on-disk partitions (one per peptide length and initial amino acid), which are then processed one
+    after another in the same order as by the 'prefix' engine to limit peak memory usage."""
+    with tempfile.TemporaryDirectory(prefix="peptide_partitions.", dir=tmp_dir) as partition_dir:
+        partition_paths = {
+            (k, prefix): os.path.join(partition_dir, f"{k}_{prefix}.tsv") for k in peptide_lengths for prefix in AA_LIST
+        }
+        buffers = {partition: [] for partition in partition_paths}
+        buffered = 0
+
+        def flush():
+            for partition, buffer in buffers.items():
+                if buffer:
+                    with open(partition_paths[partition], "a") as outfile:
+                        outfile.writelines(buffer)
+                    buffer.clear()
+
+        print("Bucket peptides into partitions ...", flush=True)
+        for it in protid_protseq_protlen.itertuples():
+            prot_seq = it.protein_sequence
+            for k in peptide_lengths:
+                for i in range(len(prot_seq) - k + 1):
+                    buffers[(k, prot_seq[i])].append(f"{it.protein_id}\t{prot_seq[i : (i + k)]}\n")
+                buffered += max(len(prot_seq) - k + 1, 0)
+            if buffered >= buffer_size:
+                flush()
+                buffered = 0
+        flush()
+
+        id_counter = 0
+        for (k, prefix), partition_path in partition_paths.items():
+            print("Process peptides of length ", k, " with prefix ", prefix, flush=True)
+            if os.path.exists(partition_path):
+                results = pd.read_csv(
+                    partition_path,
+                    sep="\t",
+                    names=["protein_id", "peptide_sequence"],
+                    dtype={"protein_id": protid_protseq_protlen["protein_id"].dtype, "peptide_sequence": str},
+                )
+                os.remove(partition_path)
+            else:
+                results = pd.DataFrame(columns=["protein_id", "peptide_sequence"])
+            id_counter = write_peptides(results, k, id_counter, peptides_writer, proteins_peptides_writer, print_mem)
+
+
+def encode_proteins(protein_sequences, protein_lengths):
+    """Encodes the concatenated protein sequences as alphabetical rank of each residue and returns it
+    together with the start and end offsets of the proteins. The sequences are encoded in batches of
+    proteins, so that only the uint8 codes are held for the whole proteome."""
+    protein_ends = np.cumsum(protein_lengths)
+    protein_starts = protein_ends - protein_lengths
+    alpha_codes = np.empty(protein_ends[-1] if len(protein_ends) else 0, dtype=np.uint8)
+    for start in range(0, len(protein_sequences), ENCODE_BATCH_SIZE):
+        end = min(start + ENCODE_BATCH_SIZE, len(protein_sequences))
+        batch = np.frombuffer("".join(protein_sequences[start:end]).encode("ascii"), dtype=np.uint8)
+        alpha_codes[protein_starts[start] : protein_starts[start] + len(batch)] = batch - ord("A")
+    return alpha_codes, protein_starts, protein_ends
+
+
+def count_peptides(encoded, k, rank):
+    """Returns the packed keys, protein indices and counts of all peptides of length k with initial
+    amino acid AA_LIST[rank], sorted by (key, protein index)."""
+    alpha_codes, protein_starts, protein_ends = encoded
+    if len(alpha_codes) < k:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.intp), np.empty(0, dtype=np.uint32)
+    windows = sliding_window_view(alpha_codes, k)
+    # Select the peptides with the initial amino acid that lie within one protein
+    starts = np.flatnonzero(alpha_codes == ord(AA_LIST[rank]) - ord("A"))
+    protein_idx = np.searchsorted(protein_starts, starts, side="right") - 1
+    within_protein = starts + k <= protein_ends[protein_idx]
+    starts = starts[within_protein]
+    protein_idx = protein_idx[within_protein]
+    del within_protein
+
+    # Pack peptides into uint64 keys
+    keys = np.full(len(starts), rank, dtype=np.uint64)
+    pep_windows = windows[starts]
+    for i in range(1, k):
+        keys = keys * np.uint64(26) + pep_windows[:, i]
+    del pep_windows, starts
+
+    # Count occurrences of one peptide in one protein: sort by (key, protein) and collapse runs
+    order = np.lexsort((protein_idx, keys))
+    keys = keys[order]
+    protein_idx = protein_idx[order]
+    del order
+    new_pair = np.ones(len(keys), dtype=bool)
+    new_pair[1:] = (keys[1:] != keys[:-1]) | (protein_idx[1:] != protein_idx[:-1])
+    pair_starts = np.flatnonzero(new_pair)
+    counts = np.diff(np.append(pair_starts, len(keys))).astype(np.uint32)
+    return keys[pair_starts], protein_idx[pair_starts], counts
+
+
+def decode_peptides(keys, k):
+    """Decodes packed uint64 keys of length k into peptide sequences."""
+    letters = np.empty((len(keys), k), dtype=np.uint8)
+    rest = keys.copy()
+    for i in range(k - 1, 0, -1):
+        letters[:, i] = (rest % np.uint64(26)).astype(np.uint8) + ord("A")
+        rest //= np.uint64(26)
+    letters[:, 0] = np.array([ord(aa) for aa in AA_LIST], dtype=np.uint8)[rest.astype(np.intp)]
+    return letters.view(f"S{k}").ravel().astype(str)
+
+
+def write_packed_peptides(
+    keys, protein_ids, counts, k, id_counter, peptides_writer, proteins_peptides_writer, print_mem
+):
+    """Takes peptide keys, protein_ids and counts sorted by (key, protein_id) for peptide length k and
+    one initial amino acid, assigns peptide_ids starting from id_counter and writes out the peptides and
+    protein peptide occurrences. Returns the next free peptide_id."""
+    new_peptide = np.ones(len(keys), dtype=bool)
+    new_peptide[1:] = keys[1:] != keys[:-1]
+    peptide_ids = id_counter + np.cumsum(new_peptide) - 1
+    unique_keys = keys[new_peptide]
+    print(
+        "Info: # peptide occurrences: ",
+        len(keys),
+        ", # unique peptides: ",
+        len(unique_keys),
+        ", memory usage of keys: ",
+        keys.nbytes,
+        " bytes",
+        flush=True,
+    )
+
+    peptides_writer.write(
+        pd.DataFrame(
+            {
+                "peptide_sequence": decode_peptides(unique_keys, k),
+                "peptide_id": np.arange(id_counter, id_counter + len(unique_keys)),
+            }
+        )
+    )
+    id_counter += len(unique_keys)
+
+    results = pd.DataFrame({"protein_id": protein_ids, "peptide_id": peptide_ids, "count": counts})
+    results["count"] = pd.to_numeric(results["count"], downcast="unsigned")
+    print("\nInfo: results (['protein_id','peptide_id','count'])", flush=True)
+    results.info(verbose=False, memory_usage=print_mem)
+    proteins_peptides_writer.write(results)
+
+    print("# peptides of length ", k, ", (non-unique across proteins): ", len(results))
+    return id_counter
+
+
+def count_shard(shard, protein_sequences, protein_lengths, protein_ids, peptide_lengths, run_dir):
+    """Worker function: counts the peptides of one shard of proteins and writes one sorted run of
+    (key, protein_id, count) per peptide length and initial amino acid into run_dir."""
+    encoded = encode_proteins(protein_sequences, protein_lengths)
+    for k in peptide_lengths:
+        for rank in range(len(AA_LIST)):
+            keys, protein_idx, counts = count_peptides(encoded, k, rank)
+            np.savez(
+                os.path.join(run_dir, f"{k}_{rank}.{shard}.npz"),
+                keys=keys,
+                protein_ids=protein_ids[protein_idx],
+                counts=counts,
+            )
+    return shard
+
+
+def generate_numpy(
+    protid_protseq_protlen, peptide_lengths, peptides_writer, proteins_peptides_writer, print_mem, workers, tmp_dir
+):
+    """Generates the peptides on integer-encoded protein sequences. Each peptide is packed into a
+    single uint64 key (base 26), such that the numeric order of the keys matches the order in which
+    the 'prefix' engine assigns the peptide_ids: initial amino acid in the order of AA_LIST, then
+    lexicographic order of the sequence. Counting and deduplication are done on the integer keys,
+    peptide sequences are only decoded for writing out the unique peptides.
+
+    With more than one worker, the proteins are sharded into contiguous protein_id ranges, which are
+    counted in a process pool. Each worker writes sorted runs per peptide length and initial amino
+    acid to disk, which are merged before the peptide_ids are assigned. The output is identical to
+    the single-process output."""
+    if max(peptide_lengths) > MAX_PACKED_PEPTIDE_LENGTH:
+        print(
+            "ERROR: the 'numpy' engine supports peptide lengths up to ",
+            MAX_PACKED_PEPTIDE_LENGTH,
+            ". Please use another engine.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    protein_sequences = protid_protseq_protlen["protein_sequence"].tolist()
+    protein_lengths = protid_protseq_protlen["protein_length"].to_numpy(dtype=np.int64)
+    protein_ids = protid_protseq_protlen["protein_id"].to_numpy()
+
+    id_counter = 0
+    if workers <= 1:
+        encoded = encode_proteins(protein_sequences, protein_lengths)
+        for k in peptide_lengths:
+            print("Generate peptides of length ", k, " ...", flush=True)
+            # Process peptides separately for each initial amino acid to limit peak memory usage
+            # (selection is done on the encoded sequences, which is cheap compared to rescanning strings)
+            for rank, prefix in enumerate(AA_LIST):
+                print("with prefix ", prefix, flush=True)
+                keys, protein_idx, counts = count_peptides(encoded, k, rank)
+                id_counter = write_packed_peptides(
+                    keys,
+                    protein_ids[protein_idx],
+                    counts,
+                    k,
+                    id_counter,
+                    peptides_writer,
+                    proteins_peptides_writer,
+                    print_mem,
+                )
+        return
+
+    # Shard proteins into contiguous ranges (proteins are sorted by protein_id)
+    bounds = np.linspace(0, len(protein_sequences), workers + 1).astype(int)
+    with tempfile.TemporaryDirectory(prefix="peptide_runs.", dir=tmp_dir) as run_dir:
+        print("Count peptides in ", workers, " shards ...", flush=True)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    count_shard,
+                    shard,
+                    protein_sequences[start:end],
+                    protein_lengths[start:end],
+                    protein_ids[start:end],
+                    peptide_lengths,
+                    run_dir,
+                )
+                for shard, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+            ]
+            for future in as_completed(futures):
+                print("Shard ", future.result(), " done.", flush=True)
+
+        for k in peptide_lengths:
+            print("Merge peptides of length ", k, " ...", flush=True)
+            for rank, prefix in enumerate(AA_LIST):
+                print("with prefix ", prefix, flush=True)
+                run_paths = [os.path.join(run_dir, f"{k}_{rank}.{shard}.npz") for shard in range(workers)]
+                runs = [np.load(run_path) for run_path in run_paths]
+                keys = np.concatenate([run["keys"] for run in runs])
+                # The runs are sorted by (key, protein_id) and cover ascending, disjoint protein_id ranges:
+                # a stable sort on the keys (merge of the sorted runs) yields the (key, protein_id) order
+                order = np.argsort(keys, kind="stable")
+                keys = keys[order]
+                run_protein_ids = np.concatenate([run["protein_ids"] for run in runs])[order]
+                counts = np.concatenate([run["counts"] for run in runs])[order]
+                del order, runs
+                for run_path in run_paths:
+                    os.remove(run_path)
+                id_counter = write_packed_peptides(
+                    keys,
+                    run_protein_ids,
+                    counts,
+                    k,
+                    id_counter,
+                    peptides_writer,
+                    proteins_peptides_writer,
+                    print_mem,
+                )
+
+
 def main(args=None):
     args = parse_args(args)
     if args.mem_log_level_deep:
@@ -68,45 +473,12 @@ def main(args=None):
     else:
         print_mem = None
 
-    # Generate peptides in chunks based on initial AA to reduce memory usage
-    # valid amino acid codes:
-    # 20 standard ('A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y')
-    # and extended codes ('B', 'J', 'O', 'U', 'X', 'Z')
-    aa_list = [
-        "A",
-        "C",
-        "D",
-        "E",
-        "F",
-        "G",
-        "H",
-        "I",
-        "K",
-        "L",
-        "M",
-        "N",
-        "P",
-        "Q",
-        "R",
-        "S",
-        "T",
-        "V",
-        "W",
-        "Y",
-        "B",
-        "J",
-        "O",
-        "U",
-        "X",
-        "Z",
-    ]
-
     protid_protseq_protlen = pd.read_csv(args.proteins, sep="\t")
     # downcast df columns where possible (i.e. that will not be used as index for downstream joining)
     protid_protseq_protlen["protein_id"] = pd.to_numeric(protid_protseq_protlen["protein_id"], downcast="unsigned")
     # validate input AAs
     protid_protseq_protlen["protein_sequence"] = protid_protseq_protlen["protein_sequence"].str.upper()
-    protid_protseq_protlen["protein_sequence"].apply(validate_letters, alphabet=aa_list)
+    protid_protseq_protlen["protein_sequence"].apply(validate_letters, alphabet=AA_LIST)
     # get protein lengths
     protid_protseq_protlen["protein_length"] = protid_protseq_protlen["protein_sequence"].apply(len)
     protid_protseq_protlen["protein_length"] = pd.to_numeric(
@@ -124,61 +496,38 @@ def main(args=None):
     # Parse peptide_lengths input list to int
     peptide_lengths_int = [int(p_len) for p_len in args.peptide_lengths]
 
+    if args.workers > 1 and args.engine != "numpy":
+        print("WARN: --workers is only supported by the 'numpy' engine and is ignored.", flush=True)
+
     ####################
     # generate peptides
-    with gzip.open(args.peptides, "wt") as pep_handle:
-        print_header = True
-        id_counter = 0
-
-        # for each k
-        for k in peptide_lengths_int:
-            print("Generate peptides of length ", k, " ...", flush=True)
-
-            # Note: could be done with prefixes instead of single first letters if this remains bottleneck
-            for prefix in aa_list:
-                print("with prefix ", prefix, flush=True)
-                # for each protein generate all peptides of length k with current prefix (to reduce peak mem usage)
-                # (the AA-wise processing causes multiple iterations over the same protein sequences,
-                # but the increase of run time is negligible in this context)
-                results = pd.DataFrame(
-                    [
-                        (it.protein_id, pep)
-                        for it in protid_protseq_protlen.itertuples()
-                        for pep in gen_peptides(it.protein_sequence, k, prefix)
-                    ],
-                    columns=["protein_id", "peptide_sequence"],
-                )
-
-                print("\nInfo: results (['protein_id','peptide_sequence'])", flush=True)
-                results.info(verbose=False, memory_usage=print_mem)
-
-                print("format results ...", flush=True)
-                # count occurrences of one peptide in one protein
-                results = results.groupby(["protein_id", "peptide_sequence"]).size().reset_index(name="count")
-                # -> protein_id, peptide_sequence, count
-                results["count"] = pd.to_numeric(results["count"], downcast="unsigned")
-                # prepare df for joining
-                results.set_index("peptide_sequence", inplace=True)
-                results.sort_index(inplace=True)
-
-                unique_peptides = pd.DataFrame(index=results.index.drop_duplicates())
-                unique_peptides["peptide_id"] = range(id_counter, id_counter + len(unique_peptides))
-                id_counter += len(unique_peptides)
-                # -> peptide_sequence, peptide_id
-                unique_peptides.to_csv(pep_handle, mode="a", sep="\t", index=True, header=print_header)
-
-                results = results.join(unique_peptides)
-                # -> protein_id, peptide_sequence, count, peptide_id
-
-                print("\nInfo: results (['protein_id','peptide_sequence','peptide_id','count'])", flush=True)
-                results.info(verbose=False, memory_usage=print_mem)
-
-                results[["protein_id", "peptide_id", "count"]].to_csv(
-                    args.proteins_peptides, mode="a", sep="\t", index=False, header=print_header
-                )
-
-                print("# peptides of length ", k, ", (non-unique across proteins): ", len(results))
-                print_header = False
+    with TableWriter(args.peptides, PEPTIDES_DTYPES) as peptides_writer, TableWriter(
+        args.proteins_peptides, PROTEINS_PEPTIDES_DTYPES
+    ) as proteins_peptides_writer:
+        if args.engine == "partitioned":
+            generate_partitioned(
+                protid_protseq_protlen,
+                peptide_lengths_int,
+                peptides_writer,
+                proteins_peptides_writer,
+                print_mem,
+                args.partition_buffer_size,
+                args.tmp_dir,
+            )
+        elif args.engine == "numpy":
+            generate_numpy(
+                protid_protseq_protlen,
+                peptide_lengths_int,
+                peptides_writer,
+                proteins_peptides_writer,
+                print_mem,
+                args.workers,
+                args.tmp_dir,
+            )
+        else:
+            generate_prefix(
+                protid_protseq_protlen, peptide_lengths_int, peptides_writer, proteins_peptides_writer, print_mem
+            )
 
     print("Done!", flush=True)
 
@@ -11,6 +11,11 @@ import sys
 
 import pandas as pd
 
+from metapep_utils import TableWriter
+
+# Fixed column types of the entity protein association table (used for Parquet output)
+ENTITIES_PROTEINS_DTYPES = {"entity_id": "uint32", "protein_id": "uint32"}
+
 
 def parse_args(args=None):
     parser = argparse.ArgumentParser()
@@ -66,7 +71,7 @@ def parse_args(args=None):
         "--out-entities-proteins",
         type=str,
         required=True,
-        help="Outputh path for the global entity protein association TSV file.",
+        help="Outputh path for the global entity protein association TSV file (Parquet file if the path ends with '.parquet').",
     )
     parser.add_argument(
         "-oe", "--out-entities", type=str, required=True, help="Outputh path for the global entities TSV file."
@@ -92,14 +97,13 @@ def main(args=None):
     entities_proteins_columns = ["entity_id", "protein_id"]
     entities_columns = ["entity_id", "entity_name"]
     microbiomes_entities_columns = ["microbiome_id", "entity_id"]
-    with gzip.open(args.out_proteins, "wt") as outfile_proteins, open(
-        args.out_entities_proteins, "w"
-    ) as outfile_entities_proteins, open(args.out_entities, "w") as outfile_entities, open(
+    with gzip.open(args.out_proteins, "wt") as outfile_proteins, TableWriter(
+        args.out_entities_proteins, ENTITIES_PROTEINS_DTYPES
+    ) as entities_proteins_writer, open(args.out_entities, "w") as outfile_entities, open(
         args.out_microbiomes_entities, "w"
     ) as outfile_microbiomes_entities:
         # HEADERS
         print("\t".join(proteins_columns), file=outfile_proteins)
-        print("\t".join(entities_proteins_columns), file=outfile_entities_proteins)
         print("\t".join(entities_columns), file=outfile_entities)
         print("\t".join(microbiomes_entities_columns), file=outfile_microbiomes_entities)
 
@@ -172,8 +176,8 @@ def main(args=None):
                     proteins.rename(columns={"protein_tmp_id": "protein_orig_id"}, inplace=True)
                     proteins[proteins_columns].to_csv(outfile_proteins, sep="\t", header=False, index=False)
                     # Write entities_proteins
-                    proteins.merge(entities)[["entity_id", "protein_id"]].drop_duplicates().to_csv(
-                        outfile_entities_proteins, sep="\t", header=False, index=False
+                    entities_proteins_writer.write(
+                        proteins.merge(entities)[entities_proteins_columns].drop_duplicates()
                     )
                     # Write entities
                     entities[entities_columns].drop_duplicates().to_csv(
@@ -221,9 +225,7 @@ def main(args=None):
             )
 
             # Write entities_proteins: 'entity_id', 'protein_id'
-            entities_microbiomes_proteins[entities_proteins_columns].to_csv(
-                outfile_entities_proteins, sep="\t", header=False, index=False
-            )
+            entities_proteins_writer.write(entities_microbiomes_proteins[entities_proteins_columns])
             # Write entities: 'entity_id', 'entity_name'
             entities[entities_columns].to_csv(outfile_entities, sep="\t", header=False, index=False)
             # Write microbiomes - entities: 'microbiome_id', 'entity_id'
@@ -0,0 +1,405 @@
+# Helpers shared by the scripts of the pipeline, which import this module from the script directory
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+# Column types of predictions stored with quantized prediction scores (see QuantizedPredictionsWriter)
+QUANTIZED_DTYPES = {"peptide_id": "uint32", "prediction_score": "uint16", "allele_id": "uint8"}
+# Quantized value of missing prediction scores in predictions files with quantized prediction scores
+NO_SCORE = np.iinfo(np.uint16).max
+# Maximum number of decimals of quantized prediction scores
+MAX_SCORE_DECIMALS = 4
+# Score bin of predictions without score in compact predictions files (see compact_predictions.py)
+NO_SCORE_BIN = np.iinfo(np.uint16).max
+# Known prediction score bounds of the prediction methods
+SCORE_BOUNDS = {"mhcflurry": (0.0, 1.0), "mhcnuggets-class-1": (0.0, 1.0), "mhcnuggets-class-2": (0.0, 1.0)}
+
+# Table of the persistent prediction cache and its shards (written by epytope_predict.py and
+# update_prediction_cache.py, read by gen_prediction_chunks.py)
+PREDICTION_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    method TEXT NOT NULL,
+    method_version TEXT NOT NULL,
+    normalized INTEGER NOT NULL,
+    allele TEXT NOT NULL,
+    peptide_sequence TEXT NOT NULL,
+    prediction_score REAL,
+    PRIMARY KEY (method, method_version, normalized, allele, peptide_sequence)
+) WITHOUT ROWID
+"""
+PREDICTION_CACHE_COLUMNS = "method, method_version, normalized, allele, peptide_sequence, prediction_score"
+
+####################################################################################################
+
+
+def dequantize_scores(scores, offset, decimals):
+    """Converts quantized prediction scores back into floats (NaN for missing scores)."""
+    return np.where(
+        scores == NO_SCORE, np.nan, (scores.astype(np.int64) - offset) / 10 ** decimals.astype(np.float64)
+    ).astype(np.float32)
+
+
+def read_quantized_predictions(path, columns=None):
+    """Reads a predictions file with quantized prediction scores (written by concat_tsv.py) and converts the
+    prediction scores back into floats. If columns are given, only these columns are read."""
+    with np.load(path) as predictions:
+        columns = columns or list(QUANTIZED_DTYPES)
+        table = pd.DataFrame({column: predictions[column] for column in columns})
+        if "prediction_score" in table:
+            table["prediction_score"] = dequantize_scores(
+                table["prediction_score"].to_numpy(),
+                predictions["prediction_score_offset"],
+                predictions["prediction_score_decimals"],
+            )
+    return table
+
+
+def iter_quantized_predictions(path, chunksize, columns=None):
+    """Reads a predictions file with quantized prediction scores (see read_quantized_predictions()) chunk-wise.
+    The arrays are compressed within the NPZ file and can thus not be memory-mapped, instead each column is
+    decompressed as a stream, so that only one chunk of each column is held in memory."""
+    columns = columns or list(QUANTIZED_DTYPES)
+    with np.load(path) as predictions:
+        offset, decimals = predictions["prediction_score_offset"], predictions["prediction_score_decimals"]
+    with zipfile.ZipFile(path) as archive:
+        streams, dtypes = {}, {}
+        try:
+            for column in columns:
+                streams[column] = archive.open(column + ".npy")
+                version = np.lib.format.read_magic(streams[column])
+                if version == (1, 0):
+                    _, _, dtypes[column] = np.lib.format.read_array_header_1_0(streams[column])
+                else:
+                    _, _, dtypes[column] = np.lib.format.read_array_header_2_0(streams[column])
+            while True:
+                table = pd.DataFrame(
+                    {
+                        column: np.frombuffer(streams[column].read(chunksize * dtypes[column].itemsize), dtypes[column])
+                        for column in columns
+                    }
+                )
+                if len(table) == 0:
+                    break
+                if "prediction_score" in table:
+                    table["prediction_score"] = dequantize_scores(
+                        table["prediction_score"].to_numpy(), offset, decimals
+                    )
+                yield table
+        finally:
+            for stream in streams.values():
+                stream.close()
+
+
+def read_table(path, columns=None):
+    """Reads a TSV file or, if the file name ends with '.parquet', a Parquet file or, if the file name ends with
+    '.npz', a predictions file with quantized prediction scores. If columns are given, only these columns are read."""
+    if path.endswith(".npz"):
+        return read_quantized_predictions(path, columns)
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns, sep="\t")
+
+
+def iter_table_chunks(path, chunksize, columns=None):
+    """Reads a TSV file or, if the file name ends with '.parquet', a Parquet file or, if the file name ends with
+    '.npz', a predictions file with quantized prediction scores chunk-wise."""
+    if path.endswith(".npz"):
+        yield from iter_quantized_predictions(path, chunksize, columns)
+    elif path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        with pd.read_csv(path, usecols=columns, sep="\t", chunksize=chunksize) as reader:
+            yield from reader
+
+
+class SortedTableStream:
+    """Returns a table sorted by peptide_id block-wise for consecutive ranges of peptide ids. The table is given
+    as chunks (e.g. read chunk-wise from a sorted file), of which only about one is held in memory."""
+
+    def __init__(self, name, chunks, columns, prepare=None):
+        self.name = name
+        self.chunks = iter(chunks)
+        self.columns = columns
+        self.prepare = prepare
+        self.buffer = None
+        self.position = 0
+        self.last_peptide_id = -1
+        self.exhausted = False
+
+    def _read_chunk(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            return
+        if len(chunk) == 0:
+            return
+        if not chunk["peptide_id"].is_monotonic_increasing or chunk["peptide_id"].iloc[0] < self.last_peptide_id:
+            print("ERROR - The", self.name, "input file is not sorted by peptide_id.", file=sys.stderr)
+            sys.exit(1)
+        self.last_peptide_id = chunk["peptide_id"].iloc[-1]
+        if self.prepare:
+            chunk = self.prepare(chunk)
+        if self.buffer is None or self.position == len(self.buffer):
+            self.buffer = chunk.reset_index(drop=True)
+        else:
+            self.buffer = pd.concat([self.buffer.iloc[self.position :], chunk], ignore_index=True)
+        self.position = 0
+
+    def finished(self):
+        """Returns True if all rows were taken."""
+        return self.exhausted and (self.buffer is None or self.position == len(self.buffer))
+
+    def take(self, max_peptide_id):
+        """Returns all remaining rows with peptide_id <= max_peptide_id, indexed by peptide_id."""
+        while not self.exhausted and (self.buffer is None or self.buffer["peptide_id"].iloc[-1] <= max_peptide_id):
+            self._read_chunk()
+        if self.buffer is None:
+            return pd.DataFrame({column: pd.Series(dtype="int64") for column in self.columns}).set_index("peptide_id")
+        split = self.position + self.buffer["peptide_id"].iloc[self.position :].searchsorted(max_peptide_id, "right")
+        block = self.buffer.iloc[self.position : split].set_index("peptide_id")
+        self.position = split
+        return block
+
+
+def prepare_predictions(predictions):
+    """Converts the columns of the predictions to the smallest possible types."""
+    if "prediction_score" in predictions:
+        predictions["prediction_score"] = pd.to_numeric(predictions["prediction_score"], downcast="float")
+    predictions["allele_id"] = pd.to_numeric(predictions["allele_id"], downcast="unsigned")
+    return predictions
+
+
+def prepare_protein_peptide_occs(protein_peptide_occs):
+    """Converts the columns of the protein peptide occurences to the smallest possible types."""
+    protein_peptide_occs["protein_id"] = pd.to_numeric(protein_peptide_occs["protein_id"], downcast="unsigned")
+    protein_peptide_occs["count"] = pd.to_numeric(protein_peptide_occs["count"], downcast="unsigned")
+    return protein_peptide_occs
+
+
+def read_compact_predictions(path, columns=("binder", "prediction_score_bin")):
+    """Reads a compact predictions file (written by compact_predictions.py) into a table with the columns
+    peptide_id, the given columns (binder and/or prediction_score_bin, the bin index) and allele_id. Returns the table
+    and the contents of the file."""
+    compact = np.load(path)
+    num_peptides = int(compact["num_peptides"])
+    predicted, binder = compact["predicted"], compact["binder"]
+    peptide_ids, binders, allele_ids = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=bool)], []
+    for i in range(len(compact["allele_ids"])):
+        allele_peptide_ids = np.flatnonzero(np.unpackbits(predicted[i], count=num_peptides))
+        peptide_ids.append(allele_peptide_ids)
+        if "binder" in columns:
+            binders.append(np.unpackbits(binder[i], count=num_peptides).astype(bool)[allele_peptide_ids])
+        allele_ids.append(len(allele_peptide_ids))
+    table = {"peptide_id": np.concatenate(peptide_ids)}
+    if "binder" in columns:
+        table["binder"] = np.concatenate(binders)
+    if "prediction_score_bin" in columns:
+        table["prediction_score_bin"] = compact["score_bins"]
+    table["allele_id"] = np.repeat(compact["allele_ids"], allele_ids)
+    return pd.DataFrame(table), compact
+
+
+def read_peptide_index(path):
+    """Reads the peptide index written by build_peptide_index.py. The CSR arrays (indptr, group, count) are
+    memory-mapped. Returns the arrays and the table of the groups (entity_id, allele_id, condition_name,
+    entity_weight) indexed by group."""
+    index = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in ["indptr", "group", "count"]}
+    groups = pd.read_csv(os.path.join(path, "groups.tsv"), sep="\t", index_col="group")
+    groups["entity_id"] = pd.to_numeric(groups["entity_id"], downcast="unsigned")
+    groups["allele_id"] = pd.to_numeric(groups["allele_id"], downcast="unsigned")
+    groups["entity_weight"] = pd.to_numeric(groups["entity_weight"], downcast="float")
+    return index, groups
+
+
+def lookup_peptide_index(index, group_allele_ids, peptide_ids, allele_ids):
+    """Returns the contributions of the given predictions (peptide_ids, allele_ids) in the peptide index: the rows of
+    the predictions, the groups with the same allele and the counts of the peptides within the groups."""
+    indptr = index["indptr"]
+    # (peptides beyond the index have no entries)
+    starts = indptr[np.minimum(peptide_ids, len(indptr) - 1)]
+    lengths = indptr[np.minimum(peptide_ids + 1, len(indptr) - 1)] - starts
+    rows = np.repeat(np.arange(len(peptide_ids)), lengths)
+    entries = np.arange(len(rows)) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    groups = index["group"][entries]
+    keep = group_allele_ids[groups] == allele_ids[rows]
+    return rows[keep], groups[keep], index["count"][entries[keep]]
+
+
+def get_bin_edges(method, min_score, max_score, bins):
+    """Returns the edges of the prediction score bins, which span the known score bounds of the prediction method or
+    otherwise the given score range. These are the edges pd.cut() would use for scores with this minimum and maximum.
+    Returns no edges if there are no scores."""
+    min_score, max_score = SCORE_BOUNDS.get(method, (min_score, max_score))
+    if not np.isfinite(min_score):
+        return np.empty(0)
+    _, bin_edges = pd.cut(pd.Series([min_score, max_score], dtype="float32"), bins=bins, retbins=True)
+    return bin_edges
+
+
+def get_score_bins(scores, bin_edges):
+    """Returns the indices of the (right-closed) bins of the prediction scores like pd.cut() or -1 for missing scores.
+    Scores outside of the score bounds of the method are assigned to the first or last bin."""
+    if len(bin_edges) == 0:
+        return np.full(len(scores), -1)
+    codes = np.clip(np.searchsorted(bin_edges, scores, side="left") - 1, 0, len(bin_edges) - 2)
+    return np.where(np.isnan(scores), -1, codes)
+
+
+def get_binder_threshold(method, syfpeithi_score_threshold, mhcfn_score_threshold):
+    """Returns the binder threshold of the prediction method (see call_binder())."""
+    if method == "syfpeithi":
+        return syfpeithi_score_threshold
+    else:
+        return mhcfn_score_threshold
+
+
+def call_binder(score, method, syfpeithi_score_threshold, mhcfn_score_threshold):
+    """
+    Scoring threshold is based on the nf-core/epitopeprediction pipeline.
+    For SYFPEITHI the scoring threshold is a "half of maximum score". After
+    normalization the highest achievable score is 1. For MHCflurry and
+    MHCnuggets the score is an 0 to 1 scoring base on the
+    affinity score (IC50) and is calculated by: 1-log_50000(affinity_score)
+    in this scale the old threshold of 500 is: 0.426 and the higher the better.
+    """
+    return score >= get_binder_threshold(method, syfpeithi_score_threshold, mhcfn_score_threshold)
+
+
+class QuantizedPredictionsWriter:
+    """Writes predictions chunk-wise into a (compressed) NPZ file with one array per column: peptide_id as uint32,
+    allele_id as uint8 and prediction_score as uint16 fixed-point number, i.e. the prediction score is
+    (prediction_score - prediction_score_offset) / 10 ** prediction_score_decimals. The number of decimals is
+    chosen such that the range of the scores fits into 16 bits (4 decimals for normalized scores between -3 and 3).
+    The columns are buffered in temporary files, so that the memory usage does not depend on the number of predictions.
+    """
+
+    def __init__(self, path, columns):
+        if sorted(columns) != sorted(QUANTIZED_DTYPES):
+            raise ValueError(f"Quantized predictions require the columns {list(QUANTIZED_DTYPES)}, got {list(columns)}")
+        self.path = path
+        self.columns = {column: tempfile.TemporaryFile() for column in QUANTIZED_DTYPES}
+        self.length = 0
+        self.min_score = np.inf
+        self.max_score = -np.inf
+
+    def write(self, data):
+        for column, dtype in QUANTIZED_DTYPES.items():
+            if column == "prediction_score":
+                values = data[column].to_numpy(dtype=np.float64)
+                if not np.isnan(values).all():
+                    self.min_score = min(self.min_score, np.nanmin(values))
+                    self.max_score = max(self.max_score, np.nanmax(values))
+            else:
+                values = data[column].to_numpy()
+                if len(values) and (values.min() < 0 or values.max() > np.iinfo(dtype).max):
+                    raise ValueError(f"Values of column {column} do not fit into {dtype}")
+                values = values.astype(dtype)
+            self.columns[column].write(values.tobytes())
+        self.length += len(data)
+
+    def close(self):
+        # Choose fixed-point representation of the prediction scores
+        decimals, offset = MAX_SCORE_DECIMALS, 0
+        if self.min_score <= self.max_score:
+            while np.ceil(self.max_score * 10**decimals) - np.floor(self.min_score * 10**decimals) >= NO_SCORE:
+                decimals -= 1
+            offset = -int(np.floor(self.min_score * 10**decimals))
+        print("Prediction score decimals: ", decimals, flush=True)
+
+        with zipfile.ZipFile(self.path, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for column, dtype in QUANTIZED_DTYPES.items():
+                with archive.open(column + ".npy", "w", force_zip64=True) as outfile:
+                    np.lib.format.write_array_header_1_0(
+                        outfile,
+                        {
+                            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                            "fortran_order": False,
+                            "shape": (self.length,),
+                        },
+                    )
+                    infile = self.columns[column]
+                    infile.seek(0)
+                    if column == "prediction_score":
+                        # Quantize block-wise
+                        for block in iter(lambda: infile.read(8 * 1048576), b""):
+                            scores = np.frombuffer(block, dtype=np.float64)
+                            quantized = np.rint(scores * 10**decimals) + offset
+                            outfile.write(np.where(np.isnan(scores), NO_SCORE, quantized).astype(dtype).tobytes())
+                    else:
+                        shutil.copyfileobj(infile, outfile)
+                    infile.close()
+            for name, value in [("prediction_score_decimals", decimals), ("prediction_score_offset", offset)]:
+                with archive.open(name + ".npy", "w") as outfile:
+                    np.lib.format.write_array(outfile, np.array(value, dtype=np.int64))
+
+
+class TableWriter:
+    """Writes a table chunk-wise into a TSV file (gzip-compressed if the file name ends with '.gz'),
+    if the file name ends with '.parquet', into a Parquet file with fixed column types or, if the file name ends
+    with '.npz', into an NPZ file with quantized prediction scores (see QuantizedPredictionsWriter)."""
+
+    def __init__(self, path, dtypes):
+        self.path = path
+        self.dtypes = dtypes
+        self.header = True
+        if path.endswith(".npz"):
+            self.writer = QuantizedPredictionsWriter(path, dtypes)
+        elif path.endswith(".parquet"):
+            import pyarrow as pa
+
+            self.schema = pa.schema(
+                [
+                    (column, pa.string() if dtype == "str" else pa.from_numpy_dtype(np.dtype(dtype)))
+                    for column, dtype in dtypes.items()
+                ]
+            )
+            self.writer = None
+        else:
+            self.handle = gzip.open(path, "wt") if path.endswith(".gz") else open(path, "w")
+
+    def write(self, data):
+        if self.path.endswith(".npz"):
+            self.writer.write(data)
+        elif self.path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, self.schema)
+            data = data[list(self.dtypes)].astype(self.dtypes)
+            self.writer.write_table(pa.Table.from_pandas(data, schema=self.schema, preserve_index=False))
+        else:
+            data.to_csv(self.handle, sep="\t", index=False, header=self.header)
+        self.header = False
+
+    def close(self):
+        if self.path.endswith(".npz"):
+            self.writer.close()
+        elif self.path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+
+            if self.writer is None:
+                pq.write_table(self.schema.empty_table(), self.path)
+            else:
+                self.writer.close()
+        else:
+            if self.header:
+                # nothing written: write header only
+                print("\t".join(self.dtypes), file=self.handle)
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
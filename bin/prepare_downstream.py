@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import itertools
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from metapep_utils import (
+    NO_SCORE_BIN,
+    SCORE_BOUNDS,
+    SortedTableStream,
+    call_binder,
+    get_bin_edges,
+    get_binder_threshold,
+    get_score_bins,
+    iter_table_chunks,
+    prepare_predictions,
+    prepare_protein_peptide_occs,
+    read_compact_predictions,
+    read_table,
+)
+
+####################################################################################################
+
+
+def parse_args(args=None):
+    """Parses the command line arguments specified by the user."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Prepare the prediction score distributions and entity binding rates for plotting and collect the "
+            "protein and peptide stats of the conditions in a single pass over the predictions and protein peptide "
+            "occurences (the results of prepare_score_distribution.py, prepare_entity_binding_ratios.py and "
+            "collect_stats.py)."
+        )
+    )
+
+    # INPUT FILES
+    parser.add_argument(
+        "-p",
+        "--predictions",
+        help="Path to the predictions input file or to a compact predictions file (.compact.npz) written by compact_predictions.py",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "-ppo",
+        "--protein-peptide-occ",
+        help="Path to the protein peptide occurences input file",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "-epo",
+        "--entities-proteins-occ",
+        help="Path to the entity protein occurences input file",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "-meo",
+        "--microbiomes-entities-occ",
+        help="Path to the microbiome entity occurences input file",
+        type=str,
+        required=True,
+    )
+    parser.add_argument("-c", "--conditions", help="Path to the conditions input file", type=str, required=True)
+    parser.add_argument(
+        "-cam", "--condition-allele-map", help="Path to the condition allele map input file", type=str, required=True
+    )
+    parser.add_argument("-a", "--alleles", help="Path to the allele input file", type=str, required=True)
+    parser.add_argument("-m", "--method", help="Used epitope prediction method", type=str, required=True)
+
+    # OUTPUT FILES
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        help=(
+            "Path to the output directory for the prediction score distributions, entity binding ratios and stats "
+            "(prediction_scores.allele_*.tsv, entity_binding_ratios.allele_*.tsv and stats.txt)"
+        ),
+        type=str,
+        required=True,
+    )
+
+    # PARAMETERS
+    parser.add_argument(
+        "-pc",
+        "--chunk-size",
+        help=(
+            "Chunk size with respect to peptide_ids used for internal processing to limit memory usage. Default: 500000"
+        ),
+        type=int,
+        default=500000,
+    )
+    parser.add_argument(
+        "-sst",
+        "--syfpeithi_score_threshold",
+        help=("Threshold for binder/non-binder calling when using SYFPEITHI epitope prediction method. Default: 0.5"),
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        "-mst",
+        "--mhcf_mhcn_score_threshold",
+        help=(
+            "Threshold for binder/non-binder calling when using MHCflurry or MHCnuggets epitope prediction methods. Default: 0.426"
+        ),
+        type=float,
+        default=0.426,
+    )
+    parser.add_argument(
+        "-mlld",
+        "--mem_log_level_deep",
+        help="Enable 'deep' option for pandas memory usage output ('deep' enables accurate usage values, but increases runtime). Default: None. ",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "-ss",
+        "--stream-sorted",
+        help=(
+            "Read the predictions and the protein peptide occurences chunk-wise, co-iterating both by peptide_id, "
+            "so that only about one chunk of each is held in memory. Both input files must be sorted by peptide_id "
+            "(compact predictions are always read at once). Default: False"
+        ),
+        default=False,
+        action="store_true",
+    )
+
+    return parser.parse_args()
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.mem_log_level_deep:
+        print_mem = "deep"
+    else:
+        print_mem = None
+
+    now = datetime.datetime.now()
+    print("Start date and time : ")
+    print(now.strftime("%Y-%m-%d %H:%M:%S"))
+
+    # Read input files
+    # (predictions and protein_peptide_occs are returned block-wise by peptide_id, see SortedTableStream)
+    prediction_columns = ["peptide_id", "prediction_score", "allele_id"]
+    if args.predictions.endswith(".compact.npz"):
+        # Compact predictions contain the binder calls and prediction score bins instead of the prediction scores
+        predictions, compact = read_compact_predictions(args.predictions)
+        threshold = get_binder_threshold(args.method, args.syfpeithi_score_threshold, args.mhcf_mhcn_score_threshold)
+        if str(compact["method"]) != args.method or float(compact["binder_threshold"]) != threshold:
+            print(
+                "ERROR - The binders of the compact predictions were called for method",
+                compact["method"],
+                "with threshold",
+                compact["binder_threshold"],
+                file=sys.stderr,
+            )
+            sys.exit(2)
+        prediction_columns = ["peptide_id", "binder", "prediction_score_bin", "allele_id"]
+        prediction_chunks = [predictions.sort_values("peptide_id")]
+        bin_edges = compact["bin_edges"]
+    elif args.stream_sorted:
+        # Get the score range for the prediction_score bins (unless the method has known score bounds)
+        min_score, max_score = np.nan, np.nan
+        if args.method not in SCORE_BOUNDS:
+            for chunk in iter_table_chunks(args.predictions, args.chunk_size, columns=["prediction_score"]):
+                min_score = np.fmin(min_score, chunk["prediction_score"].min())
+                max_score = np.fmax(max_score, chunk["prediction_score"].max())
+        prediction_chunks = iter_table_chunks(args.predictions, args.chunk_size, columns=prediction_columns)
+        bin_edges = get_bin_edges(args.method, min_score, max_score, bins=1000)
+    else:
+        predictions = read_table(args.predictions, columns=prediction_columns).sort_values("peptide_id")
+        prediction_chunks = [predictions]
+        bin_edges = get_bin_edges(
+            args.method, predictions["prediction_score"].min(), predictions["prediction_score"].max(), bins=1000
+        )
+    prediction_stream = SortedTableStream("predictions", prediction_chunks, prediction_columns, prepare_predictions)
+    num_bins = max(len(bin_edges) - 1, 0)
+
+    occurrence_columns = ["protein_id", "peptide_id", "count"]
+    if args.stream_sorted:
+        occurrence_chunks = iter_table_chunks(args.protein_peptide_occ, args.chunk_size, columns=occurrence_columns)
+    else:
+        occurrence_chunks = [read_table(args.protein_peptide_occ, columns=occurrence_columns).sort_values("peptide_id")]
+    occurrence_stream = SortedTableStream(
+        "protein peptide occurences", occurrence_chunks, occurrence_columns, prepare_protein_peptide_occs
+    )
+
+    entities_proteins_occs = read_table(args.entities_proteins_occ, columns=["entity_id", "protein_id"])
+    entities_proteins_occs["entity_id"] = pd.to_numeric(entities_proteins_occs["entity_id"], downcast="unsigned")
+    entities_proteins_occs["protein_id"] = pd.to_numeric(entities_proteins_occs["protein_id"], downcast="unsigned")
+
+    microbiomes_entities_occs = read_table(
+        args.microbiomes_entities_occ, columns=["microbiome_id", "entity_id", "entity_weight"]
+    )
+    microbiomes_entities_occs["microbiome_id"] = pd.to_numeric(
+        microbiomes_entities_occs["microbiome_id"], downcast="unsigned"
+    )
+    microbiomes_entities_occs["entity_id"] = pd.to_numeric(microbiomes_entities_occs["entity_id"], downcast="unsigned")
+    microbiomes_entities_occs["entity_weight"] = pd.to_numeric(
+        microbiomes_entities_occs["entity_weight"], downcast="float"
+    )
+
+    conditions = pd.read_csv(args.conditions, sep="\t")
+    conditions["condition_id"] = pd.to_numeric(conditions["condition_id"], downcast="unsigned")
+    conditions["microbiome_id"] = pd.to_numeric(conditions["microbiome_id"], downcast="unsigned")
+
+    condition_allele_map = pd.read_csv(args.condition_allele_map, sep="\t")
+    condition_allele_map["condition_id"] = pd.to_numeric(condition_allele_map["condition_id"], downcast="unsigned")
+    condition_allele_map["allele_id"] = pd.to_numeric(condition_allele_map["allele_id"], downcast="unsigned")
+
+    alleles = pd.read_csv(args.alleles, sep="\t")
+    alleles["allele_id"] = pd.to_numeric(alleles["allele_id"], downcast="unsigned")
+
+    # Create output directory if it doesn't exist
+    if os.path.exists(args.outdir) and not os.path.isdir(args.outdir):
+        print("ERROR - The target path is not a directory", file=sys.stderr)
+        sys.exit(2)
+    elif not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    print("Prepare df with protein info ...", flush=True)
+    # Prepare df for joining protein information
+    protein_info = (
+        microbiomes_entities_occs.merge(conditions)
+        .drop(columns="microbiome_id")
+        .merge(condition_allele_map)
+        .drop(columns="condition_id")
+        .merge(entities_proteins_occs)
+    )
+    # -> protein_id, entity_id, entity_weight, condition_name, allele_id
+    # merged against condition_allele_map to keep only entities, and thus proteins, for which a prediction is requested for the current allele
+    print("\nInfo: protein_info", flush=True)
+    protein_info.info(verbose=False, memory_usage=print_mem)
+
+    # Index the combinations of entity_id, allele_id, condition_name and entity_weight in the order of the entity
+    # binding ratio results, so that all aggregations can be accumulated into dense arrays
+    group_columns = ["entity_id", "allele_id", "condition_name", "entity_weight"]
+    entity_results = protein_info[group_columns].drop_duplicates().sort_values(group_columns, ignore_index=True)
+    protein_info = protein_info.merge(entity_results.reset_index(names="group"))[["protein_id", "allele_id", "group"]]
+    # -> protein_id, allele_id, group
+
+    # Rows of the alleles and conditions in the score distribution
+    allele_ids = pd.Index(alleles["allele_id"])
+    condition_names = np.sort(conditions["condition_name"].unique())
+    group_conditions = np.searchsorted(condition_names, entity_results["condition_name"].to_numpy())
+    group_entity_weights = entity_results["entity_weight"].to_numpy(dtype=np.float64)
+
+    # Proteins of the conditions for the stats, with the number of entities each protein is counted for
+    conditions_proteins = (
+        conditions[["microbiome_id"]]
+        .reset_index(names="condition")
+        .merge(microbiomes_entities_occs[["microbiome_id", "entity_id"]])
+        .merge(entities_proteins_occs)[["condition", "protein_id"]]
+    )
+    # -> condition (row in conditions), protein_id
+    unique_protein_counts = np.bincount(
+        conditions_proteins.drop_duplicates()["condition"], minlength=len(conditions)
+    ).astype(np.int64)
+    conditions_proteins = conditions_proteins.groupby(["protein_id", "condition"]).size().reset_index(name="entities")
+    # -> protein_id, condition, entities
+
+    # Aggregations: weight sums per allele, condition and prediction_score bin, peptide and binder counts per entity,
+    # allele and condition (group) and the peptide counts of the conditions
+    score_distribution = np.zeros((len(allele_ids), len(condition_names), num_bins))
+    count_binders = np.zeros(len(entity_results), dtype=np.int64)
+    count_peptides = np.zeros(len(entity_results), dtype=np.int64)
+    total_peptide_counts = np.zeros(len(conditions), dtype=np.int64)
+    unique_peptide_counts = np.zeros(len(conditions), dtype=np.int64)
+    all_conditions_unique_peptide_count = 0
+
+    # Process predictions and protein_peptide_occs chunk-wise based on peptide_ids
+    # (predictions chunk can contain more than chunk_size rows due to multiple alleles)
+    for i in itertools.count(0, args.chunk_size):
+        if prediction_stream.finished() and occurrence_stream.finished():
+            break
+        print("\nChunk peptide_ids: ", i, " - ", i + args.chunk_size - 1)
+
+        now = datetime.datetime.now()
+        print("Time: ...")
+        print(now.strftime("%Y-%m-%d %H:%M:%S"))
+
+        predictions = prediction_stream.take(i + args.chunk_size - 1)
+        protein_peptide_occs = occurrence_stream.take(i + args.chunk_size - 1)
+        print("\nInfo: predictions", flush=True)
+        predictions.info(verbose=False, memory_usage=print_mem)
+        print("\nInfo: protein_peptide_occs", flush=True)
+        protein_peptide_occs.info(verbose=False, memory_usage=print_mem)
+
+        # Stats: count the peptides of the conditions
+        # (all occurences of a peptide are within the same chunk)
+        condition_peptides = protein_peptide_occs.reset_index(names="peptide_id").merge(conditions_proteins)
+        total_peptide_counts += np.bincount(
+            condition_peptides["condition"],
+            weights=condition_peptides["count"].to_numpy(dtype=np.int64) * condition_peptides["entities"].to_numpy(),
+            minlength=len(conditions),
+        ).astype(np.int64)
+        unique_peptide_counts += np.bincount(
+            condition_peptides[["peptide_id", "condition"]].drop_duplicates()["condition"], minlength=len(conditions)
+        )
+        all_conditions_unique_peptide_count += protein_peptide_occs.index.nunique()
+
+        # Join predictions with protein_ids and further protein info
+        data = predictions.join(protein_peptide_occs).merge(protein_info)  # based on protein_id, allele_id
+        # -> index, prediction_score (or binder and prediction_score_bin), allele_id, protein_id, count, group
+        groups = data["group"].to_numpy()
+        counts = data["count"].to_numpy(dtype=np.int64)
+
+        # Entity binding ratios: call binder based on prediction_score (unless already called in the compact
+        # predictions) and count total number of peptides and number of binders for each entity, allele and condition
+        # (compare in double precision, the threshold would otherwise be rounded to the float32 scores)
+        if "binder" in data:
+            binder = data["binder"].to_numpy(dtype=bool)
+        else:
+            binder = call_binder(
+                data["prediction_score"].to_numpy(dtype=np.float64),
+                method=args.method,
+                syfpeithi_score_threshold=args.syfpeithi_score_threshold,
+                mhcfn_score_threshold=args.mhcf_mhcn_score_threshold,
+            )
+        count_peptides += np.bincount(groups, weights=counts, minlength=len(entity_results)).astype(np.int64)
+        count_binders += np.bincount(groups[binder], weights=counts[binder], minlength=len(entity_results)).astype(
+            np.int64
+        )
+
+        # Score distribution: assign prediction_scores to the bins and add up the weights (entity_weights * counts)
+        if "prediction_score_bin" in data:
+            score_bins = data["prediction_score_bin"].to_numpy(dtype=np.int64)
+            score_bins[score_bins == NO_SCORE_BIN] = -1
+        else:
+            score_bins = get_score_bins(data["prediction_score"].to_numpy(), bin_edges)
+        binned = score_bins >= 0
+        index = np.ravel_multi_index(
+            (
+                allele_ids.get_indexer(data["allele_id"])[binned],
+                group_conditions[groups[binned]],
+                score_bins[binned],
+            ),
+            score_distribution.shape,
+        )
+        score_distribution += np.bincount(
+            index, weights=(group_entity_weights[groups] * counts)[binned], minlength=score_distribution.size
+        ).reshape(score_distribution.shape)
+
+    # Write out score distributions for each allele
+    # (for the sake of simplicity, just use bin center for plotting, anyway smoothed for violin plots)
+    bin_centers = pd.cut([], bins=bin_edges).categories.mid.to_numpy() if num_bins else np.empty(0)
+    for i, allele_id in enumerate(allele_ids):
+        bin_rows, condition_rows = np.nonzero(score_distribution[i].T)
+        pd.DataFrame(
+            {
+                "prediction_score": bin_centers[bin_rows],
+                "condition_name": condition_names[condition_rows],
+                "weight_sum": score_distribution[i].T[bin_rows, condition_rows].astype(np.float32),
+            }
+        ).to_csv(
+            os.path.join(args.outdir, "prediction_scores.allele_" + str(allele_id) + ".tsv"), sep="\t", index=False
+        )
+
+    # Write out entity binding ratios for each allele (of combinations with predictions)
+    entity_results["count_binders"] = count_binders
+    entity_results["count_peptides"] = count_peptides
+    entity_results = entity_results[entity_results["count_peptides"] > 0].copy()
+    entity_results["binding_rate"] = entity_results["count_binders"] / entity_results["count_peptides"]
+    print("\nInfo: entity_results", flush=True)
+    entity_results.info(verbose=False, memory_usage=print_mem)
+    for allele_id in alleles.allele_id:
+        with open(os.path.join(args.outdir, "entity_binding_ratios.allele_" + str(allele_id) + ".tsv"), "w") as outfile:
+            entity_results[entity_results.allele_id == allele_id][
+                ["condition_name", "binding_rate", "entity_weight"]
+            ].to_csv(outfile, sep="\t", index=False, header=True)
+
+    # Write out stats (unique proteins, total peptides and unique peptides per condition)
+    with open(os.path.join(args.outdir, "stats.txt"), "w") as outfile:
+        for i, condition_name in enumerate(conditions["condition_name"]):
+            print("Condition name:", condition_name, file=outfile, sep="\t")
+            print("Unique proteins:", unique_protein_counts[i], file=outfile, sep="\t")
+            print("Total peptides:", total_peptide_counts[i], file=outfile, sep="\t")
+            print("Unique peptides:", unique_peptide_counts[i], file=outfile, sep="\t")
+            print(file=outfile)
+        print(file=outfile)
+        print("Unique peptides across all conditions:", all_conditions_unique_peptide_count, file=outfile, sep="\t")
+
+    print("Done!", flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,11 +2,26 @@
 
 import argparse
 import datetime
+import itertools
 import os
 import sys
 
+import numpy as np
 import pandas as pd
 
+from metapep_utils import (
+    SortedTableStream,
+    call_binder,
+    get_binder_threshold,
+    iter_table_chunks,
+    lookup_peptide_index,
+    prepare_predictions,
+    prepare_protein_peptide_occs,
+    read_compact_predictions,
+    read_peptide_index,
+    read_table,
+)
+
 ####################################################################################################
 
 
@@ -15,7 +30,13 @@ def parse_args(args=None):
     parser = argparse.ArgumentParser(description="Prepare entity binding rates for plotting.")
 
     # INPUT FILES
-    parser.add_argument("-p", "--predictions", help="Path to the predictions input file", type=str, required=True)
+    parser.add_argument(
+        "-p",
+        "--predictions",
+        help="Path to the predictions input file or to a compact predictions file (.compact.npz) written by compact_predictions.py",
+        type=str,
+        required=True,
+    )
     parser.add_argument(
         "-ppo",
         "--protein-peptide-occ",
@@ -43,6 +64,16 @@ def parse_args(args=None):
     )
     parser.add_argument("-a", "--alleles", help="Path to the allele input file", type=str, required=True)
     parser.add_argument("-m", "--method", help="Used epitope prediction method", type=str, required=True)
+    parser.add_argument(
+        "-pi",
+        "--peptide-index",
+        help=(
+            "Path to the peptide index directory written by build_peptide_index.py. If given, the predictions are "
+            "joined with the precomputed peptide contributions of the index instead of the protein peptide "
+            "occurences, entity protein occurences, microbiome entity occurences, conditions and condition allele map."
+        ),
+        type=str,
+    )
 
     # OUTPUT FILES
     parser.add_argument("-o", "--outdir", help="Path to the output directory", type=str, required=True)
@@ -80,25 +111,21 @@ def parse_args(args=None):
         default=False,
         action="store_true",
     )
+    parser.add_argument(
+        "-ss",
+        "--stream-sorted",
+        help=(
+            "Read the predictions and the protein peptide occurences chunk-wise, co-iterating both by peptide_id, "
+            "so that only about one chunk of each is held in memory. Both input files must be sorted by peptide_id "
+            "(compact predictions are always read at once). Default: False"
+        ),
+        default=False,
+        action="store_true",
+    )
 
     return parser.parse_args()
 
 
-def call_binder(score, method, syfpeithi_score_threshold, mhcfn_score_threshold):
-    """
-    Scoring threshold is based on the nf-core/epitopeprediction pipeline.
-    For SYFPEITHI the scoring threshold is a "half of maximum score". After
-    normalization the highest achievable score is 1. For MHCflurry and
-    MHCnuggets the score is an 0 to 1 scoring base on the
-    affinity score (IC50) and is calculated by: 1-log_50000(affinity_score)
-    in this scale the old threshold of 500 is: 0.426 and the higher the better.
-    """
-    if method == "syfpeithi":
-        return score >= syfpeithi_score_threshold
-    else:
-        return score >= mhcfn_score_threshold
-
-
 def main(args=None):
     args = parse_args(args)
 
@@ -107,36 +134,28 @@ def main(args=None):
     print(now.strftime("%Y-%m-%d %H:%M:%S"))
 
     # Read input files
-    predictions = pd.read_csv(args.predictions, sep="\t", index_col="peptide_id").sort_index()
-    predictions["allele_id"] = pd.to_numeric(predictions["allele_id"], downcast="unsigned")
-    predictions["prediction_score"] = pd.to_numeric(predictions["prediction_score"], downcast="float")
-    # NOTE could be read in chunk-wise if this gets bottleneck.
-    # E.g. sort and split before by peptide_ids into chunks, read in as file list, process chunk-wise (protein_peptide_occs accordingly)
-    # (would decrease code readability though)
-    protein_peptide_occs = pd.read_csv(args.protein_peptide_occ, sep="\t", index_col="peptide_id").sort_index()
-    protein_peptide_occs["protein_id"] = pd.to_numeric(protein_peptide_occs["protein_id"], downcast="unsigned")
-    protein_peptide_occs["count"] = pd.to_numeric(protein_peptide_occs["count"], downcast="unsigned")
-
-    entities_proteins_occs = pd.read_csv(args.entities_proteins_occ, sep="\t")
-    entities_proteins_occs["entity_id"] = pd.to_numeric(entities_proteins_occs["entity_id"], downcast="unsigned")
-    entities_proteins_occs["protein_id"] = pd.to_numeric(entities_proteins_occs["protein_id"], downcast="unsigned")
-
-    microbiomes_entities_occs = pd.read_csv(args.microbiomes_entities_occ, sep="\t")
-    microbiomes_entities_occs["microbiome_id"] = pd.to_numeric(
-        microbiomes_entities_occs["microbiome_id"], downcast="unsigned"
-    )
-    microbiomes_entities_occs["entity_id"] = pd.to_numeric(microbiomes_entities_occs["entity_id"], downcast="unsigned")
-    microbiomes_entities_occs["entity_weight"] = pd.to_numeric(
-        microbiomes_entities_occs["entity_weight"], downcast="float"
-    )
-
-    conditions = pd.read_csv(args.conditions, sep="\t")
-    conditions["condition_id"] = pd.to_numeric(conditions["condition_id"], downcast="unsigned")
-    conditions["microbiome_id"] = pd.to_numeric(conditions["microbiome_id"], downcast="unsigned")
-
-    condition_allele_map = pd.read_csv(args.condition_allele_map, sep="\t")
-    condition_allele_map["condition_id"] = pd.to_numeric(condition_allele_map["condition_id"], downcast="unsigned")
-    condition_allele_map["allele_id"] = pd.to_numeric(condition_allele_map["allele_id"], downcast="unsigned")
+    # (predictions and protein_peptide_occs are returned block-wise by peptide_id, see SortedTableStream)
+    prediction_columns = ["peptide_id", "prediction_score", "allele_id"]
+    if args.predictions.endswith(".compact.npz"):
+        # Compact predictions contain the binder calls instead of the prediction scores
+        predictions, compact = read_compact_predictions(args.predictions, columns=["binder"])
+        threshold = get_binder_threshold(args.method, args.syfpeithi_score_threshold, args.mhcf_mhcn_score_threshold)
+        if str(compact["method"]) != args.method or float(compact["binder_threshold"]) != threshold:
+            print(
+                "ERROR - The binders of the compact predictions were called for method",
+                compact["method"],
+                "with threshold",
+                compact["binder_threshold"],
+                file=sys.stderr,
+            )
+            sys.exit(2)
+        prediction_columns = ["peptide_id", "binder", "allele_id"]
+        prediction_chunks = [predictions.sort_values("peptide_id")]
+    elif args.stream_sorted:
+        prediction_chunks = iter_table_chunks(args.predictions, args.chunk_size, columns=prediction_columns)
+    else:
+        prediction_chunks = [read_table(args.predictions, columns=prediction_columns).sort_values("peptide_id")]
+    prediction_stream = SortedTableStream("predictions", prediction_chunks, prediction_columns, prepare_predictions)
 
     alleles = pd.read_csv(args.alleles, sep="\t")
     alleles["allele_id"] = pd.to_numeric(alleles["allele_id"], downcast="unsigned")
@@ -146,11 +165,6 @@ def main(args=None):
     else:
         print_mem = None
 
-    print("\nInfo: predictions", flush=True)
-    predictions.info(verbose=False, memory_usage=print_mem)
-    print("\nInfo: protein_peptide_occs", flush=True)
-    protein_peptide_occs.info(verbose=False, memory_usage=print_mem)
-
     # Create output directory if it doesn't exist
     if os.path.exists(args.outdir) and not os.path.isdir(args.outdir):
         print("ERROR - The target path is not a directory", file=sys.stderr)
@@ -158,25 +172,78 @@ def main(args=None):
     elif not os.path.exists(args.outdir):
         os.makedirs(args.outdir)
 
-    print("Prepare df with protein info ...", file=sys.stderr, flush=True, end="")
-    # Prepare df for joining protein information
-    protein_info = (
-        microbiomes_entities_occs.merge(conditions)
-        .drop(columns="microbiome_id")
-        .merge(condition_allele_map)
-        .drop(columns="condition_id")
-        .merge(entities_proteins_occs)
-    )
-    # -> protein_id, entity_id, entity_weight, condition_name, allele_id
-    # merged against condition_allele_map to keep only entities, and thus proteins, for which a prediction is requested for the current allele
-    print("\nInfo: protein_info", flush=True)
-    protein_info.info(verbose=False, memory_usage=print_mem)
+    if args.peptide_index:
+        # The peptide index replaces the protein peptide occurences and the protein info
+        peptide_index, entity_results = read_peptide_index(args.peptide_index)
+    else:
+        occurrence_columns = ["protein_id", "peptide_id", "count"]
+        if args.stream_sorted:
+            occurrence_chunks = iter_table_chunks(args.protein_peptide_occ, args.chunk_size, columns=occurrence_columns)
+        else:
+            occurrence_chunks = [
+                read_table(args.protein_peptide_occ, columns=occurrence_columns).sort_values("peptide_id")
+            ]
+        occurrence_stream = SortedTableStream(
+            "protein peptide occurences", occurrence_chunks, occurrence_columns, prepare_protein_peptide_occs
+        )
+
+        entities_proteins_occs = read_table(args.entities_proteins_occ, columns=["entity_id", "protein_id"])
+        entities_proteins_occs["entity_id"] = pd.to_numeric(entities_proteins_occs["entity_id"], downcast="unsigned")
+        entities_proteins_occs["protein_id"] = pd.to_numeric(entities_proteins_occs["protein_id"], downcast="unsigned")
+
+        microbiomes_entities_occs = read_table(
+            args.microbiomes_entities_occ, columns=["microbiome_id", "entity_id", "entity_weight"]
+        )
+        microbiomes_entities_occs["microbiome_id"] = pd.to_numeric(
+            microbiomes_entities_occs["microbiome_id"], downcast="unsigned"
+        )
+        microbiomes_entities_occs["entity_id"] = pd.to_numeric(
+            microbiomes_entities_occs["entity_id"], downcast="unsigned"
+        )
+        microbiomes_entities_occs["entity_weight"] = pd.to_numeric(
+            microbiomes_entities_occs["entity_weight"], downcast="float"
+        )
+
+        conditions = pd.read_csv(args.conditions, sep="\t")
+        conditions["condition_id"] = pd.to_numeric(conditions["condition_id"], downcast="unsigned")
+        conditions["microbiome_id"] = pd.to_numeric(conditions["microbiome_id"], downcast="unsigned")
+
+        condition_allele_map = pd.read_csv(args.condition_allele_map, sep="\t")
+        condition_allele_map["condition_id"] = pd.to_numeric(condition_allele_map["condition_id"], downcast="unsigned")
+        condition_allele_map["allele_id"] = pd.to_numeric(condition_allele_map["allele_id"], downcast="unsigned")
+
+        print("Prepare df with protein info ...", file=sys.stderr, flush=True, end="")
+        # Prepare df for joining protein information
+        protein_info = (
+            microbiomes_entities_occs.merge(conditions)
+            .drop(columns="microbiome_id")
+            .merge(condition_allele_map)
+            .drop(columns="condition_id")
+            .merge(entities_proteins_occs)
+        )
+        # -> protein_id, entity_id, entity_weight, condition_name, allele_id
+        # merged against condition_allele_map to keep only entities, and thus proteins, for which a prediction is requested for the current allele
+        print("\nInfo: protein_info", flush=True)
+        protein_info.info(verbose=False, memory_usage=print_mem)
+
+        # Index the combinations of entity_id, allele_id, condition_name and entity_weight in the order of the results,
+        # so that the peptide and binder counts of each combination can be accumulated into dense arrays
+        group_columns = ["entity_id", "allele_id", "condition_name", "entity_weight"]
+        entity_results = protein_info[group_columns].drop_duplicates().sort_values(group_columns, ignore_index=True)
+        protein_info = protein_info.merge(entity_results.reset_index(names="group"))[
+            ["protein_id", "allele_id", "group"]
+        ]
+        # -> protein_id, allele_id, group
+
+    group_allele_ids = entity_results["allele_id"].to_numpy()
+    count_binders = np.zeros(len(entity_results), dtype=np.int64)
+    count_peptides = np.zeros(len(entity_results), dtype=np.int64)
 
     # Process predictions chunk-wise based on peptide_ids
     # (predictions chunk can contain more than chunk_size rows due to multiple alleles)
-    entity_results = pd.DataFrame()
-    max_peptide_id = predictions.index.max()
-    for i in range(0, max_peptide_id, args.chunk_size):
+    for i in itertools.count(0, args.chunk_size):
+        if prediction_stream.finished():
+            break
         print("\nChunk peptide_ids: ", i, " - ", i + args.chunk_size - 1)
 
         now = datetime.datetime.now()
@@ -184,57 +251,48 @@ def main(args=None):
         print(now.strftime("%Y-%m-%d %H:%M:%S"))
 
         # Join predictions with protein_ids and further protein info
-        # NOTE would be faster to process directly respective chunks (see comment above)
-        data = (
-            predictions[(predictions.index >= i) & (predictions.index < i + args.chunk_size)]
-            .join(
-                protein_peptide_occs[
-                    (protein_peptide_occs.index >= i) & (protein_peptide_occs.index < i + args.chunk_size)
-                ]
+        predictions = prediction_stream.take(i + args.chunk_size - 1)
+        print("\nInfo: predictions", flush=True)
+        predictions.info(verbose=False, memory_usage=print_mem)
+        if args.peptide_index:
+            rows, groups, counts = lookup_peptide_index(
+                peptide_index, group_allele_ids, predictions.index.to_numpy(), predictions["allele_id"].to_numpy()
+            )
+            data = predictions.iloc[rows].assign(group=groups, count=counts)
+        else:
+            protein_peptide_occs = occurrence_stream.take(i + args.chunk_size - 1)
+            print("\nInfo: protein_peptide_occs", flush=True)
+            protein_peptide_occs.info(verbose=False, memory_usage=print_mem)
+            data = predictions.join(protein_peptide_occs).merge(protein_info)  # based on protein_id, allele_id
+        # -> index, prediction_score (or binder), allele_id, [protein_id,] count, group
+
+        # Call binder based on prediction_score (unless already called in the compact predictions)
+        # (compare in double precision, the threshold would otherwise be rounded to the float32 scores)
+        if "binder" in data:
+            binder = data["binder"].to_numpy(dtype=bool)
+        else:
+            binder = call_binder(
+                data["prediction_score"].to_numpy(dtype=np.float64),
+                method=args.method,
+                syfpeithi_score_threshold=args.syfpeithi_score_threshold,
+                mhcfn_score_threshold=args.mhcf_mhcn_score_threshold,
             )
-            .merge(protein_info)
-        )  # based on protein_id, allele_id
-        # -> index, prediction_score, allele_id, protein_id, count, entity_id, entity_weight, condition_name
-        # (protein_id could be dropped, but no big impact here)
-
-        # Call binder based on prediction_score
-        data["binder"] = data["prediction_score"].apply(
-            call_binder,
-            method=args.method,
-            syfpeithi_score_threshold=args.syfpeithi_score_threshold,
-            mhcfn_score_threshold=args.mhcf_mhcn_score_threshold,
-        )
-        data.drop(columns="prediction_score", inplace=True)
 
         # Count total number of peptides and number of binders for each entity, allele and condition (including multiple counts within proteins)
-        # Create extra column containing only counts for peptides that are classified as 'binder' to allow efficient aggregation
-        data["binder_count"] = 0
-        data.loc[data["binder"], "binder_count"] = data["count"]
-        data = (
-            data.groupby(["entity_id", "allele_id", "condition_name", "entity_weight"], group_keys=False)
-            .agg(
-                count_binders=pd.NamedAgg(column="binder_count", aggfunc="sum"),
-                count_peptides=pd.NamedAgg(column="count", aggfunc="sum"),
-            )
-            .reset_index()
+        groups = data["group"].to_numpy()
+        counts = data["count"].to_numpy(dtype=np.int64)
+        count_peptides += np.bincount(groups, weights=counts, minlength=len(entity_results)).astype(np.int64)
+        count_binders += np.bincount(groups[binder], weights=counts[binder], minlength=len(entity_results)).astype(
+            np.int64
         )
-        # -> index, entity_id, allele_id, condition_name, entity_weight, count_binders, count_peptides
-
-        # Append to entity results
-        entity_results = pd.concat([entity_results, data], ignore_index=True)
-        print("\nInfo: entity_results", flush=True)
-        entity_results.info(verbose=False, memory_usage=print_mem)
 
-    # Combine entity results from different chunks
-    entity_results = (
-        entity_results.groupby(["entity_id", "allele_id", "condition_name", "entity_weight"], group_keys=False)[
-            ["count_binders", "count_peptides"]
-        ]
-        .sum()
-        .reset_index()
-    )
+    # Keep combinations with predictions
+    entity_results["count_binders"] = count_binders
+    entity_results["count_peptides"] = count_peptides
+    entity_results = entity_results[entity_results["count_peptides"] > 0].copy()
     entity_results["binding_rate"] = entity_results["count_binders"] / entity_results["count_peptides"]
-    data.drop(columns=["count_binders", "count_peptides"], inplace=True)
+    print("\nInfo: entity_results", flush=True)
+    entity_results.info(verbose=False, memory_usage=print_mem)
 
     # Write out results for each allele
     for allele_id in alleles.allele_id:
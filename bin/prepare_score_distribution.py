@@ -8,6 +8,16 @@ import sys
 import numpy as np
 import pandas as pd
 
+from metapep_utils import (
+    NO_SCORE_BIN,
+    get_bin_edges,
+    get_score_bins,
+    lookup_peptide_index,
+    read_compact_predictions,
+    read_peptide_index,
+    read_table,
+)
+
 ####################################################################################################
 
 
@@ -16,7 +26,13 @@ def parse_args(args=None):
     parser = argparse.ArgumentParser(description="Prepare prediction score distribution for plotting.")
 
     # INPUT FILES
-    parser.add_argument("-p", "--predictions", help="Path to the predictions input file", type=str, required=True)
+    parser.add_argument(
+        "-p",
+        "--predictions",
+        help="Path to the predictions input file or to a compact predictions file (.compact.npz) written by compact_predictions.py",
+        type=str,
+        required=True,
+    )
     parser.add_argument(
         "-ppo",
         "--protein-peptide-occ",
@@ -43,6 +59,17 @@ def parse_args(args=None):
         "-cam", "--condition-allele-map", help="Path to the condition allele map input file", type=str, required=True
     )
     parser.add_argument("-a", "--alleles", help="Path to the allele input file", type=str, required=True)
+    parser.add_argument("-m", "--method", help="Used epitope prediction method", type=str, required=True)
+    parser.add_argument(
+        "-pi",
+        "--peptide-index",
+        help=(
+            "Path to the peptide index directory written by build_peptide_index.py. If given, the predictions are "
+            "joined with the precomputed peptide contributions of the index instead of the protein peptide "
+            "occurences, entity protein occurences, microbiome entity occurences, conditions and condition allele map."
+        ),
+        type=str,
+    )
 
     # OUTPUT FILES
     parser.add_argument("-o", "--outdir", help="Path to the output directory", type=str, required=True)
@@ -80,42 +107,74 @@ def main(args=None):
     print(now.strftime("%Y-%m-%d %H:%M:%S"))
 
     # Read input files
-    predictions = pd.read_csv(args.predictions, sep="\t", index_col="peptide_id").sort_index()
+    if args.predictions.endswith(".compact.npz"):
+        # Compact predictions contain the prediction score bins instead of the prediction scores
+        predictions, compact = read_compact_predictions(args.predictions, columns=["prediction_score_bin"])
+        # predictions without score are not part of the score distribution
+        predictions = predictions[predictions["prediction_score_bin"] != NO_SCORE_BIN]
+        predictions = predictions.set_index("peptide_id").sort_index()
+        predictions["prediction_score_bin"] = pd.to_numeric(predictions["prediction_score_bin"], downcast="unsigned")
+    else:
+        predictions = (
+            read_table(args.predictions, columns=["peptide_id", "prediction_score", "allele_id"])
+            .set_index("peptide_id")
+            .sort_index()
+        )
+        predictions["prediction_score"] = pd.to_numeric(predictions["prediction_score"], downcast="float")
     predictions["allele_id"] = pd.to_numeric(predictions["allele_id"], downcast="unsigned")
-    predictions["prediction_score"] = pd.to_numeric(predictions["prediction_score"], downcast="float")
-
-    protein_peptide_occs = pd.read_csv(args.protein_peptide_occ, sep="\t", index_col="peptide_id").sort_index()
-    protein_peptide_occs["protein_id"] = pd.to_numeric(protein_peptide_occs["protein_id"], downcast="unsigned")
-    protein_peptide_occs["count"] = pd.to_numeric(protein_peptide_occs["count"], downcast="unsigned")
-
-    entities_proteins_occs = pd.read_csv(args.entities_proteins_occ, sep="\t")
-    entities_proteins_occs["entity_id"] = pd.to_numeric(entities_proteins_occs["entity_id"], downcast="unsigned")
-    entities_proteins_occs["protein_id"] = pd.to_numeric(entities_proteins_occs["protein_id"], downcast="unsigned")
-
-    microbiomes_entities_occs = pd.read_csv(args.microbiomes_entities_occ, sep="\t")
-    microbiomes_entities_occs["microbiome_id"] = pd.to_numeric(
-        microbiomes_entities_occs["microbiome_id"], downcast="unsigned"
-    )
-    microbiomes_entities_occs["entity_id"] = pd.to_numeric(microbiomes_entities_occs["entity_id"], downcast="unsigned")
-    microbiomes_entities_occs["entity_weight"] = pd.to_numeric(
-        microbiomes_entities_occs["entity_weight"], downcast="float"
-    )
 
     conditions = pd.read_csv(args.conditions, sep="\t")
     conditions["condition_id"] = pd.to_numeric(conditions["condition_id"], downcast="unsigned")
     conditions["microbiome_id"] = pd.to_numeric(conditions["microbiome_id"], downcast="unsigned")
 
-    condition_allele_map = pd.read_csv(args.condition_allele_map, sep="\t")
-    condition_allele_map["condition_id"] = pd.to_numeric(condition_allele_map["condition_id"], downcast="unsigned")
-    condition_allele_map["allele_id"] = pd.to_numeric(condition_allele_map["allele_id"], downcast="unsigned")
-
     alleles = pd.read_csv(args.alleles, sep="\t")
     alleles["allele_id"] = pd.to_numeric(alleles["allele_id"], downcast="unsigned")
 
+    # Rows of the alleles and conditions in the score distribution
+    allele_ids = pd.Index(alleles["allele_id"])
+    condition_names = np.sort(conditions["condition_name"].unique())
+
+    if args.peptide_index:
+        # The peptide index replaces the protein peptide occurences and the protein info
+        peptide_index, groups = read_peptide_index(args.peptide_index)
+        group_allele_ids = groups["allele_id"].to_numpy()
+        group_conditions = np.searchsorted(condition_names, groups["condition_name"].to_numpy())
+        group_entity_weights = groups["entity_weight"].to_numpy()
+    else:
+        protein_peptide_occs = (
+            read_table(args.protein_peptide_occ, columns=["protein_id", "peptide_id", "count"])
+            .set_index("peptide_id")
+            .sort_index()
+        )
+        protein_peptide_occs["protein_id"] = pd.to_numeric(protein_peptide_occs["protein_id"], downcast="unsigned")
+        protein_peptide_occs["count"] = pd.to_numeric(protein_peptide_occs["count"], downcast="unsigned")
+
+        entities_proteins_occs = read_table(args.entities_proteins_occ, columns=["entity_id", "protein_id"])
+        entities_proteins_occs["entity_id"] = pd.to_numeric(entities_proteins_occs["entity_id"], downcast="unsigned")
+        entities_proteins_occs["protein_id"] = pd.to_numeric(entities_proteins_occs["protein_id"], downcast="unsigned")
+
+        microbiomes_entities_occs = read_table(
+            args.microbiomes_entities_occ, columns=["microbiome_id", "entity_id", "entity_weight"]
+        )
+        microbiomes_entities_occs["microbiome_id"] = pd.to_numeric(
+            microbiomes_entities_occs["microbiome_id"], downcast="unsigned"
+        )
+        microbiomes_entities_occs["entity_id"] = pd.to_numeric(
+            microbiomes_entities_occs["entity_id"], downcast="unsigned"
+        )
+        microbiomes_entities_occs["entity_weight"] = pd.to_numeric(
+            microbiomes_entities_occs["entity_weight"], downcast="float"
+        )
+
+        condition_allele_map = pd.read_csv(args.condition_allele_map, sep="\t")
+        condition_allele_map["condition_id"] = pd.to_numeric(condition_allele_map["condition_id"], downcast="unsigned")
+        condition_allele_map["allele_id"] = pd.to_numeric(condition_allele_map["allele_id"], downcast="unsigned")
+
     print("\nInfo: predictions", flush=True)
     predictions.info(verbose=False, memory_usage=print_mem)
-    print("\nInfo: protein_peptide_occs", flush=True)
-    protein_peptide_occs.info(verbose=False, memory_usage=print_mem)
+    if not args.peptide_index:
+        print("\nInfo: protein_peptide_occs", flush=True)
+        protein_peptide_occs.info(verbose=False, memory_usage=print_mem)
 
     # Create output directory if it doesn't exist
     if os.path.exists(args.outdir) and not os.path.isdir(args.outdir):
@@ -124,109 +183,107 @@ def main(args=None):
     elif not os.path.exists(args.outdir):
         os.makedirs(args.outdir)
 
-    # Create prediction_score bin intervals to reduce number of data points for plotting
-    bin_results, bin_edges = pd.cut(predictions["prediction_score"], bins=1000, retbins=True)
-
-    print("Prepare df with protein info ...", flush=True)
-    # Prepare df for joining protein information
-    # (get condition_name, entity_weights and filter for condition entities)
-    protein_info = (
-        microbiomes_entities_occs.merge(conditions)
-        .drop(columns="microbiome_id")
-        .merge(condition_allele_map)
-        .drop(columns="condition_id")
-        .merge(entities_proteins_occs)
-        .drop(columns="entity_id")
-    )
-    # -> protein_id, entity_weight, condition_name, allele_id
-    # merged against condition_allele_map to keep only entities, and thus proteins, for which a prediction is requested for the current allele
-    print("\nInfo: protein_info", flush=True)
-    protein_info.info(verbose=False, memory_usage=print_mem)
-
-    # Prepare output files for each allele
-    outfile_dict = {}
-    for allele_id in alleles.allele_id:
-        outfile = open(os.path.join(args.outdir, "prediction_scores.allele_" + str(allele_id) + ".tsv"), "w")
-        outfile_dict[allele_id] = outfile
-    print_header = ["prediction_score", "condition_name", "weight_sum"]
-
-    try:
-        # Process predictions chunk-wise based on peptide_ids
-        # (predictions chunk can contain more than chunk_size rows due to multiple alleles)
-        max_peptide_id = predictions.index.max()
-        for chunk_start in range(0, max_peptide_id, args.chunk_size):
-            chunk_end = min(chunk_start + args.chunk_size - 1, max_peptide_id)
-            print("\nChunk peptide_ids: ", chunk_start, " - ", chunk_end)
-
-            now = datetime.datetime.now()
-            print("Time: ...")
-            print(now.strftime("%Y-%m-%d %H:%M:%S"))
-
-            data = (
-                predictions[(predictions.index >= chunk_start) & (predictions.index <= chunk_end)]
-                .join(
-                    protein_peptide_occs[
-                        (protein_peptide_occs.index >= chunk_start) & (protein_peptide_occs.index <= chunk_end)
-                    ]
-                )
-                .reset_index(names="peptide_id")
-                .merge(protein_info)
-                .drop(columns="protein_id")
-            )
-            # (merge() might change index, so reset_index(..) before)
-            # -> index, peptide_id, prediction_score, allele_id, count, entity_weight, condition_name
-
-            # Add for each prediction, protein and entity aggregated weights containing entity_weights * counts
-            data["agg_weight"] = data["entity_weight"] * data["count"]
-            data.drop(columns=["entity_weight", "count"], inplace=True)
-
-            print("\nInfo: data after merging protein_info", flush=True)
-            data.info(verbose=False, memory_usage=print_mem)
-
-            data = (
-                data.groupby(["peptide_id", "prediction_score", "condition_name", "allele_id"])["agg_weight"]
-                .sum()
-                .reset_index(name="weight_sum")
-                .drop(columns="peptide_id")
-            )
-            # -> index, prediction_score, condition_name, allele_id, weight_sum
-
-            # NOTE
-            # for each peptide in a condition the weight is computed as follows:
-            # - the sum of all weights of the corresponding entity_weights, each weighted by the number of proteins in which the peptide occurs
-            # - multiple occurrences of the peptide within one protein are counted
-            # if the no entity weights are provided, weight_sum corresponds to the number of peptide occurrences within the condition
-
-            print("\nInfo: final data", flush=True)
-            data.info(verbose=False, memory_usage=print_mem)
-
-            # Assign prediction_scores to precomputed bins, group and sum up weights
-            data["prediction_score_bin"] = pd.cut(data["prediction_score"], bins=bin_edges)
-            data = (
-                data.groupby(["prediction_score_bin", "condition_name", "allele_id"])
-                .agg(
-                    agg_weight=("weight_sum", "sum"),
-                )
-                .reset_index()
+    # Fix the prediction_score bin intervals up front to reduce number of data points for plotting
+    # (compact predictions are already binned and contain the bin edges)
+    if args.predictions.endswith(".compact.npz"):
+        bin_edges = compact["bin_edges"]
+    else:
+        bin_edges = get_bin_edges(
+            args.method, predictions["prediction_score"].min(), predictions["prediction_score"].max(), bins=1000
+        )
+    num_bins = max(len(bin_edges) - 1, 0)
+
+    if not args.peptide_index:
+        print("Prepare df with protein info ...", flush=True)
+        # Prepare df for joining protein information
+        # (get condition_name, entity_weights and filter for condition entities)
+        protein_info = (
+            microbiomes_entities_occs.merge(conditions)
+            .drop(columns="microbiome_id")
+            .merge(condition_allele_map)
+            .drop(columns="condition_id")
+            .merge(entities_proteins_occs)
+            .drop(columns="entity_id")
+        )
+        # -> protein_id, entity_weight, condition_name, allele_id
+        # merged against condition_allele_map to keep only entities, and thus proteins, for which a prediction is requested for the current allele
+        protein_info["condition"] = np.searchsorted(condition_names, protein_info["condition_name"].to_numpy())
+        protein_info.drop(columns="condition_name", inplace=True)
+        print("\nInfo: protein_info", flush=True)
+        protein_info.info(verbose=False, memory_usage=print_mem)
+
+    # Weight sums of the predictions per allele, condition and prediction_score bin
+    score_distribution = np.zeros((len(allele_ids), len(condition_names), num_bins))
+
+    # Process predictions chunk-wise based on peptide_ids
+    # (predictions chunk can contain more than chunk_size rows due to multiple alleles)
+    max_peptide_id = int(predictions.index.max()) if len(predictions) else -1
+    for chunk_start in range(0, max_peptide_id + 1, args.chunk_size):
+        chunk_end = min(chunk_start + args.chunk_size - 1, max_peptide_id)
+        print("\nChunk peptide_ids: ", chunk_start, " - ", chunk_end)
+
+        now = datetime.datetime.now()
+        print("Time: ...")
+        print(now.strftime("%Y-%m-%d %H:%M:%S"))
+
+        chunk_predictions = predictions.loc[chunk_start:chunk_end]
+        if args.peptide_index:
+            rows, chunk_groups, counts = lookup_peptide_index(
+                peptide_index,
+                group_allele_ids,
+                chunk_predictions.index.to_numpy(),
+                chunk_predictions["allele_id"].to_numpy(),
             )
-            # For the sake of simplicity, just use bin center for plotting (anyway smoothed for violin plots)
-            # (todo: think about more elegant way for visualization if necessary)
-            data["prediction_score_bin_center"] = data["prediction_score_bin"].apply(
-                lambda x: np.mean([x.left, x.right])
+            data = chunk_predictions.iloc[rows].assign(
+                count=counts, entity_weight=group_entity_weights[chunk_groups], condition=group_conditions[chunk_groups]
             )
-
-            # Write out results for each allele
-            for allele_id in outfile_dict.keys():
-                data[data.allele_id == allele_id][
-                    ["prediction_score_bin_center", "condition_name", "agg_weight"]
-                ].to_csv(outfile_dict[allele_id], mode="a", sep="\t", index=False, header=print_header)
-            print_header = False
-
-        print("Done!", flush=True)
-
-    finally:
-        for outfile in outfile_dict.values():
-            outfile.close()
+        else:
+            data = chunk_predictions.join(protein_peptide_occs.loc[chunk_start:chunk_end]).merge(protein_info)
+        # -> prediction_score (or prediction_score_bin), allele_id, count, entity_weight, condition
+
+        print("\nInfo: data after merging protein_info", flush=True)
+        data.info(verbose=False, memory_usage=print_mem)
+
+        # NOTE
+        # for each peptide in a condition the weight is computed as follows:
+        # - the sum of all weights of the corresponding entity_weights, each weighted by the number of proteins in which the peptide occurs
+        # - multiple occurrences of the peptide within one protein are counted
+        # if the no entity weights are provided, weight_sum corresponds to the number of peptide occurrences within the condition
+
+        # Assign prediction_scores to the bins and add up the weights
+        if "prediction_score_bin" in data:
+            score_bins = data["prediction_score_bin"].to_numpy(dtype=np.int64)
+        else:
+            score_bins = get_score_bins(data["prediction_score"].to_numpy(), bin_edges)
+        weights = data["entity_weight"].to_numpy(dtype=np.float64) * data["count"].to_numpy(dtype=np.float64)
+        binned = score_bins >= 0
+        index = np.ravel_multi_index(
+            (
+                allele_ids.get_indexer(data["allele_id"])[binned],
+                data["condition"].to_numpy()[binned],
+                score_bins[binned],
+            ),
+            score_distribution.shape,
+        )
+        score_distribution += np.bincount(index, weights=weights[binned], minlength=score_distribution.size).reshape(
+            score_distribution.shape
+        )
+
+    # Write out results for each allele
+    # (for the sake of simplicity, just use bin center for plotting, anyway smoothed for violin plots)
+    bin_centers = pd.cut([], bins=bin_edges).categories.mid.to_numpy() if num_bins else np.empty(0)
+    for i, allele_id in enumerate(allele_ids):
+        bin_rows, condition_rows = np.nonzero(score_distribution[i].T)
+        pd.DataFrame(
+            {
+                "prediction_score": bin_centers[bin_rows],
+                "condition_name": condition_names[condition_rows],
+                "weight_sum": score_distribution[i].T[bin_rows, condition_rows].astype(np.float32),
+            }
+        ).to_csv(
+            os.path.join(args.outdir, "prediction_scores.allele_" + str(allele_id) + ".tsv"), sep="\t", index=False
+        )
+    print("Done!", flush=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sqlite3
+import sys
+
+from metapep_utils import PREDICTION_CACHE_COLUMNS, PREDICTION_CACHE_SCHEMA
+
+####################################################################################################
+
+
+def parse_args(args=None):
+    """Parses the command line arguments specified by the user."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Merge the prediction cache shards written by the individual epytope_predict.py runs into the "
+            "persistent SQLite prediction cache, so that the persistent cache has a single writer."
+        )
+    )
+
+    # INPUT FILES
+    parser.add_argument("-s", "--shards", help="Paths to the prediction cache shards", type=str, nargs="*", default=[])
+
+    # OUTPUT FILES
+    parser.add_argument(
+        "-pc",
+        "--prediction-cache",
+        help="Path to the persistent SQLite prediction cache, which is created within its existing directory if it does not exist",
+        type=str,
+        required=True,
+    )
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    # The cache directory is not created here, so that an inaccessible (e.g. not mounted) directory is not
+    # silently replaced by a new one that is lost with the task
+    cache_dir = os.path.dirname(os.path.abspath(args.prediction_cache))
+    if not os.path.isdir(cache_dir):
+        print(f"ERROR - The directory of the prediction cache {cache_dir} does not exist.", file=sys.stderr)
+        sys.exit(2)
+
+    connection = sqlite3.connect(args.prediction_cache, timeout=600)
+    try:
+        with connection:
+            connection.execute(PREDICTION_CACHE_SCHEMA)
+        for shard in args.shards:
+            print("Processing shard: ", shard, flush=True)
+            connection.execute("ATTACH DATABASE ? AS shard", (shard,))
+            try:
+                # one transaction per shard
+                with connection:
+                    cursor = connection.execute(
+                        f"INSERT OR REPLACE INTO predictions ({PREDICTION_CACHE_COLUMNS}) "
+                        f"SELECT {PREDICTION_CACHE_COLUMNS} FROM shard.predictions"
+                    )
+                print(f"Added {cursor.rowcount} predictions to the prediction cache.", flush=True)
+            finally:
+                connection.execute("DETACH DATABASE shard")
+    finally:
+        connection.close()
+
+    print("Done!", flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
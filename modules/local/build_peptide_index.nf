@@ -0,0 +1,42 @@
+process BUILD_PEPTIDE_INDEX {
+    label "process_long"
+    label "process_high_memory"
+
+    conda "conda-forge::pandas=1.5.2 conda-forge::pyarrow=11.0.0"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/pandas:1.5.2' :
+        'biocontainers/pandas:1.5.2' }"
+
+
+    input:
+    path proteins_peptides
+    path entities_proteins
+    path microbiomes_entities
+    path conditions
+    path conditions_alleles
+
+    output:
+    path "peptide_index",   emit: ch_peptide_index   // indptr.npy, group.npy, count.npy, groups.tsv
+    path "versions.yml",    emit: versions
+
+    script:
+    def chunk_size            = params.downstream_chunk_size
+    def mem_log_level         = params.memory_usage_log_deep ? "--mem_log_level_deep" : ""
+    """
+    build_peptide_index.py --protein-peptide-occ "$proteins_peptides" \\
+                            --entities-proteins-occ "$entities_proteins" \\
+                            --microbiomes-entities-occ "$microbiomes_entities" \\
+                            --conditions "$conditions" \\
+                            --condition-allele-map "$conditions_alleles" \\
+                            --chunk-size $chunk_size \\
+                            $mem_log_level \\
+                            --outdir peptide_index
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        pandas: \$(python -c "import pkg_resources; print(pkg_resources.get_distribution('pandas').version)")
+        numpy: \$(python -c "import pkg_resources; print(pkg_resources.get_distribution('numpy').version)")
+    END_VERSIONS
+    """
+}
@@ -16,6 +16,7 @@ process CHECK_SAMPLESHEET_CREATE_TABLES {
     path "alleles.tsv"              , emit: alleles                      // allele_id, allele_name
     path "conditions_alleles.tsv"   , emit: conditions_alleles           // condition_id, allele_id
     path "samplesheet.valid.csv"    , emit: samplesheet_valid
+    env  pred_method_version        , emit: pred_method_version
     path "versions.yml"             , emit: versions
 
     when:
@@ -2,7 +2,7 @@ process COLLECT_STATS {
     label 'process_long'
     label 'process_high_memory'
 
-    conda "conda-forge::pandas=1.5.2"
+    conda "conda-forge::pandas=1.5.2 conda-forge::pyarrow=11.0.0"
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
         'https://depot.galaxyproject.org/singularity/pandas:1.5.2' :
         'biocontainers/pandas:1.5.2' }"
@@ -0,0 +1,37 @@
+process COMPACT_PREDICTIONS {
+    label "process_long"
+    label "process_high_memory"
+
+    conda "conda-forge::pandas=1.5.2 conda-forge::pyarrow=11.0.0"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/pandas:1.5.2' :
+        'biocontainers/pandas:1.5.2' }"
+
+
+    input:
+    path predictions
+
+    output:
+    path "predictions.compact.npz", emit: ch_compact_predictions
+    path "versions.yml",            emit: versions
+
+    script:
+    def chunk_size                = params.downstream_chunk_size
+    def syfpeithi_score_threshold = params.syfpeithi_score_threshold
+    def mhcf_mhcn_score_threshold = params.mhcflurry_mhcnuggets_score_threshold
+    """
+    compact_predictions.py --predictions "$predictions" \\
+                            --method ${params.pred_method} \\
+                            --chunk-size $chunk_size \\
+                            --syfpeithi_score_threshold $syfpeithi_score_threshold \\
+                            --mhcf_mhcn_score_threshold $mhcf_mhcn_score_threshold \\
+                            --output predictions.compact.npz
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        pandas: \$(python -c "import pkg_resources; print(pkg_resources.get_distribution('pandas').version)")
+        numpy: \$(python -c "import pkg_resources; print(pkg_resources.get_distribution('numpy').version)")
+    END_VERSIONS
+    """
+}
@@ -1,7 +1,7 @@
 process MERGE_PREDICTIONS {
     label "process_long"
 
-    conda "conda-forge::pandas=1.5.2"
+    conda "conda-forge::pandas=1.5.2 conda-forge::pyarrow=11.0.0"
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
         'https://depot.galaxyproject.org/singularity/pandas:1.5.2' :
         'biocontainers/pandas:1.5.2' }"
@@ -12,15 +12,18 @@ process MERGE_PREDICTIONS {
     path prediction_warnings
 
     output:
-    path "predictions.tsv.gz",          emit: ch_predictions
-    path "prediction_warnings.log",     emit: ch_prediction_warnings
-    path "versions.yml",                emit: versions
+    path "predictions.{tsv.gz,parquet,npz}", emit: ch_predictions
+    path "prediction_warnings.log",         emit: ch_prediction_warnings
+    path "versions.yml",                    emit: versions
 
     script:
     def chunk_size = params.prediction_chunk_size * params.pred_chunk_size_scaling
+    def output     = params.quantize_predictions ? "predictions.npz" :
+        params.intermediate_format == "parquet" ? "predictions.parquet" : "predictions.tsv.gz"
+    def sort       = params.sort_predictions ? "--sort peptide_id" : ""
     """
-    concat_tsv.py -i $predictions -c $chunk_size -o predictions.tsv.gz
-    sort -u $prediction_warnings > prediction_warnings.log
+    concat_tsv.py -i $predictions -c $chunk_size -o $output --threads $task.cpus $sort
+    sort -u /dev/null $prediction_warnings > prediction_warnings.log
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
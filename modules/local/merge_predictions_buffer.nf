@@ -17,12 +17,13 @@ process MERGE_PREDICTIONS_BUFFER {
 
     script:
     def chunk_size = params.prediction_chunk_size * params.pred_chunk_size_scaling
+    def sort       = params.sort_predictions ? "--sort peptide_id" : ""
     """
     [[ ${predictions[0]} =~  peptides_(.*)_predictions.tsv ]];
     uname="\${BASH_REMATCH[1]}"
     echo \$uname
 
-    concat_tsv.py -i $predictions -c $chunk_size -o predictions.buffer_\$uname.tsv
+    concat_tsv.py -i $predictions -c $chunk_size -o predictions.buffer_\$uname.tsv $sort
     sort -u $prediction_warnings > prediction_warnings.buffer_\$uname.log
 
     cat <<-END_VERSIONS > versions.yml
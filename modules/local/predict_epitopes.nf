@@ -10,13 +10,18 @@ process PREDICT_EPITOPES {
 
     input:
     path(peptides)
+    path(syfpeithi_max_scores)
 
     output:
-    path "*predictions.tsv",            emit:   ch_epitope_predictions
-    path "*pred_warnings.log",          emit:   ch_epitope_prediction_warnings
-    path "versions.yml",                emit:   versions
+    path "*predictions.tsv",                            emit:   ch_epitope_predictions
+    path "*pred_warnings.log",                          emit:   ch_epitope_prediction_warnings
+    path "prediction_cache.sqlite", optional: true,     emit:   ch_prediction_cache_shard
+    path "versions.yml",                                emit:   versions
 
     script:
+    // With a prediction cache, the predictions are written into a task-local shard,
+    // which is merged into the persistent cache by UPDATE_PREDICTION_CACHE
+    def cache = params.prediction_cache ? "--prediction-cache prediction_cache.sqlite" : ""
     """
     # create folder for MHCflurry downloads to avoid permission problems when running pipeline with docker profile and mhcflurry selected
     mkdir -p mhcflurry-data
@@ -24,9 +29,8 @@ process PREDICT_EPITOPES {
     # specify MHCflurry release for which to download models, need to be updated here as well when MHCflurry will be updated
     export MHCFLURRY_DOWNLOADS_CURRENT_RELEASE=1.4.0
 
-    # Extract software versions from container
-    mhcflurry_version=\$(mhcflurry-predict --version 2>&1 | sed 's/^mhcflurry //; s/ .*\$//')
-    mhcnuggets_version=\$(python -c "import pkg_resources; print(pkg_resources.get_distribution('mhcnuggets').version)")
+    # Extract software versions from container (within one interpreter to keep the task startup short)
+    read -r python_version epytope_version pandas_version mhcflurry_version mhcnuggets_version <<< "\$(python -c "import platform, pkg_resources; print(platform.python_version(), *[pkg_resources.get_distribution(p).version for p in ['epytope', 'pandas', 'mhcflurry', 'mhcnuggets']])")"
 
     # Syfpeithi is not an external software, but rather a matrix on which scoring is based on -> titled version 1.0 in epytope
     syfpeithi_version=1.0
@@ -47,42 +51,31 @@ process PREDICT_EPITOPES {
         ;;
     esac
 
-    # Extract allele name from file header
-    allele_name="\$(head -n1 "$peptides" | fgrep '#' | cut -f2 -d'#')"
-    allele_id="\$(head -n1 "$peptides" | fgrep '#' | cut -f3 -d'#')"
-
-    out_basename="\$(basename "$peptides" .txt)"
-    out_predictions="\$out_basename"_predictions.tsv
-    out_warnings="\$out_basename"_pred_warnings.log
-
-    # Create output header
-    echo "peptide_id	prediction_score	allele_id" >"\$out_predictions"
-
-    # Process file
-    # The --syfpeithi-norm flag enables score normalization when syfpeithi is
-    # used and is ignored otherwise
-    if ! epytope_predict.py --peptides "$peptides" \\
+    # Process all chunk files with one predictor, the allele names and ids are read from the
+    # chunk headers (#name1,name2#id1,id2) and for each chunk the predictions are written in
+    # long format (peptide_id, prediction_score, allele_id) along with the prediction warnings
+    # The --syfpeithi-norm flag enables score normalization (using the shipped table of
+    # max scores) and the --native-syfpeithi flag the NumPy based scoring when syfpeithi
+    # is used, both are ignored otherwise, and all CPUs of the task are used for the scoring
+    if ! epytope_predict.py --batch $peptides \\
+                    --output-dir . \\
                     --method "$params.pred_method" \\
                     --method_version "\$pred_method_version" \\
                     --syfpeithi-norm \\
-                    "\$allele_name" \\
-                    2>stderr.log \\
-                    | tail -n +2 \\
-                    | cut -f 1,3 \\
-                    | sed -e "s/\$/	\$allele_id/" \\
-                    >>"\$out_basename"_predictions.tsv; then
+                    --syfpeithi-max-scores "$syfpeithi_max_scores" \\
+                    --native-syfpeithi \\
+                    --threads $task.cpus \\
+                    $cache \\
+                    2>stderr.log; then
         cat stderr.log >&2
         exit 1
     fi
 
-    # Filter stderr for warnings and pass them on in the warnings channel
-    fgrep WARNING stderr.log  | sort -u >"\$out_warnings" || :
-
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
-        python: \$(python --version 2>&1 | sed 's/Python //g')
-        epytope: \$(python -c "import pkg_resources; print(pkg_resources.get_distribution('epytope').version)")
-        pandas: \$(python -c "import pkg_resources; print(pkg_resources.get_distribution('pandas').version)")
+        python: \$python_version
+        epytope: \$epytope_version
+        pandas: \$pandas_version
         mhcflurry: \$mhcflurry_version
         mhcnuggets: \$mhcnuggets_version
         syfpeithi: \$syfpeithi_version
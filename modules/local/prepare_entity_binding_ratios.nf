@@ -2,7 +2,7 @@ process PREPARE_ENTITY_BINDING_RATIOS {
     label "process_long"
     label "process_high_memory"
 
-    conda "conda-forge::pandas=1.5.2"
+    conda "conda-forge::pandas=1.5.2 conda-forge::pyarrow=11.0.0"
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
         'https://depot.galaxyproject.org/singularity/pandas:1.5.2' :
         'biocontainers/pandas:1.5.2' }"
@@ -16,6 +16,7 @@ process PREPARE_ENTITY_BINDING_RATIOS {
     path conditions
     path conditions_alleles
     path alleles
+    path peptide_index
 
     output:
     path "entity_binding_ratios.allele_*.tsv", emit: ch_prep_entity_binding_ratios
@@ -25,7 +26,9 @@ process PREPARE_ENTITY_BINDING_RATIOS {
     def chunk_size                = params.downstream_chunk_size
     def syfpeithi_score_threshold = params.syfpeithi_score_threshold
     def mhcf_mhcn_score_threshold = params.mhcflurry_mhcnuggets_score_threshold
+    def index                     = peptide_index ? "--peptide-index $peptide_index" : ""
     def mem_log_level             = params.memory_usage_log_deep ? "--mem_log_level_deep" : ""
+    def stream_sorted             = params.sort_predictions ? "--stream-sorted" : ""
     """
     prepare_entity_binding_ratios.py --predictions "$predictions" \\
                             --protein-peptide-occ "$proteins_peptides" \\
@@ -34,11 +37,13 @@ process PREPARE_ENTITY_BINDING_RATIOS {
                             --conditions "$conditions" \\
                             --condition-allele-map "$conditions_alleles" \\
                             --alleles "$alleles" \\
+                            $index \\
                             --method ${params.pred_method} \\
                             --chunk-size $chunk_size \\
                             --syfpeithi_score_threshold $syfpeithi_score_threshold \\
                             --mhcf_mhcn_score_threshold $mhcf_mhcn_score_threshold \\
                             $mem_log_level \\
+                            $stream_sorted \\
                             --outdir .
 
     cat <<-END_VERSIONS > versions.yml
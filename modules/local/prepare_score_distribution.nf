@@ -2,7 +2,7 @@ process PREPARE_SCORE_DISTRIBUTION {
     label "process_long"
     label "process_high_memory"
 
-    conda "conda-forge::pandas=1.5.2"
+    conda "conda-forge::pandas=1.5.2 conda-forge::pyarrow=11.0.0"
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
         'https://depot.galaxyproject.org/singularity/pandas:1.5.2' :
         'biocontainers/pandas:1.5.2' }"
@@ -16,6 +16,7 @@ process PREPARE_SCORE_DISTRIBUTION {
     path conditions
     path conditions_alleles
     path alleles
+    path peptide_index
 
     output:
     path "prediction_scores.allele_*.tsv", emit: ch_prep_prediction_scores
@@ -23,6 +24,7 @@ process PREPARE_SCORE_DISTRIBUTION {
 
     script:
     def chunk_size            = params.downstream_chunk_size
+    def index                 = peptide_index ? "--peptide-index $peptide_index" : ""
     def mem_log_level         = params.memory_usage_log_deep ? "--mem_log_level_deep" : ""
     """
     prepare_score_distribution.py --predictions "$predictions" \\
@@ -32,6 +34,8 @@ process PREPARE_SCORE_DISTRIBUTION {
                             --conditions "$conditions" \\
                             --condition-allele-map "$conditions_alleles" \\
                             --alleles "$alleles" \\
+                            $index \\
+                            --method ${params.pred_method} \\
                             --chunk-size $chunk_size \\
                             $mem_log_level \\
                             --outdir .
@@ -2,11 +2,16 @@ process SPLIT_PRED_TASKS {
     label 'process_long'
     label 'process_high_memory'
 
-    conda "conda-forge::pandas=1.5.2"
+    conda "conda-forge::pandas=1.5.2 conda-forge::pyarrow=11.0.0"
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
         'https://depot.galaxyproject.org/singularity/pandas:1.5.2' :
         'biocontainers/pandas:1.5.2' }"
 
+    // The persistent prediction cache directory is passed as absolute path instead of being staged,
+    // so it is mounted into the container at the same path
+    containerOptions "${ !prediction_cache ? '' :
+        workflow.containerEngine in ['singularity', 'apptainer'] ? "-B ${prediction_cache}" :
+        workflow.containerEngine in ['docker', 'podman'] ? "-v ${prediction_cache}:${prediction_cache}" : '' }"
 
     input:
     path(peptides            )
@@ -16,21 +21,35 @@ process SPLIT_PRED_TASKS {
     path(conditions          )
     path(conditions_alleles  )
     path(alleles             )
+    path(prediction_cost     )
+    val(pred_method_version  )
+    val(prediction_cache     )
     // The tables are joined to map peptide -> protein -> microbiome -> condition -> allele
     // and thus to enumerate, which (peptide, allele) combinations have to be predicted.
+    // GENERATE_PEPTIDES writes both peptide tables sorted by peptide_id, so the protein peptide
+    // occurences are streamed alongside the peptides instead of being loaded into memory at once.
+    // If a prediction cost table is given, the chunks are sized by the relative prediction cost of their peptides for the chosen method.
+    // If a prediction cache is given (absolute path, not staged but mounted), cached predictions are not written into chunks
+    // but passed on directly (no chunks are written if all are cached). Since PREDICT_EPITOPES always normalizes SYFPEITHI scores, normalized scores are looked up.
+    // With deduplicate_peptides, each peptide is written once per allele group along with a mask of its required alleles.
 
     output:
-    path "peptides_*.txt",  emit:   ch_epitope_prediction_chunks
-    path "versions.yml",    emit:   versions
+    path "peptides_*.txt", optional: true,          emit:   ch_epitope_prediction_chunks
+    path "cached_predictions.tsv", optional: true,  emit:   ch_cached_predictions
+    path "versions.yml",                            emit:   versions
 
     script:
     def max_chunk_num         = params.max_task_num
     def pred_chunk_size       = params.prediction_chunk_size
     def proc_chunk_size       = params.prediction_chunk_size * params.pred_chunk_size_scaling
     def mem_log_level         = params.memory_usage_log_deep ? "--mem_log_level_deep" : ""
+    def cost_table            = prediction_cost ? "--cost-table ${prediction_cost}" : ""
+    def cache                 = prediction_cache ? "--prediction-cache ${prediction_cache}/predictions.sqlite --syfpeithi-norm" : ""
+    def deduplicate_peptides  = params.deduplicate_peptides ? "--deduplicate-peptides" : ""
     """
     gen_prediction_chunks.py --peptides "$peptides" \\
                             --protein-peptide-occ "$proteins_peptides" \\
+                            --sorted-protein-peptide-occ \\
                             --entities-proteins-occ "$entities_proteins" \\
                             --microbiomes-entities-occ "$microbiomes_entities" \\
                             --conditions "$conditions" \\
@@ -40,6 +59,12 @@ process SPLIT_PRED_TASKS {
                             --proc-chunk-size $proc_chunk_size \\
                             $mem_log_level \\
                             --alleles "$alleles" \\
+                            $cost_table \\
+                            --pred-method ${params.pred_method} \\
+                            --pred-method-version ${pred_method_version} \\
+                            $cache \\
+                            --alleles-per-chunk ${params.alleles_per_chunk} \\
+                            $deduplicate_peptides \\
                             --outdir .
 
     cat <<-END_VERSIONS > versions.yml
@@ -0,0 +1,36 @@
+process UPDATE_PREDICTION_CACHE {
+    label "process_single"
+
+    conda "conda-forge::pandas=1.5.2 conda-forge::pyarrow=11.0.0"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/pandas:1.5.2' :
+        'biocontainers/pandas:1.5.2' }"
+
+    // The persistent prediction cache directory is passed as absolute path instead of being staged,
+    // so it is mounted into the container at the same path
+    containerOptions "${ !prediction_cache ? '' :
+        workflow.containerEngine in ['singularity', 'apptainer'] ? "-B ${prediction_cache}" :
+        workflow.containerEngine in ['docker', 'podman'] ? "-v ${prediction_cache}:${prediction_cache}" : '' }"
+
+    input:
+    path(shards, stageAs: "shards/shard*.sqlite")
+    val(prediction_cache)
+    // The prediction cache directory is given as absolute path and not staged (but mounted), since this task
+    // is the only one that writes into the persistent cache (the PREDICT_EPITOPES tasks write into
+    // task-local shards), so the cache has a single writer and its changes do not affect -resume.
+
+    output:
+    path "versions.yml",    emit: versions
+
+    script:
+    """
+    update_prediction_cache.py --shards $shards \\
+                                --prediction-cache "${prediction_cache}/predictions.sqlite"
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        sqlite: \$(python -c "import sqlite3; print(sqlite3.sqlite_version)")
+    END_VERSIONS
+    """
+}
@@ -180,5 +180,6 @@ workflow PROCESS_INPUT {
     ch_conditions           = CHECK_SAMPLESHEET_CREATE_TABLES.out.conditions
     ch_alleles              = CHECK_SAMPLESHEET_CREATE_TABLES.out.alleles
     ch_conditions_alleles   = CHECK_SAMPLESHEET_CREATE_TABLES.out.conditions_alleles
+    pred_method_version     = CHECK_SAMPLESHEET_CREATE_TABLES.out.pred_method_version
     versions                = ch_versions
 }
@@ -141,6 +141,10 @@ def validateInputParameters() {
     if (params.min_pep_len > params.max_pep_len) {
         error "The minimum peptide length needs to be smaller or equal than the maximum. See 'https://nf-co.re/metapep/dev/parameters' for more information."
     }
+    // Exit if Parquet intermediate tables are requested with containers, whose images do not provide pyarrow
+    if (params.intermediate_format == 'parquet' && workflow.containerEngine) {
+        error "The Parquet format for intermediate tables ('--intermediate_format parquet') requires pyarrow, which is not available in the containers of the pipeline. Please use '-profile conda' or '-profile mamba', or '--intermediate_format tsv'. See 'https://nf-co.re/metapep/dev/parameters' for more information."
+    }
 }
 
 //
@@ -27,8 +27,12 @@ include { GENERATE_PEPTIDES                 } from '../modules/local/generate_pe
 include { COLLECT_STATS                     } from '../modules/local/collect_stats'
 include { SPLIT_PRED_TASKS                  } from '../modules/local/split_pred_tasks'
 include { PREDICT_EPITOPES                  } from '../modules/local/predict_epitopes'
+include { UPDATE_PREDICTION_CACHE           } from '../modules/local/update_prediction_cache'
 include { MERGE_PREDICTIONS_BUFFER          } from '../modules/local/merge_predictions_buffer'
 include { MERGE_PREDICTIONS                 } from '../modules/local/merge_predictions'
+include { COMPACT_PREDICTIONS               } from '../modules/local/compact_predictions'
+include { BUILD_PEPTIDE_INDEX               } from '../modules/local/build_peptide_index'
+include { PREPARE_DOWNSTREAM                } from '../modules/local/prepare_downstream'
 include { PREPARE_SCORE_DISTRIBUTION        } from '../modules/local/prepare_score_distribution'
 include { PLOT_SCORE_DISTRIBUTION           } from '../modules/local/plot_score_distribution'
 include { PREPARE_ENTITY_BINDING_RATIOS     } from '../modules/local/prepare_entity_binding_ratios'
@@ -141,13 +145,16 @@ workflow METAPEP {
         //
 
         // Collects proteins, peptides, unique peptides per conditon
-        COLLECT_STATS (
-            GENERATE_PEPTIDES.out.ch_proteins_peptides,
-            GENERATE_PROTEIN_AND_ENTITY_IDS.out.ch_entities_proteins,
-            FINALIZE_MICROBIOME_ENTITIES.out.ch_microbiomes_entities,
-            PROCESS_INPUT.out.ch_conditions
-        )
-        ch_versions = ch_versions.mix(COLLECT_STATS.out.versions)
+        // (collected by PREPARE_DOWNSTREAM with --fused_downstream)
+        if (!params.fused_downstream) {
+            COLLECT_STATS (
+                GENERATE_PEPTIDES.out.ch_proteins_peptides,
+                GENERATE_PROTEIN_AND_ENTITY_IDS.out.ch_entities_proteins,
+                FINALIZE_MICROBIOME_ENTITIES.out.ch_microbiomes_entities,
+                PROCESS_INPUT.out.ch_conditions
+            )
+            ch_versions = ch_versions.mix(COLLECT_STATS.out.versions)
+        }
 
         //
         // MODULE: Split prediction tasks into chunks
@@ -155,6 +162,22 @@ workflow METAPEP {
 
         // Split prediction tasks (peptide, allele) into chunks of peptides that are to
         // be predicted against the same allele for parallel prediction
+        // (with cost_based_chunking, chunks are sized by the estimated prediction cost of the chosen method)
+        ch_prediction_cost_table = !params.cost_based_chunking ? [] :
+            params.prediction_cost_table ?
+            file(params.prediction_cost_table, checkIfExists: true) :
+            file("$projectDir/assets/prediction_cost.tsv", checkIfExists: true)
+
+        // Optional persistent prediction cache (SQLite database within the given directory), passed as absolute
+        // path instead of being staged, since it is updated in place by UPDATE_PREDICTION_CACHE
+        // (the directory is created beforehand, so that it can be mounted into the containers)
+        ch_prediction_cache = ""
+        if (params.prediction_cache) {
+            def prediction_cache_dir = file(params.prediction_cache, type: 'dir').toAbsolutePath()
+            prediction_cache_dir.mkdirs()
+            ch_prediction_cache = prediction_cache_dir.toString()
+        }
+
         SPLIT_PRED_TASKS (
         GENERATE_PEPTIDES.out.ch_peptides,
         GENERATE_PEPTIDES.out.ch_proteins_peptides,
@@ -162,18 +185,36 @@ workflow METAPEP {
         FINALIZE_MICROBIOME_ENTITIES.out.ch_microbiomes_entities,
         PROCESS_INPUT.out.ch_conditions,
         PROCESS_INPUT.out.ch_conditions_alleles,
-        PROCESS_INPUT.out.ch_alleles
+        PROCESS_INPUT.out.ch_alleles,
+        ch_prediction_cost_table,
+        PROCESS_INPUT.out.pred_method_version,
+        ch_prediction_cache
         )
         ch_versions = ch_versions.mix(SPLIT_PRED_TASKS.out.versions)
 
         //
         // MODULE: Epitope prediction
         //
+
+        // Maximum attainable SYFPEITHI scores per allele model and peptide length for the score normalization
+        ch_syfpeithi_max_scores = file("$projectDir/assets/syfpeithi_max_scores.tsv", checkIfExists: true)
+
+        // Predict the chunks in groups of prediction_chunks_per_task, using one predictor per task
         PREDICT_EPITOPES (
-            SPLIT_PRED_TASKS.out.ch_epitope_prediction_chunks.flatten()
+            SPLIT_PRED_TASKS.out.ch_epitope_prediction_chunks.flatten().collate(params.prediction_chunks_per_task),
+            ch_syfpeithi_max_scores
         )
         ch_versions = ch_versions.mix(PREDICT_EPITOPES.out.versions)
 
+        // Merge the prediction cache shards of all PREDICT_EPITOPES tasks into the persistent prediction cache
+        if (params.prediction_cache) {
+            UPDATE_PREDICTION_CACHE (
+                PREDICT_EPITOPES.out.ch_prediction_cache_shard.collect(),
+                ch_prediction_cache
+            )
+            ch_versions = ch_versions.mix(UPDATE_PREDICTION_CACHE.out.versions)
+        }
+
         //
         // MODULE: Merge prediction results
         //
@@ -212,31 +253,103 @@ workflow METAPEP {
         ch_versions = ch_versions.mix(MERGE_PREDICTIONS_BUFFER.out.versions)
 
         // Mix the output of the merge predictions buffer channel and merge predictions channel (one of them will be empty)
-        ch_merge_predictions_input_pred = MERGE_PREDICTIONS_BUFFER.out.ch_predictions_merged_buffer.mix(ch_predictions_unbuffered.predictions)
+        // and add the predictions found in the prediction cache
+        ch_merge_predictions_input_pred = MERGE_PREDICTIONS_BUFFER.out.ch_predictions_merged_buffer
+            .mix(ch_predictions_unbuffered.predictions)
+            .mix(SPLIT_PRED_TASKS.out.ch_cached_predictions)
         ch_merge_predictions_input_warn = MERGE_PREDICTIONS_BUFFER.out.ch_prediction_warnings_merged_buffer.mix(ch_predictions_unbuffered.warnings)
 
         MERGE_PREDICTIONS (
             ch_merge_predictions_input_pred.collect(),
-            ch_merge_predictions_input_warn.collect()
+            ch_merge_predictions_input_warn.collect().ifEmpty([])
         )
         ch_versions = ch_versions.mix(MERGE_PREDICTIONS.out.versions)
 
         //
-        // MODULE: Plot score distributions
+        // MODULE: Compact predictions into binder bitmaps and score bins for the downstream visualizations
         //
-        PREPARE_SCORE_DISTRIBUTION (
-            MERGE_PREDICTIONS.out.ch_predictions,
-            GENERATE_PEPTIDES.out.ch_proteins_peptides,
-            GENERATE_PROTEIN_AND_ENTITY_IDS.out.ch_entities_proteins,
-            FINALIZE_MICROBIOME_ENTITIES.out.ch_microbiomes_entities,
-            PROCESS_INPUT.out.ch_conditions,
-            PROCESS_INPUT.out.ch_conditions_alleles,
-            PROCESS_INPUT.out.ch_alleles
-        )
-        ch_versions = ch_versions.mix(PREPARE_SCORE_DISTRIBUTION.out.versions)
+        if (params.compact_predictions) {
+            COMPACT_PREDICTIONS (
+                MERGE_PREDICTIONS.out.ch_predictions
+            )
+            ch_versions = ch_versions.mix(COMPACT_PREDICTIONS.out.versions)
+            ch_downstream_predictions = COMPACT_PREDICTIONS.out.ch_compact_predictions
+        } else {
+            ch_downstream_predictions = MERGE_PREDICTIONS.out.ch_predictions
+        }
 
+        //
+        // MODULE: Prepare score distributions, entity binding ratios and stats in a single pass
+        //
+        if (params.fused_downstream) {
+            PREPARE_DOWNSTREAM (
+                ch_downstream_predictions,
+                GENERATE_PEPTIDES.out.ch_proteins_peptides,
+                GENERATE_PROTEIN_AND_ENTITY_IDS.out.ch_entities_proteins,
+                FINALIZE_MICROBIOME_ENTITIES.out.ch_microbiomes_entities,
+                PROCESS_INPUT.out.ch_conditions,
+                PROCESS_INPUT.out.ch_conditions_alleles,
+                PROCESS_INPUT.out.ch_alleles
+            )
+            ch_versions = ch_versions.mix(PREPARE_DOWNSTREAM.out.versions)
+            ch_prep_prediction_scores = PREPARE_DOWNSTREAM.out.ch_prep_prediction_scores
+            ch_prep_entity_binding_ratios = PREPARE_DOWNSTREAM.out.ch_prep_entity_binding_ratios
+        } else {
+            //
+            // MODULE: Build the peptide index shared by the downstream visualizations
+            //
+            if (params.peptide_index) {
+                BUILD_PEPTIDE_INDEX (
+                    GENERATE_PEPTIDES.out.ch_proteins_peptides,
+                    GENERATE_PROTEIN_AND_ENTITY_IDS.out.ch_entities_proteins,
+                    FINALIZE_MICROBIOME_ENTITIES.out.ch_microbiomes_entities,
+                    PROCESS_INPUT.out.ch_conditions,
+                    PROCESS_INPUT.out.ch_conditions_alleles
+                )
+                ch_versions = ch_versions.mix(BUILD_PEPTIDE_INDEX.out.versions)
+                ch_peptide_index = BUILD_PEPTIDE_INDEX.out.ch_peptide_index
+            } else {
+                ch_peptide_index = []
+            }
+
+            //
+            // MODULE: Prepare score distributions
+            //
+            PREPARE_SCORE_DISTRIBUTION (
+                ch_downstream_predictions,
+                GENERATE_PEPTIDES.out.ch_proteins_peptides,
+                GENERATE_PROTEIN_AND_ENTITY_IDS.out.ch_entities_proteins,
+                FINALIZE_MICROBIOME_ENTITIES.out.ch_microbiomes_entities,
+                PROCESS_INPUT.out.ch_conditions,
+                PROCESS_INPUT.out.ch_conditions_alleles,
+                PROCESS_INPUT.out.ch_alleles,
+                ch_peptide_index
+            )
+            ch_versions = ch_versions.mix(PREPARE_SCORE_DISTRIBUTION.out.versions)
+
+            //
+            // MODULE: Prepare entity binding ratios
+            //
+            PREPARE_ENTITY_BINDING_RATIOS (
+                ch_downstream_predictions,
+                GENERATE_PEPTIDES.out.ch_proteins_peptides,
+                GENERATE_PROTEIN_AND_ENTITY_IDS.out.ch_entities_proteins,
+                FINALIZE_MICROBIOME_ENTITIES.out.ch_microbiomes_entities,
+                PROCESS_INPUT.out.ch_conditions,
+                PROCESS_INPUT.out.ch_conditions_alleles,
+                PROCESS_INPUT.out.ch_alleles,
+                ch_peptide_index
+            )
+            ch_versions = ch_versions.mix(PREPARE_ENTITY_BINDING_RATIOS.out.versions)
+            ch_prep_prediction_scores = PREPARE_SCORE_DISTRIBUTION.out.ch_prep_prediction_scores
+            ch_prep_entity_binding_ratios = PREPARE_ENTITY_BINDING_RATIOS.out.ch_prep_entity_binding_ratios
+        }
+
+        //
+        // MODULE: Plot score distributions
+        //
         PLOT_SCORE_DISTRIBUTION (
-            PREPARE_SCORE_DISTRIBUTION.out.ch_prep_prediction_scores.flatten(),
+            ch_prep_prediction_scores.flatten(),
             PROCESS_INPUT.out.ch_alleles,
             PROCESS_INPUT.out.ch_conditions
         )
@@ -245,19 +358,8 @@ workflow METAPEP {
         //
         // MODULE: Plot entity binding ratios
         //
-        PREPARE_ENTITY_BINDING_RATIOS (
-            MERGE_PREDICTIONS.out.ch_predictions,
-            GENERATE_PEPTIDES.out.ch_proteins_peptides,
-            GENERATE_PROTEIN_AND_ENTITY_IDS.out.ch_entities_proteins,
-            FINALIZE_MICROBIOME_ENTITIES.out.ch_microbiomes_entities,
-            PROCESS_INPUT.out.ch_conditions,
-            PROCESS_INPUT.out.ch_conditions_alleles,
-            PROCESS_INPUT.out.ch_alleles
-        )
-        ch_versions = ch_versions.mix(PREPARE_ENTITY_BINDING_RATIOS.out.versions)
-
         PLOT_ENTITY_BINDING_RATIOS (
-            PREPARE_ENTITY_BINDING_RATIOS.out.ch_prep_entity_binding_ratios.flatten(),
+            ch_prep_entity_binding_ratios.flatten(),
             PROCESS_INPUT.out.ch_alleles
         )
         ch_versions = ch_versions.mix(PLOT_ENTITY_BINDING_RATIOS.out.versions)